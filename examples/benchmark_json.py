@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Benchmarks parsing and serializing the classes in u2flib_server.model using
+each available JSON backend.
+
+Usage: python examples/benchmark_json.py [-n ITERATIONS]
+"""
+
+from u2flib_server import json_backend
+from u2flib_server.model import (RegisteredKey, DeviceRegistration,
+                                 ClientData, RegisterRequest, RegisterResponse,
+                                 SignResponse, U2fRegisterRequest,
+                                 U2fSignRequest)
+import argparse
+import json
+import timeit
+
+
+KEY_HANDLE = ('BIarIKfyMqyf4bEI6tOqGInAfHrrQkMA2eyPJlNnInbAG1tXNpdRs48ef92_b1'
+              '-mfN4VhaTWxo1SGoxT6CIanw')
+PUBLIC_KEY = ('BBCcnAOknoMgokEGuTdfpNLQ-uylwlKp_xbEW8urjJsXKv9XZSL-V8C2nwcPEc'
+              'kav1mKZFr5K96uAoLtuxOUf-E')
+CHALLENGE = 'oIeu-nPxx9DcF7L_DCE3kvYox-c4UuvFb8lNG6th10o'
+APP_ID = 'https://www.example.com/appid'
+
+DEVICE = {
+    'version': 'U2F_V2',
+    'keyHandle': KEY_HANDLE,
+    'publicKey': PUBLIC_KEY,
+    'appId': APP_ID,
+    'transports': ['usb', 'nfc']
+}
+
+CLIENT_DATA = ('eyJvcmlnaW4iOiAiaHR0cHM6Ly93d3cuZXhhbXBsZS5jb20iLCAiY2hhbGxlbm'
+               'dlIjogIm9JZXUtblB4eDlEY0Y3TF9EQ0Uza3ZZb3gtYzRVdXZGYjhsTkc2dGgx'
+               'MG8iLCAidHlwIjogIm5hdmlnYXRvci5pZC5nZXRBc3NlcnRpb24ifQ')
+
+SAMPLES = [
+    (RegisteredKey, {'version': 'U2F_V2', 'keyHandle': KEY_HANDLE}),
+    (DeviceRegistration, DEVICE),
+    (ClientData, {
+        'typ': 'navigator.id.getAssertion',
+        'challenge': CHALLENGE,
+        'origin': 'https://www.example.com'
+    }),
+    (RegisterRequest, {'version': 'U2F_V2', 'challenge': CHALLENGE}),
+    (RegisterResponse, {
+        'version': 'U2F_V2',
+        'registrationData': 'B' * 1000,
+        'clientData': CLIENT_DATA
+    }),
+    (SignResponse, {
+        'keyHandle': KEY_HANDLE,
+        'signatureData': 'AAAAAAEwRQIhAJrcBSpaDprFzXmVw60r6x-_gOZ0t-8v7DGiiKm'
+                         'ar0SAAiAYKKEX41nWUCLLoKiBYuHYdPP1MPPNQ0cX_JIybPtThA',
+        'clientData': CLIENT_DATA
+    }),
+    (U2fRegisterRequest, {
+        'appId': APP_ID,
+        'registerRequests': [{'version': 'U2F_V2', 'challenge': CHALLENGE}],
+        'registeredKeys': [DEVICE] * 5
+    }),
+    (U2fSignRequest, {
+        'appId': APP_ID,
+        'challenge': CHALLENGE,
+        'registeredKeys': [DEVICE] * 5
+    }),
+]
+
+
+def run(iterations):
+    backends = json_backend.available_backends()
+    print('%-20s %-8s %12s %12s' % ('class', 'backend', 'parse (us)',
+                                    'json (us)'))
+    for cls, data in SAMPLES:
+        text = json.dumps(data)
+        for name in backends:
+            json_backend.set_backend(name, encode=True)
+            parse = timeit.timeit(lambda: cls(text), number=iterations)
+            obj = cls(text)
+            dump = timeit.timeit(lambda: obj.json, number=iterations)
+            print('%-20s %-8s %12.2f %12.2f' % (
+                cls.__name__, name, parse / iterations * 1e6,
+                dump / iterations * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n\n')[0])
+    parser.add_argument('-n', '--iterations', type=int, default=10000,
+                        help='iterations per measurement')
+    args = parser.parse_args()
+    run(args.iterations)
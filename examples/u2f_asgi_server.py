@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Reference U2F enrollment and authentication service, as an ASGI application.
+
+Compared to u2f_server.py, this service:
+ * Is configured with its AppID and facets up front, instead of deriving them
+   from each request, so requests share no mutable state.
+ * Keeps challenges, registrations and counters in pluggable stores. These
+   can use a shared SQLite file, so several worker processes can be run.
+ * Enforces monotonic signature counters.
+ * Runs each call, including store access and signature verification, in a
+   thread pool, off the event loop.
+
+It provides the same four calls: enroll, bind, sign and verify. Parameters
+(username and data) can be given in the query string, or as a form encoded
+POST body. Errors are returned as JSON with a 400 response code.
+
+This example requires Python 3.5+ and an ASGI server, such as uvicorn:
+
+  U2F_APP_ID=https://u2f.example.com uvicorn u2f_asgi_server:application
+
+The optional environment variables U2F_FACETS (comma separated) and U2F_DB (a
+path to an SQLite database) configure the facets and the stores. Without a
+database each worker process has its own stores, so only one worker can be
+used.
+"""
+
+from u2flib_server.u2f import (begin_registration, begin_authentication,
+                               complete_registration, complete_authentication)
+from u2flib_server.facets import FacetSet
+from u2flib_server.counters import MemoryCounterStore, SQLiteCounterStore
+from u2flib_server.repository import (MemoryRegistrationRepository,
+                                      SQLiteRegistrationRepository)
+from concurrent.futures import ThreadPoolExecutor
+from six.moves.urllib.parse import urlparse, parse_qsl
+import asyncio
+import argparse
+import logging
+import threading
+import sqlite3
+import json
+import abc
+import time
+import os
+
+
+log = logging.getLogger(__name__)
+
+
+class ChallengeStore(abc.ABC):
+    """Stores pending requests. Each one can only be taken once."""
+
+    @abc.abstractmethod
+    def put(self, key, request):
+        """Stores a request, replacing any pending one with the same key."""
+
+    @abc.abstractmethod
+    def pop(self, key):
+        """Removes and returns a pending request, or None if there is none."""
+
+
+class MemoryChallengeStore(ChallengeStore):
+
+    def __init__(self, ttl=300, clock=time.monotonic):
+        self._ttl = ttl
+        self._clock = clock
+        self._requests = {}
+        self._lock = threading.Lock()
+        self._next_purge = 0
+
+    def put(self, key, request):
+        now = self._clock()
+        with self._lock:
+            if now >= self._next_purge:
+                self._requests = dict(
+                    (k, v) for (k, v) in self._requests.items()
+                    if v[0] > now)
+                self._next_purge = now + self._ttl
+            self._requests[key] = (now + self._ttl, request)
+
+    def pop(self, key):
+        with self._lock:
+            expires, request = self._requests.pop(key, (0, None))
+        if expires <= self._clock():
+            return None
+        return request
+
+
+class SQLiteChallengeStore(ChallengeStore):
+    """Challenge store which can be shared by several worker processes."""
+
+    def __init__(self, path, ttl=300, table='u2f_challenges'):
+        self._ttl = ttl
+        self._table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, '
+            'expires REAL NOT NULL, request TEXT NOT NULL)' % table)
+
+    def put(self, key, request):
+        now = time.time()
+        with self._lock:
+            self._conn.execute('DELETE FROM %s WHERE expires <= ?' %
+                               self._table, (now,))
+            self._conn.execute(
+                'INSERT OR REPLACE INTO %s VALUES (?, ?, ?)' % self._table,
+                (json.dumps(key), now + self._ttl, request))
+
+    def pop(self, key):
+        key = json.dumps(key)
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    'SELECT expires, request FROM %s WHERE key = ?' %
+                    self._table, (key,)).fetchone()
+                self._conn.execute('DELETE FROM %s WHERE key = ?' %
+                                   self._table, (key,))
+            finally:
+                self._conn.execute('COMMIT')
+        if row is None or row[0] <= time.time():
+            return None
+        return row[1]
+
+
+class U2FService(object):
+    """The U2F operations, independent of transport."""
+
+    def __init__(self, app_id, facets=None, registrations=None,
+                 challenges=None, counters=None):
+        if facets is None:
+            parsed = urlparse(app_id)
+            facets = ['%s://%s' % (parsed.scheme, parsed.netloc)]
+        self.app_id = app_id
+        self.facets = FacetSet(facets)
+        self.registrations = registrations or MemoryRegistrationRepository()
+        self.challenges = challenges or MemoryChallengeStore()
+        self.counters = counters or MemoryCounterStore()
+
+    def enroll(self, username):
+        request = begin_registration(
+            self.app_id, self.registrations.registrations_for_user(username))
+        self.challenges.put(('enroll', username), request.json)
+        return request.data_for_client_json
+
+    def bind(self, username, data):
+        request = self.challenges.pop(('enroll', username))
+        if request is None:
+            raise ValueError('No pending enrollment')
+        device, cert = complete_registration(request, data, self.facets)
+        self.registrations.add(username, device)
+        log.info('U2F device enrolled. Username: %s', username)
+        return json.dumps(True)
+
+    def sign(self, username):
+        devices = self.registrations.registrations_for_user(username)
+        if not devices:
+            raise ValueError('No registered devices')
+        request = begin_authentication(self.app_id, devices)
+        self.challenges.put(('sign', username), request.json)
+        return request.data_for_client_json
+
+    def verify(self, username, data):
+        request = self.challenges.pop(('sign', username))
+        if request is None:
+            raise ValueError('No pending authentication')
+        device, counter, touch = complete_authentication(
+            request, data, self.facets, self.counters,
+            prepared_keys=self.registrations.prepared_keys(username,
+                                                           self.app_id))
+        return json.dumps({
+            'keyHandle': device['keyHandle'],
+            'touch': touch,
+            'counter': counter
+        })
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def _respond(send, status, body):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'application/json')]
+    })
+    await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+
+class U2FApplication(object):
+    """ASGI application exposing a U2FService."""
+
+    # Calls which take the response data from the client.
+    _with_data = ('bind', 'verify')
+
+    def __init__(self, service, max_workers=None):
+        self.service = service
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+
+        page = scope['path'].strip('/')
+        params = dict(parse_qsl(scope.get('query_string', b'').decode()))
+        body = await _read_body(receive)
+        if body:
+            params.update(parse_qsl(body.decode('utf-8')))
+
+        if not page:
+            return await _respond(send, 200,
+                                  json.dumps(sorted(self.service.facets)))
+        if page not in ('enroll', 'bind', 'sign', 'verify'):
+            return await _respond(send, 404, json.dumps({'error': 'Not found'}))
+
+        username = params.get('username', 'user')
+        args = [username]
+        if page in self._with_data:
+            args.append(params.get('data'))
+        call = getattr(self.service, page)
+
+        try:
+            # All calls use the stores, which may block, so they are run in
+            # the executor rather than on the event loop.
+            loop = asyncio.get_event_loop()
+            result = await loop.run_in_executor(self.executor, call, *args)
+        except Exception as e:
+            log.debug("Exception in call to '%s'", page, exc_info=True)
+            return await _respond(send, 400, json.dumps({'error': str(e)}))
+        await _respond(send, 200, result)
+
+
+def create_application(app_id, facets=None, db=None, max_workers=None):
+    if db:
+        registrations = SQLiteRegistrationRepository(db)
+        challenges = SQLiteChallengeStore(db)
+        counters = SQLiteCounterStore(db)
+    else:
+        registrations = MemoryRegistrationRepository()
+        challenges = MemoryChallengeStore()
+        counters = MemoryCounterStore()
+    service = U2FService(app_id, facets, registrations, challenges, counters)
+    return U2FApplication(service, max_workers)
+
+
+def _from_environ():
+    facets = os.environ.get('U2F_FACETS')
+    return create_application(
+        os.environ.get('U2F_APP_ID', 'http://localhost:8081'),
+        facets.split(',') if facets else None,
+        os.environ.get('U2F_DB')
+    )
+
+
+application = _from_environ()
+
+if __name__ == '__main__':
+    import uvicorn
+
+    parser = argparse.ArgumentParser(
+        description='U2F reference server',
+        add_help=True,
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-i', '--interface', nargs='?', default='localhost',
+                        help='network interface to bind to')
+    parser.add_argument('-p', '--port', nargs='?', type=int, default=8081,
+                        help='TCP port to bind to')
+    parser.add_argument('-a', '--app-id', help='the AppID to use, defaults to '
+                        'the server URL')
+    parser.add_argument('-f', '--facet', action='append', dest='facets',
+                        help='a valid facet, may be given more than once')
+    parser.add_argument('-d', '--db', help='SQLite database to store '
+                        'registrations and counters in')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of worker processes, more than one '
+                        'requires --db')
+
+    args = parser.parse_args()
+    if args.workers > 1 and not args.db:
+        parser.error('--workers above 1 requires --db, as the in-memory '
+                     'stores are not shared between processes')
+
+    os.environ['U2F_APP_ID'] = args.app_id or 'http://%s:%d' % (
+        args.interface, args.port)
+    if args.facets:
+        os.environ['U2F_FACETS'] = ','.join(args.facets)
+    if args.db:
+        os.environ['U2F_DB'] = args.db
+
+    logging.basicConfig(level=logging.INFO)
+    uvicorn.run('u2f_asgi_server:application', host=args.interface,
+                port=args.port, workers=args.workers)
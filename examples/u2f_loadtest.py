@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Load generator for U2F verification, using the soft U2F device from the test
+suite.
+
+N simulated devices are spread over M worker processes. Each process enrolls
+its devices, using pre-generated keys, and then issues a mix of registrations
+and authentications at a target rate. Latency histograms are reported for
+each server side call.
+
+Three targets are supported:
+ * api: the u2flib_server.u2f functions, called directly.
+ * asgi: u2f_asgi_server.py, driven in-process without HTTP.
+ * a URL: a running server providing the enroll/bind/sign/verify API, such as
+   u2f_server.py or u2f_asgi_server.py. Its AppID must be given with --app-id.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from test.soft_u2f_v2 import SoftU2FDevice, CURVE  # noqa: E402
+from u2flib_server.u2f import (begin_registration, begin_authentication,  # noqa
+                               complete_registration, complete_authentication)
+from cryptography.hazmat.backends import default_backend  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+from six.moves.urllib.parse import urlencode, urlparse  # noqa: E402
+from six.moves.urllib.request import urlopen  # noqa: E402
+from six.moves.urllib.error import HTTPError  # noqa: E402
+import multiprocessing  # noqa: E402
+import argparse  # noqa: E402
+import random  # noqa: E402
+import json  # noqa: E402
+import time  # noqa: E402
+
+
+APP_ID = 'https://u2f.example.com'
+CALLS = ('enroll', 'bind', 'sign', 'verify')
+
+
+class ApiTarget(object):
+    """Calls the library directly, keeping state in memory."""
+
+    def __init__(self, app_id):
+        self.app_id = app_id
+        self.facets = [_origin(app_id)]
+        self.devices = {}
+        self.requests = {}
+
+    def enroll(self, username):
+        request = begin_registration(self.app_id,
+                                     self.devices.get(username, []))
+        self.requests[username] = request.json
+        return request.data_for_client
+
+    def bind(self, username, data):
+        device, cert = complete_registration(self.requests.pop(username),
+                                             data, self.facets)
+        self.devices.setdefault(username, []).append(device)
+
+    def sign(self, username):
+        request = begin_authentication(self.app_id, self.devices[username])
+        self.requests[username] = request.json
+        return request.data_for_client
+
+    def verify(self, username, data):
+        complete_authentication(self.requests.pop(username), data,
+                                self.facets)
+
+
+class AsgiTarget(object):
+    """Drives u2f_asgi_server.py in-process."""
+
+    def __init__(self, app_id):
+        import asyncio
+        from u2f_asgi_server import create_application
+        self.app = create_application(app_id)
+        self.loop = asyncio.new_event_loop()
+
+    def _call(self, page, **params):
+        body = urlencode(params).encode('utf-8')
+        scope = {'type': 'http', 'method': 'POST', 'path': '/' + page,
+                 'query_string': b'', 'headers': []}
+        messages = [{'type': 'http.request', 'body': body}]
+        response = {}
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                response['status'] = message['status']
+            else:
+                response['body'] = message['body']
+
+        self.loop.run_until_complete(self.app(scope, receive, send))
+        if response['status'] != 200:
+            raise ValueError('%s failed: %s' % (page, response['body']))
+        return json.loads(response['body'].decode('utf-8'))
+
+    def enroll(self, username):
+        return self._call('enroll', username=username)
+
+    def bind(self, username, data):
+        self._call('bind', username=username, data=data.json)
+
+    def sign(self, username):
+        return self._call('sign', username=username)
+
+    def verify(self, username, data):
+        self._call('verify', username=username, data=data.json)
+
+
+class HttpTarget(AsgiTarget):
+    """Calls a running server over HTTP."""
+
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def _call(self, page, **params):
+        body = urlencode(params).encode('utf-8')
+        try:
+            response = urlopen('%s/%s' % (self.url, page), body)
+        except HTTPError as e:
+            raise ValueError('%s failed: %s' % (page, e.read()))
+        try:
+            return json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+
+
+def _origin(url):
+    parsed = urlparse(url)
+    return '%s://%s' % (parsed.scheme, parsed.netloc)
+
+
+def _create_target(target, app_id):
+    if target == 'api':
+        return ApiTarget(app_id)
+    if target == 'asgi':
+        return AsgiTarget(app_id)
+    return HttpTarget(target)
+
+
+class Histogram(object):
+    """Latency histogram with logarithmic buckets, from 10us to ~100s."""
+
+    BUCKETS = [10e-6 * 10 ** (i / 8.0) for i in range(57)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.values = []
+
+    def add(self, value):
+        i = 0
+        while i < len(self.BUCKETS) and value > self.BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.values.append(value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.values.extend(other.values)
+
+    def percentile(self, p):
+        values = sorted(self.values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def render(self, width=40):
+        peak = max(self.counts)
+        lines = []
+        for i, count in enumerate(self.counts):
+            if count:
+                bound = self.BUCKETS[i] if i < len(self.BUCKETS) else None
+                label = '<= %9.3f ms' % (bound * 1000) if bound else \
+                    ' > %9.3f ms' % (self.BUCKETS[-1] * 1000)
+                lines.append('  %s %8d %s' % (
+                    label, count, '#' * max(1, count * width // peak)))
+        return '\n'.join(lines)
+
+
+def _timed(histograms, call, func, *args):
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        histograms[call].add(time.time() - start)
+
+
+def _register(target, token, histograms, username, app_id, facet):
+    data = _timed(histograms, 'enroll', target.enroll, username)
+    response = token.register(facet, data['appId'],
+                              data['registerRequests'][0])
+    _timed(histograms, 'bind', target.bind, username, response)
+
+
+def _authenticate(target, token, histograms, username, facet):
+    data = _timed(histograms, 'sign', target.sign, username)
+    key = random.choice(data['registeredKeys'])
+    response = token.getAssertion(facet, data['appId'], data['challenge'],
+                                  key)
+    _timed(histograms, 'verify', target.verify, username, response)
+
+
+def worker(options):
+    (index, devices, keys_per_device, target, app_id, duration, rate,
+     register_ratio, prefix) = options
+    random.seed(index)
+    target = _create_target(target, app_id)
+    facet = _origin(app_id)
+    histograms = dict((call, Histogram()) for call in CALLS)
+    errors = 0
+
+    # Pre-generate all keys, so key generation doesn't skew the results.
+    keys = [ec.generate_private_key(CURVE, default_backend())
+            for _ in range(devices * (1 + keys_per_device))]
+
+    users = []
+    for i in range(devices):
+        username = '%s-%d-%d' % (prefix, index, i)
+        token = SoftU2FDevice(keys[i::devices])
+        _register(target, token, histograms, username, app_id, facet)
+        users.append((username, token))
+
+    # Only measure the steady state, not the initial enrollment.
+    histograms = dict((call, Histogram()) for call in CALLS)
+
+    start = next_at = time.time()
+    while time.time() - start < duration:
+        if rate:
+            delay = next_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            next_at += 1.0 / rate
+        username, token = random.choice(users)
+        try:
+            if token.private_keys and random.random() < register_ratio:
+                _register(target, token, histograms, username, app_id, facet)
+            else:
+                _authenticate(target, token, histograms, username, facet)
+        except ValueError:
+            errors += 1
+
+    return histograms, errors, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='U2F load generator',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-t', '--target', default='api',
+                        help='api, asgi, or the URL of a running server')
+    parser.add_argument('-a', '--app-id', default=APP_ID,
+                        help='AppID to use, for a URL target the AppID used '
+                        'by the server')
+    parser.add_argument('-n', '--devices', type=int, default=100,
+                        help='total number of simulated devices')
+    parser.add_argument('-p', '--processes', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of worker processes')
+    parser.add_argument('-d', '--duration', type=float, default=10.0,
+                        help='duration of the measurement, in seconds')
+    parser.add_argument('-r', '--rps', type=float, default=0,
+                        help='total target requests (register or sign '
+                        'operations) per second, 0 for unlimited')
+    parser.add_argument('-m', '--register-ratio', type=float, default=0.1,
+                        help='fraction of operations that are registrations')
+    parser.add_argument('-k', '--keys', type=int, default=10,
+                        help='pre-generated keys per device, for '
+                        'registrations after the initial one. Devices '
+                        'only authenticate once they run out')
+    parser.add_argument('--histogram', action='store_true',
+                        help='print latency histograms')
+    args = parser.parse_args()
+
+    processes = max(1, min(args.processes, args.devices))
+    prefix = '%x' % random.getrandbits(32)
+    options = [
+        (i, args.devices // processes + (i < args.devices % processes),
+         args.keys, args.target, args.app_id, args.duration,
+         args.rps / processes, args.register_ratio, prefix)
+        for i in range(processes)
+    ]
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(worker, options)
+    finally:
+        pool.close()
+
+    histograms = dict((call, Histogram()) for call in CALLS)
+    errors = 0
+    elapsed = max(r[2] for r in results)
+    for result_histograms, result_errors, _ in results:
+        errors += result_errors
+        for call in CALLS:
+            histograms[call].merge(result_histograms[call])
+
+    print('%d devices, %d processes, %.1f s, %d errors' % (
+        args.devices, processes, elapsed, errors))
+    print('%-8s %8s %10s %10s %10s %10s' % (
+        'call', 'count', 'p50 (ms)', 'p90 (ms)', 'p99 (ms)', 'rate (/s)'))
+    for call in CALLS:
+        histogram = histograms[call]
+        if histogram.values:
+            print('%-8s %8d %10.2f %10.2f %10.2f %10.1f' % (
+                call, len(histogram.values),
+                histogram.percentile(0.5) * 1000,
+                histogram.percentile(0.9) * 1000,
+                histogram.percentile(0.99) * 1000,
+                len(histogram.values) / elapsed))
+    if args.histogram:
+        for call in CALLS:
+            if histograms[call].values:
+                print('\n%s:' % call)
+                print(histograms[call].render())
+
+
+if __name__ == '__main__':
+    main()
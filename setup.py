@@ -34,6 +34,8 @@ import sys
 install_requires = ['cryptography>=1.2', 'six']
 if sys.version_info < (3, 4):
     install_requires.append('enum34')
+if sys.version_info < (3, 2):
+    install_requires.append('futures')
 
 
 setup(
@@ -45,10 +47,12 @@ setup(
     maintainer_email='ossmaint@yubico.com',
     url='https://github.com/Yubico/python-u2flib-server',
     install_requires=install_requires,
+    python_requires='>=2.7',
     test_suite='test',
     tests_require=[],
     extras_require={
         'u2f_server': ['WebOb'],
+        'reports': ['numpy'],
     },
     classifiers=[
         'License :: OSI Approved :: BSD License',
@@ -57,7 +61,6 @@ setup(
         'Intended Audience :: Developers',
         'Intended Audience :: System Administrators',
         'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
         'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
         'Programming Language :: Python :: 3.3',
@@ -62,15 +62,29 @@ lnhXcKoxn4w5SAgK3ZozFpwxf1whrx2BLQ==
 """
 
 
+_cert_priv = []
+
+
+def _get_cert_priv():
+    if not _cert_priv:
+        _cert_priv.append(load_pem_private_key(
+            CERT_PRIV, password=None, backend=default_backend()))
+    return _cert_priv[0]
+
+
 class SoftU2FDevice(object):
 
     """
     This simulates the U2F browser API with a soft U2F device connected.
     It can be used for testing.
+
+    Private keys for new registrations can be given up front, to avoid
+    generating them when registering, e.g. when generating load.
     """
-    def __init__(self):
+    def __init__(self, private_keys=None):
         self.keys = {}
         self.counter = 0
+        self.private_keys = list(private_keys or [])
 
     def register(self, facet, app_id, request):
         """
@@ -97,7 +111,10 @@ class SoftU2FDevice(object):
         client_param = sha_256(client_data)
 
         # ECC key generation
-        priv_key = ec.generate_private_key(CURVE, default_backend())
+        if self.private_keys:
+            priv_key = self.private_keys.pop()
+        else:
+            priv_key = ec.generate_private_key(CURVE, default_backend())
         pub_key = priv_key.public_key().public_bytes(
             Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
         pub_key = pub_key[-65:]
@@ -108,8 +125,7 @@ class SoftU2FDevice(object):
         self.keys[key_handle] = (priv_key, app_param)
 
         # Attestation signature
-        cert_priv = load_pem_private_key(
-            CERT_PRIV, password=None, backend=default_backend())
+        cert_priv = _get_cert_priv()
         cert = CERT
         data = b'\x00' + app_param + client_param + key_handle + pub_key
         signer = cert_priv.signer(ec.ECDSA(hashes.SHA256()))
@@ -1,15 +1,28 @@
 from u2flib_server.model import Transport
 from u2flib_server.attestation.metadata import MetadataProvider
-from u2flib_server.attestation.resolvers import create_resolver
+from u2flib_server.attestation.resolvers import (create_resolver, _iter_json,
+                                                 ReloadableResolver,
+                                                 ChainResolver,
+                                                 MetadataResolver)
 from u2flib_server.attestation.data import YUBICO
 from u2flib_server.attestation.model import (
     VendorInfo, Selector,
-    DeviceInfo, MetadataObject
+    DeviceInfo, MetadataObject, CompiledMetadata
 )
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta
 from base64 import b64decode
 import json
+import io
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 ATTESTATION_CERT = b64decode(b"""
@@ -126,6 +139,321 @@ class AttestationTest(unittest.TestCase):
         attestation = provider.get_attestation(cert)
         self.assertEqual(attestation.transports, [Transport.USB])
 
+    def test_resolver_from_stream(self):
+        extended = json.loads(json.dumps(YUBICO))
+        extended['description'] = 'x' * 1000
+        extended['devices'][0]['icon'] = 'x' * 1000
+        other = dict(YUBICO, identifier='other', trustedCertificates=[])
+
+        for data in [json.dumps([other, extended]),
+                     json.dumps(extended) + '\n' + json.dumps(other)]:
+            resolver = create_resolver(io.BytesIO(data.encode('utf-8')))
+            metadata = resolver.resolve(ATTESTATION_CERT)
+            self.assertEqual(metadata.identifier, YUBICO['identifier'])
+            self.assertNotIn('description', metadata)
+            self.assertNotIn('icon', metadata['devices'][0])
+            self.assertEqual(YUBICO['devices'], metadata['devices'])
+
+    def test_stream_chunks(self):
+        data = json.dumps([YUBICO, YUBICO, 12, u'\u00e9'], indent=2)
+        resolver = create_resolver()
+        for chunk_size in [1, 7, 100000]:
+            values = list(_iter_json(io.BytesIO(data.encode('utf-8')),
+                                     chunk_size))
+            self.assertEqual([YUBICO, YUBICO, 12, u'\u00e9'], values)
+        self.assertRaises(ValueError, list, _iter_json(io.StringIO(u'[{}')))
+        self.assertRaises(ValueError, resolver.add_metadata_stream,
+                          io.StringIO(u'{"identifier": '))
+
+
+def make_cert(subject, issuer=None, issuer_key=None, days=365, ca=False,
+              path_length=None, cert_sign=True):
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    issuer = issuer or subject
+    issuer_key = issuer_key or key
+    now = datetime.utcnow()
+    builder = x509.CertificateBuilder() \
+        .subject_name(x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, subject)])) \
+        .issuer_name(x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, issuer)])) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - timedelta(days=1)) \
+        .not_valid_after(now + timedelta(days=days))
+    if ca:
+        builder = builder.add_extension(
+            x509.BasicConstraints(ca=True, path_length=path_length), True)
+        builder = builder.add_extension(x509.KeyUsage(
+            digital_signature=False, content_commitment=False,
+            key_encipherment=False, data_encipherment=False,
+            key_agreement=False, key_cert_sign=cert_sign, crl_sign=True,
+            encipher_only=False, decipher_only=False), True)
+    cert = builder.sign(issuer_key, hashes.SHA256(), default_backend())
+    return cert, key
+
+
+class NegativeCacheTest(unittest.TestCase):
+
+    def create(self, *args, **kwargs):
+        resolver = MetadataResolver(*args, **kwargs)
+        calls = []
+        find_trusted = resolver._find_trusted
+
+        def counting_find_trusted(info, issuer):
+            calls.append(info)
+            return find_trusted(info, issuer)
+        resolver._find_trusted = counting_find_trusted
+        return resolver, calls
+
+    def test_untrusted_cached(self):
+        resolver, calls = self.create()
+        self.assertIsNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertIsNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, resolver.cache_stats()['untrusted'].hits)
+
+        resolver.add_metadata(YUBICO)
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertEqual(3, len(calls))
+
+    def test_invalidated_by_update(self):
+        resolver, calls = self.create()
+        resolver.add_metadata(dict(YUBICO, trustedCertificates=[]))
+        self.assertIsNone(resolver.resolve(ATTESTATION_CERT))
+        resolver.add_metadata(YUBICO)  # Same version, ignored
+        self.assertIsNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertEqual(1, len(calls))
+        resolver.add_metadata(dict(YUBICO, version=YUBICO['version'] + 1))
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
+
+    def test_size(self):
+        resolver, calls = self.create(negative_cache_size=1)
+        resolver.resolve(ATTESTATION_CERT)
+        resolver.resolve(ATTESTATION_CERT_WITH_TRANSPORT)
+        resolver.resolve(ATTESTATION_CERT)
+        self.assertEqual(3, len(calls))
+        self.assertEqual(1, len(resolver._untrusted))
+
+
+class ChainResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root, root_key = make_cert(u'Test Root')
+        self.root_key = root_key
+        self.intermediate, key = make_cert(u'Test CA', u'Test Root',
+                                           root_key, ca=True)
+        self.leaf, _ = make_cert(u'Test Device', u'Test CA', key)
+        self.metadata = dict(YUBICO, identifier='test', trustedCertificates=[
+            self.root.public_bytes(Encoding.PEM).decode('ascii')])
+
+    def create(self, **kwargs):
+        resolver = ChainResolver([self.intermediate], **kwargs)
+        resolver.add_metadata(self.metadata)
+        resolver.add_metadata(YUBICO)
+        self.addCleanup(resolver.close)
+        return resolver
+
+    def test_resolve_chain(self):
+        resolver = create_resolver(self.metadata)
+        self.assertIsNone(resolver.resolve(self.leaf))
+        resolver = self.create()
+        self.assertEqual('test', resolver.resolve(self.leaf).identifier)
+        self.assertEqual(YUBICO['identifier'],
+                         resolver.resolve(ATTESTATION_CERT).identifier)
+        self.assertIsNone(resolver.resolve(make_cert(u'Other')[0]))
+
+    def test_edges_cached(self):
+        resolver = self.create()
+        calls = []
+        verify_cert = resolver._verify_cert
+
+        def counting_verify_cert(cert, pubkey):
+            calls.append(cert)
+            return verify_cert(cert, pubkey)
+        resolver._verify_cert = counting_verify_cert
+
+        resolver.resolve(self.leaf)
+        self.assertEqual(2, len(calls))
+        resolver.resolve(self.leaf)
+        self.assertEqual(2, len(calls))
+
+        leaf2, _ = make_cert(u'Test Device', u'Test CA', make_cert(u'X')[1])
+        self.assertIsNone(resolver.resolve(leaf2))
+        self.assertEqual(3, len(calls))
+
+    def test_validity(self):
+        resolver = self.create(clock=lambda: datetime.utcnow() +
+                               timedelta(days=400))
+        self.assertIsNone(resolver.resolve(self.leaf))
+        resolver = self.create(check_validity=False, clock=lambda:
+                               datetime.utcnow() + timedelta(days=400))
+        self.assertEqual('test', resolver.resolve(self.leaf).identifier)
+
+    def test_validity_not_cached(self):
+        now = [datetime.utcnow() + timedelta(days=400)]
+        resolver = self.create(clock=lambda: now[0])
+        self.assertIsNone(resolver.resolve(self.leaf))
+        self.assertEqual(0, len(resolver._untrusted))
+        now[0] = datetime.utcnow()
+        self.assertEqual('test', resolver.resolve(self.leaf).identifier)
+
+        # Failures not caused by validity are still cached.
+        self.assertIsNone(resolver.resolve(make_cert(u'Other')[0]))
+        self.assertEqual(1, len(resolver._untrusted))
+
+    def test_concurrent_candidates(self):
+        resolver = self.create()
+        # Intermediates with the same name, not signed by the root
+        for _ in range(3):
+            resolver.add_intermediate(
+                make_cert(u'Test CA', u'Test Root', ca=True)[0])
+
+        # Each check waits for all four to have started, so this only
+        # succeeds if they run concurrently.
+        started = []
+        all_started = threading.Event()
+        verify_edge = resolver._verify_edge
+
+        def waiting_verify_edge(subject, issuer):
+            started.append(threading.current_thread())
+            if len(started) == 4:
+                all_started.set()
+            self.assertTrue(all_started.wait(5))
+            return verify_edge(subject, issuer)
+        resolver._verify_edge = waiting_verify_edge
+
+        self.assertEqual('test', resolver.resolve(self.leaf).identifier)
+        self.assertNotIn(threading.current_thread(), started[:4])
+
+    def test_concurrent_lookups(self):
+        resolver = self.create()
+        leaves = []
+        for n in range(8):
+            intermediate, key = make_cert(u'Test CA %d' % n, u'Test Root',
+                                          self.root_key, ca=True)
+            resolver.add_intermediate(intermediate)
+            leaves.append(make_cert(u'Device', u'Test CA %d' % n, key)[0])
+        results = []
+
+        def resolve(leaf):
+            results.append(resolver.resolve(leaf).identifier)
+        threads = [threading.Thread(target=resolve, args=(leaf,))
+                   for leaf in leaves * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(['test'] * 32, results)
+
+    def test_not_ca(self):
+        resolver = self.create()
+        leaf, key = make_cert(u'Leaf CA', u'Test Root', self.root_key)
+        self.assertRaises(ValueError, resolver.add_intermediate, leaf)
+        no_sign, _ = make_cert(u'Leaf CA', u'Test Root', self.root_key,
+                               ca=True, cert_sign=False)
+        self.assertRaises(ValueError, resolver.add_intermediate, no_sign)
+        self.assertIsNone(resolver.resolve(
+            make_cert(u'Device', u'Leaf CA', key)[0]))
+
+    def test_path_length(self):
+        resolver = self.create()
+        ca, ca_key = make_cert(u'Constrained', u'Test Root', self.root_key,
+                               ca=True, path_length=0)
+        sub, sub_key = make_cert(u'Sub CA', u'Constrained', ca_key, ca=True)
+        resolver.add_intermediate(ca)
+        resolver.add_intermediate(sub)
+        self.assertEqual('test', resolver.resolve(
+            make_cert(u'Device', u'Constrained', ca_key)[0]).identifier)
+        self.assertIsNone(resolver.resolve(
+            make_cert(u'Device', u'Sub CA', sub_key)[0]))
+
+    def test_reindex_clears_anchors(self):
+        resolver = self.create()
+        resolver.resolve(self.leaf)
+        self.assertTrue(resolver._infos)
+        resolver.add_metadata(dict(self.metadata,
+                                   version=self.metadata['version'] + 1,
+                                   trustedCertificates=[]))
+        self.assertFalse(resolver._infos)
+        self.assertIsNone(resolver.resolve(self.leaf))
+
+    def test_max_depth(self):
+        resolver = self.create(max_depth=0)
+        self.assertIsNone(resolver.resolve(self.leaf))
+
+
+class ReloadableResolverTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.write('yubico.json', YUBICO)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, fname, data, mtime=None):
+        fname = os.path.join(self.tmpdir, fname)
+        with open(fname, 'w') as f:
+            json.dump(data, f)
+        if mtime is not None:
+            os.utime(fname, (mtime, mtime))
+
+    def test_reload(self):
+        resolver = ReloadableResolver(self.tmpdir)
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertFalse(resolver.reload())
+
+        # Rewritten with the same contents
+        self.write('yubico.json', YUBICO, 1000)
+        initial = resolver.resolver
+        self.assertFalse(resolver.reload())
+        self.assertIs(initial, resolver.resolver)
+
+        newer = dict(YUBICO, version=YUBICO['version'] + 1,
+                     trustedCertificates=[])
+        self.write('newer.json', [newer])
+        self.assertTrue(resolver.reload())
+        self.assertIsNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertIsNotNone(initial.resolve(ATTESTATION_CERT))
+
+        os.remove(os.path.join(self.tmpdir, 'newer.json'))
+        self.assertTrue(resolver.reload())
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
+
+    def test_invalid_file(self):
+        resolver = ReloadableResolver(self.tmpdir)
+        with open(os.path.join(self.tmpdir, 'broken.json'), 'w') as f:
+            f.write('{')
+        loaded = resolver.last_loaded
+        self.assertRaises(ValueError, resolver.reload)
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertIsInstance(resolver.last_error, ValueError)
+        self.assertEqual(loaded, resolver.last_loaded)
+
+        os.remove(os.path.join(self.tmpdir, 'broken.json'))
+        resolver.reload()
+        self.assertIsNone(resolver.last_error)
+
+    def test_resolver_factory(self):
+        def factory():
+            chain = ChainResolver()
+            chain.enable_prefilter()
+            return chain
+        resolver = ReloadableResolver(self.tmpdir, resolver_factory=factory)
+        self.assertIsInstance(resolver.resolver, ChainResolver)
+        self.write('newer.json', dict(YUBICO, version=YUBICO['version'] + 1))
+        resolver.reload()
+        self.assertIsInstance(resolver.resolver, ChainResolver)
+        self.assertIsNotNone(resolver.resolver._get_prefilter())
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
+
+    def test_start(self):
+        resolver = ReloadableResolver(self.tmpdir, interval=0.01)
+        resolver.start()
+        resolver.close()
+
 
 class DeviceInfoTest(unittest.TestCase):
     def test_selectors_empty(self):
@@ -151,3 +479,57 @@ class MetadataObjectTest(unittest.TestCase):
         self.assertTrue(isinstance(metadata.devices[0], DeviceInfo))
         self.assertTrue(isinstance(metadata.devices[1], DeviceInfo))
         self.assertTrue(isinstance(metadata.devices[2], DeviceInfo))
+
+
+class CompiledMetadataTest(unittest.TestCase):
+    def test_compile(self):
+        compiled = CompiledMetadata(YUBICO)
+        self.assertEqual(YUBICO, compiled.metadata)
+        self.assertIsInstance(compiled.metadata, MetadataObject)
+        self.assertEqual(YUBICO['identifier'], compiled.identifier)
+        self.assertEqual(YUBICO['version'], compiled.version)
+        self.assertIsInstance(compiled.vendor_info, VendorInfo)
+        self.assertEqual(len(YUBICO['devices']), len(compiled.devices))
+        device = compiled.devices[0]
+        self.assertIsInstance(device.info, DeviceInfo)
+        self.assertEqual(YUBICO['devices'][0], device.info)
+        self.assertEqual(
+            tuple((s['type'], s['parameters'])
+                  for s in YUBICO['devices'][0]['selectors']),
+            device.selectors)
+        self.assertIs(compiled, CompiledMetadata.wrap(compiled))
+
+    def test_empty(self):
+        compiled = CompiledMetadata({})
+        self.assertIsNone(compiled.vendor_info)
+        self.assertEqual((), compiled.devices)
+
+    def test_provider_copies_objects(self):
+        provider = MetadataProvider(YUBICO_RESOLVER)
+        a1 = provider.get_attestation(ATTESTATION_CERT)
+        self.assertIs(a1.device_info, a1.device_info)
+        a1.device_info['displayName'] = 'Modified'
+        a1.device_info['selectors'].append({})
+        a1.vendor_info['name'] = 'Modified'
+
+        a2 = provider.get_attestation(ATTESTATION_CERT)
+        self.assertIsInstance(a2.device_info, DeviceInfo)
+        self.assertIsInstance(a2.vendor_info, VendorInfo)
+        self.assertNotEqual('Modified', a2.device_info['displayName'])
+        self.assertNotEqual('Modified', a2.vendor_info['name'])
+        self.assertEqual(a1.device_info['selectors'][:-1],
+                         a2.device_info['selectors'])
+
+    def test_provider_plain_resolver(self):
+        test = self
+
+        class PlainResolver(object):
+            def resolve(self, cert):
+                test.assertIsInstance(cert, x509.Certificate)
+                return YUBICO_RESOLVER.resolve(cert)
+
+        attestation = MetadataProvider(PlainResolver()).get_attestation(
+            ATTESTATION_CERT)
+        self.assertTrue(attestation.trusted)
+        self.assertEqual(attestation.device_info['deviceId'],
+                         '1.3.6.1.4.1.41482.1.2')
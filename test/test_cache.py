@@ -0,0 +1,124 @@
+from u2flib_server.cache import ShardedLRUCache, CacheStats, stats
+from u2flib_server.model import _app_param
+from u2flib_server.replay import ReplayCache
+from u2flib_server.facets import TrustedFacetsResolver
+from u2flib_server.attestation.resolvers import ChainResolver
+import threading
+import unittest
+
+
+class ShardedLRUCacheTest(unittest.TestCase):
+
+    def test_get_put(self):
+        cache = ShardedLRUCache()
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(1, cache.get('a', 1))
+        cache.put('a', 2)
+        self.assertEqual(2, cache.get('a'))
+        self.assertIn('a', cache)
+        self.assertEqual(2, cache.pop('a'))
+        self.assertNotIn('a', cache)
+        self.assertEqual(0, len(cache))
+
+    def test_lru(self):
+        cache = ShardedLRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(2, len(cache))
+
+    def test_sharded(self):
+        cache = ShardedLRUCache(maxsize=1000, shards=8)
+        self.assertEqual(8, len(cache._shards))
+        self.assertEqual(1000, sum(s.maxsize for s in cache._shards))
+        for i in range(2000):
+            cache.put(i, i)
+        self.assertEqual(1000, len(cache))
+        self.assertEqual(1999, cache.get(1999))
+        cache.resize(100)
+        self.assertEqual(100, len(cache))
+        self.assertEqual(1, len(ShardedLRUCache(maxsize=100)._shards))
+
+    def test_ttl(self):
+        now = [0]
+        cache = ShardedLRUCache(ttl=10, clock=lambda: now[0])
+        cache.put('a', 1)
+        now[0] = 9
+        self.assertEqual(1, cache.get('a'))
+        now[0] = 10
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(1, cache.stats().expirations)
+
+    def test_get_or_create(self):
+        cache = ShardedLRUCache()
+        calls = []
+
+        def factory():
+            calls.append(1)
+            return 'value'
+        self.assertEqual('value', cache.get_or_create('a', factory))
+        self.assertEqual('value', cache.get_or_create('a', factory))
+        self.assertEqual(1, len(calls))
+
+    def test_setdefault(self):
+        now = [0]
+        cache = ShardedLRUCache(ttl=10, clock=lambda: now[0])
+        self.assertEqual(1, cache.setdefault('a', 1))
+        self.assertEqual(1, cache.setdefault('a', 2))
+        now[0] = 10
+        self.assertEqual(3, cache.setdefault('a', 3))
+        self.assertEqual(3, cache.get('a'))
+
+    def test_stats(self):
+        cache = ShardedLRUCache(maxsize=1, name='test_stats')
+        cache.get('a')
+        cache.put('a', 1)
+        cache.get('a')
+        cache.put('b', 2)
+        self.assertEqual(CacheStats(hits=1, misses=1, evictions=1,
+                                    expirations=0, size=1, maxsize=1),
+                         cache.stats())
+        self.assertEqual(cache.stats(), stats()['test_stats'])
+
+    def test_app_params_registered(self):
+        _app_param('https://example.com')
+        self.assertGreaterEqual(stats()['app_params'].size, 1)
+        self.assertIn('certificates', stats())
+
+    def test_same_name(self):
+        first = ShardedLRUCache(maxsize=2, name='test_same_name')
+        second = ShardedLRUCache(maxsize=3, name='test_same_name')
+        first.put('a', 1)
+        second.put('a', 1)
+        second.get('a')
+        self.assertEqual(CacheStats(hits=1, misses=0, evictions=0,
+                                    expirations=0, size=2, maxsize=5),
+                         stats()['test_same_name'])
+
+    def test_library_caches_registered(self):
+        # Caches are registered weakly, so keep the owners alive.
+        caches = [ReplayCache(), TrustedFacetsResolver(), ChainResolver()]
+        names = stats()
+        for name in ('replay', 'trusted_facets', 'attestation_untrusted',
+                     'attestation_edges', 'attestation_anchors'):
+            self.assertIn(name, names)
+        del caches
+
+    def test_threads(self):
+        cache = ShardedLRUCache(maxsize=256)
+
+        def run(n):
+            for i in range(1000):
+                cache.put((n, i % 100), i)
+                cache.get((n, (i + 1) % 100))
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(len(cache), 256)
+        result = cache.stats()
+        self.assertEqual(8000, result.hits + result.misses)
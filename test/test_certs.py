@@ -0,0 +1,44 @@
+from u2flib_server.certs import CertificateCache, get_certificate_info
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from .test_attestation import (ATTESTATION_CERT,
+                               ATTESTATION_CERT_WITH_TRANSPORT)
+import unittest
+
+
+class CertificateCacheTest(unittest.TestCase):
+
+    def test_parse_once(self):
+        cache = CertificateCache()
+        info = cache.get(ATTESTATION_CERT)
+        self.assertIs(info, cache.get(ATTESTATION_CERT))
+        self.assertIs(info, cache.get(info))
+        self.assertEqual(1, len(cache))
+
+    def test_parsed_certificate(self):
+        cache = CertificateCache()
+        cert = x509.load_der_x509_certificate(ATTESTATION_CERT,
+                                              default_backend())
+        info = cache.get(cert)
+        self.assertIs(cert, info.certificate)
+        self.assertIs(info, cache.get(ATTESTATION_CERT))
+
+    def test_bounded(self):
+        cache = CertificateCache(maxsize=1)
+        first = cache.get(ATTESTATION_CERT)
+        cache.get(ATTESTATION_CERT_WITH_TRANSPORT)
+        self.assertEqual(1, len(cache))
+        self.assertIsNot(first, cache.get(ATTESTATION_CERT))
+
+    def test_derived_values(self):
+        info = get_certificate_info(ATTESTATION_CERT_WITH_TRANSPORT)
+        self.assertEqual('test', info.issuer_cn)
+        self.assertEqual('Yubico U2F EE Serial 544338083', info.subject_cn)
+        self.assertEqual(0x0c, info.transports)
+        self.assertEqual(b'1.3.6.1.4.1.41482.1.2',
+                         info.extension_value('1.3.6.1.4.1.41482.2'))
+        self.assertIsNone(info.extension_value('1.2.3.4'))
+        self.assertEqual(32, len(info.fingerprint))
+
+    def test_no_transports(self):
+        self.assertIsNone(get_certificate_info(ATTESTATION_CERT).transports)
@@ -0,0 +1,161 @@
+from u2flib_server.counters import (MemoryCounterStore, SQLiteCounterStore,
+                                    WriteBehindCounterStore)
+from u2flib_server.u2f import begin_authentication, complete_authentication
+from .test_u2f import register_token, APP_ID, FACET
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+
+class CounterStoreTests(object):
+
+    def test_check_and_set(self):
+        store = self.create_store()
+        self.assertIsNone(store.get('a'))
+        self.assertTrue(store.check_and_set('a', 1))
+        self.assertTrue(store.check_and_set('a', 5))
+        self.assertFalse(store.check_and_set('a', 5))
+        self.assertFalse(store.check_and_set('a', 2))
+        self.assertTrue(store.check_and_set('b', 0))
+        self.assertEqual(5, store.get('a'))
+
+    def test_update_many(self):
+        store = self.create_store()
+        store.check_and_set('a', 5)
+        store.update_many([('a', 3), ('b', 2)])
+        self.assertEqual(5, store.get('a'))
+        self.assertEqual(2, store.get('b'))
+
+
+class MemoryCounterStoreTest(unittest.TestCase, CounterStoreTests):
+
+    def create_store(self):
+        return MemoryCounterStore()
+
+
+class SQLiteCounterStoreTest(unittest.TestCase, CounterStoreTests):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def create_store(self):
+        return SQLiteCounterStore(os.path.join(self.tmpdir, 'counters.db'))
+
+    def test_shared_file(self):
+        store1 = self.create_store()
+        store2 = self.create_store()
+        self.assertTrue(store1.check_and_set('a', 1))
+        self.assertFalse(store2.check_and_set('a', 1))
+        self.assertTrue(store2.check_and_set('a', 2))
+        self.assertEqual(2, store1.get('a'))
+
+
+class WriteBehindCounterStoreTest(unittest.TestCase, CounterStoreTests):
+
+    def create_store(self):
+        return WriteBehindCounterStore(MemoryCounterStore())
+
+    def test_write_behind(self):
+        backing = MemoryCounterStore()
+        backing.check_and_set('a', 3)
+        store = WriteBehindCounterStore(backing, max_pending=2)
+        self.assertFalse(store.check_and_set('a', 3))
+        self.assertTrue(store.check_and_set('a', 4))
+        self.assertEqual(3, backing.get('a'))
+        self.assertTrue(store.check_and_set('b', 1))
+        self.assertEqual(4, backing.get('a'))
+        self.assertEqual(1, backing.get('b'))
+        store.check_and_set('b', 2)
+        store.close()
+        self.assertEqual(2, backing.get('b'))
+
+
+class FlakyCounterStore(MemoryCounterStore):
+
+    def __init__(self):
+        super(FlakyCounterStore, self).__init__()
+        self.failing = True
+        self.event = threading.Event()
+
+    def update_many(self, counters):
+        self.event.set()
+        if self.failing:
+            raise sqlite3.OperationalError('database is locked')
+        super(FlakyCounterStore, self).update_many(counters)
+
+
+class WriteBehindFailureTest(unittest.TestCase):
+
+    def test_flush_retried(self):
+        backing = FlakyCounterStore()
+        store = WriteBehindCounterStore(backing, flush_interval=0.01)
+        store.check_and_set('a', 1)
+        store.start()
+        self.assertTrue(backing.event.wait(5))
+        backing.event.clear()
+        self.assertTrue(backing.event.wait(5))  # Thread is still running.
+        self.assertIsNone(backing.get('a'))
+
+        backing.failing = False
+        store.close()
+        self.assertEqual(1, backing.get('a'))
+
+    def test_bounded(self):
+        backing = MemoryCounterStore()
+        store = WriteBehindCounterStore(backing, max_cached=2)
+        for key_handle in 'abcd':
+            store.check_and_set(key_handle, 5)
+        self.assertEqual(2, len(store._counters))
+        # Evicted, but not yet written.
+        self.assertFalse(store.check_and_set('a', 5))
+        store.flush()
+        self.assertEqual(5, backing.get('a'))
+        self.assertFalse(store.check_and_set('b', 4))
+        self.assertTrue(store.check_and_set('b', 6))
+
+    def test_evicted_during_read(self):
+        backing = MemoryCounterStore()
+        backing.check_and_set('a', 3)
+        store = WriteBehindCounterStore(backing)
+        get = backing.get
+
+        def racing_get(key_handle):
+            # Another thread accepts, writes and evicts a counter while this
+            # one reads the old value.
+            backing.get = get
+            value = get(key_handle)
+            self.assertTrue(store.check_and_set(key_handle, 10))
+            store.flush()
+            store._counters.clear()
+            return value
+        backing.get = racing_get
+
+        self.assertFalse(store.check_and_set('a', 4))
+        self.assertEqual(10, store.get('a'))
+
+
+class CompleteAuthenticationTest(unittest.TestCase):
+
+    def test_counter_store(self):
+        store = MemoryCounterStore()
+        device, token = register_token()
+
+        def authenticate():
+            request = begin_authentication(APP_ID, [device])
+            data = request.data_for_client
+            response = token.getAssertion(FACET, data['appId'],
+                                          data['challenge'],
+                                          data['registeredKeys'][0])
+            return complete_authentication(request, response,
+                                           counter_store=store)
+
+        authenticate()
+        authenticate()
+        token.counter = 0
+        self.assertRaises(ValueError, authenticate)
@@ -0,0 +1,254 @@
+from u2flib_server.facets import (FacetSet, TrustedFacetsResolver,
+                                  parse_trusted_facets, _http_fetch,
+                                  TRUSTED_FACETS_TYPE)
+from u2flib_server.u2f import (begin_registration, complete_registration,
+                               check_registration)
+from u2flib_server.model import ErrorCode
+from .soft_u2f_v2 import SoftU2FDevice
+from six.moves.BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from six.moves.urllib.error import HTTPError
+import json
+import threading
+import unittest
+
+APP_ID = 'https://example.com/appid'
+FACET_LIST = json.dumps({
+    'trustedFacets': [{
+        'version': {'major': 1, 'minor': 0},
+        'ids': [
+            'https://login.example.com',
+            'http://insecure.example.com',
+            'android:apk-key-hash:abc'
+        ]
+    }, {
+        'version': {'major': 2, 'minor': 0},
+        'ids': ['https://future.example.com']
+    }]
+})
+
+
+class Clock(object):
+    now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class Fetcher(object):
+
+    def __init__(self, body=FACET_LIST):
+        self.body = body
+        self.urls = []
+        self.event = threading.Event()
+
+    def __call__(self, url):
+        self.urls.append(url)
+        self.event.set()
+        return self.body
+
+
+class FailingFetcher(Fetcher):
+
+    def __call__(self, url):
+        Fetcher.__call__(self, url)
+        raise IOError('Unavailable')
+
+
+class Handler(BaseHTTPRequestHandler):
+    responses_by_path = {
+        '/facets': (200, {'Content-Type': TRUSTED_FACETS_TYPE}),
+        '/wrong-type': (200, {'Content-Type': 'text/html'}),
+        '/no-content': (204, {'Content-Type': TRUSTED_FACETS_TYPE}),
+        '/redirect': (302, {'Location': '/facets'}),
+        '/authorized': (302, {'Location': '/facets',
+                              'FIDO-AppID-Redirect-Authorized': 'true'}),
+    }
+
+    def do_GET(self):
+        status, headers = self.responses_by_path[self.path]
+        body = FACET_LIST.encode('utf-8') if status == 200 else b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpFetchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=cls.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        cls.base = 'http://127.0.0.1:%d' % cls.server.server_address[1]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def test_fetch(self):
+        self.assertEqual(FACET_LIST.encode('utf-8'),
+                         _http_fetch(self.base + '/facets'))
+
+    def test_wrong_content_type(self):
+        self.assertRaises(ValueError, _http_fetch, self.base + '/wrong-type')
+
+    def test_status(self):
+        self.assertRaises(ValueError, _http_fetch, self.base + '/no-content')
+
+    def test_redirect(self):
+        self.assertRaises(HTTPError, _http_fetch, self.base + '/redirect')
+        self.assertEqual(FACET_LIST.encode('utf-8'),
+                         _http_fetch(self.base + '/authorized'))
+
+
+class FacetsTest(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(
+            set(['https://example.com', 'https://login.example.com']),
+            parse_trusted_facets(APP_ID, FACET_LIST))
+        self.assertRaises(ValueError, parse_trusted_facets, APP_ID, '{}')
+
+    def test_facet_set(self):
+        facets = FacetSet(['https://example.com'])
+        self.assertIn('https://example.com', facets)
+        self.assertEqual("FacetSet(['https://example.com'])", repr(facets))
+
+    def test_cached(self):
+        fetcher = Fetcher()
+        resolver = TrustedFacetsResolver(fetcher, clock=Clock())
+        facets = resolver.get_facets(APP_ID)
+        self.assertIs(facets, resolver.get_facets(APP_ID))
+        self.assertEqual([APP_ID], fetcher.urls)
+
+    def test_http_app_id(self):
+        fetcher = Fetcher()
+        resolver = TrustedFacetsResolver(fetcher)
+        self.assertEqual(set(['http://example.com']),
+                         resolver.get_facets('http://example.com/appid'))
+        self.assertEqual([], fetcher.urls)
+
+    def test_stale_while_revalidate(self):
+        clock = Clock()
+        fetcher = Fetcher()
+        resolver = TrustedFacetsResolver(fetcher, ttl=10, stale_ttl=10,
+                                         clock=clock)
+        facets = resolver.get_facets(APP_ID)
+        fetcher.event.clear()
+
+        clock.now += 15
+        fetcher.body = json.dumps({'trustedFacets': []})
+        entry = resolver._entries.get(APP_ID)
+        self.assertIs(facets, resolver.get_facets(APP_ID))
+        self.assertTrue(fetcher.event.wait(5))
+        while resolver._entries.get(APP_ID) is entry:
+            threading.Event().wait(0.01)
+
+        clock.now += 30
+        self.assertEqual(set(['https://example.com']),
+                         resolver.get_facets(APP_ID))
+
+    def test_refresh_backoff(self):
+        clock = Clock()
+        resolver = TrustedFacetsResolver(Fetcher(), ttl=10, stale_ttl=1000,
+                                         clock=clock, retry_interval=5)
+        facets = resolver.get_facets(APP_ID)
+        fetcher = resolver._fetcher = FailingFetcher()
+
+        clock.now += 15
+        self.assertIs(facets, resolver.get_facets(APP_ID))
+        self.assertTrue(fetcher.event.wait(5))
+        entry = resolver._entries.get(APP_ID)
+        while entry.refreshing:
+            threading.Event().wait(0.01)
+        self.assertEqual(clock.now + 5, entry.retry_at)
+
+        # No new refresh is started until retry_at.
+        resolver.get_facets(APP_ID)
+        clock.now += 4
+        resolver.get_facets(APP_ID)
+        self.assertEqual(1, len(fetcher.urls))
+
+        fetcher.event.clear()
+        clock.now += 1
+        resolver.get_facets(APP_ID)
+        self.assertTrue(fetcher.event.wait(5))
+        while entry.refreshing:
+            threading.Event().wait(0.01)
+        self.assertEqual(2, len(fetcher.urls))
+        self.assertEqual(clock.now + 10, entry.retry_at)
+
+    def test_expired(self):
+        clock = Clock()
+        fetcher = Fetcher()
+        resolver = TrustedFacetsResolver(fetcher, ttl=10, stale_ttl=10,
+                                         clock=clock)
+        resolver.prefetch([APP_ID])
+        clock.now += 25
+        resolver.get_facets(APP_ID)
+        self.assertEqual([APP_ID, APP_ID], fetcher.urls)
+
+    def test_failure_cached(self):
+        clock = Clock()
+        fetcher = FailingFetcher()
+        resolver = TrustedFacetsResolver(fetcher, clock=clock,
+                                         retry_interval=5)
+        for _ in range(3):
+            self.assertRaises(ValueError, resolver.get_facets, APP_ID)
+        self.assertEqual(1, len(fetcher.urls))
+
+        clock.now += 5
+        self.assertRaises(ValueError, resolver.get_facets, APP_ID)
+        self.assertEqual(2, len(fetcher.urls))
+
+        resolver._fetcher = Fetcher()
+        clock.now += 9
+        self.assertRaises(ValueError, resolver.get_facets, APP_ID)
+        clock.now += 1
+        self.assertIn('https://login.example.com',
+                      resolver.get_facets(APP_ID))
+
+    def test_non_blocking(self):
+        fetcher = Fetcher()
+        resolver = TrustedFacetsResolver(fetcher, blocking=False)
+        entries = resolver._entries
+        self.assertRaises(ValueError, resolver.get_facets, APP_ID)
+        self.assertTrue(fetcher.event.wait(5))
+        while not isinstance(entries.get(APP_ID).facets, FacetSet):
+            threading.Event().wait(0.01)
+        self.assertIn('https://login.example.com',
+                      resolver.get_facets(APP_ID))
+        self.assertEqual(1, len(fetcher.urls))
+
+    def test_check_unavailable(self):
+        resolver = TrustedFacetsResolver(FailingFetcher())
+        token = SoftU2FDevice()
+        request = begin_registration(APP_ID)
+        data = request.data_for_client
+        response = token.register('https://login.example.com', data['appId'],
+                                  data['registerRequests'][0])
+        result = check_registration(request, response, resolver)
+        self.assertEqual(ErrorCode.FACETS_UNAVAILABLE, result.code)
+        self.assertIn(APP_ID, result.message)
+
+    def test_complete_with_resolver(self):
+        resolver = TrustedFacetsResolver(Fetcher())
+        token = SoftU2FDevice()
+        request = begin_registration(APP_ID)
+        data = request.data_for_client
+        response = token.register('https://login.example.com', data['appId'],
+                                  data['registerRequests'][0])
+        complete_registration(request, response, resolver)
+
+        response = token.register('https://evil.example.com', data['appId'],
+                                  data['registerRequests'][0])
+        self.assertRaises(ValueError, complete_registration, request,
+                          response, resolver)
@@ -0,0 +1,127 @@
+from u2flib_server import instrumentation
+from u2flib_server.instrumentation import HistogramCollector, Collector
+from u2flib_server.u2f import (begin_registration, complete_registration,
+                               begin_authentication, complete_authentication)
+from u2flib_server.attestation import create_resolver, MetadataProvider
+from .soft_u2f_v2 import SoftU2FDevice
+import unittest
+
+APP_ID = 'http://www.example.com/appid'
+FACET = 'http://www.example.com'
+
+
+class RecordingCollector(Collector):
+
+    def __init__(self):
+        self.observations = []
+
+    def observe(self, operation, stage, seconds, outcome):
+        self.observations.append((operation, stage, outcome))
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collector = RecordingCollector()
+        instrumentation.set_collector(self.collector)
+
+    def tearDown(self):
+        instrumentation.set_collector(None)
+
+    def _register(self):
+        token = SoftU2FDevice()
+        request = begin_registration(APP_ID)
+        data = request.data_for_client
+        response = token.register(FACET, data['appId'],
+                                  data['registerRequests'][0])
+        device, cert = complete_registration(request, response, [FACET])
+        return device, cert, token
+
+    def test_disabled(self):
+        instrumentation.set_collector(None)
+        self._register()
+        self.assertEqual([], self.collector.observations)
+
+    def test_base_collector(self):
+        instrumentation.set_collector(Collector())
+        self._register()
+
+    def test_register_stages(self):
+        self._register()
+        self.assertEqual([
+            ('register', 'parse', 'ok'),
+            ('register', 'client_data', 'ok'),
+            ('register', 'decode', 'ok'),
+            ('register', 'public_key', 'ok'),
+            ('register', 'verify', 'ok'),
+            ('register', 'transports', 'ok'),
+            ('register', 'total', 'ok'),
+        ], self.collector.observations)
+
+    def test_sign_stages(self):
+        device, cert, token = self._register()
+        del self.collector.observations[:]
+
+        request = begin_authentication(APP_ID, [device])
+        data = request.data_for_client
+        response = token.getAssertion(FACET, data['appId'], data['challenge'],
+                                      data['registeredKeys'][0])
+        complete_authentication(request, response, [FACET])
+        stages = [s for (op, s, outcome) in self.collector.observations]
+        self.assertEqual(['parse', 'client_data', 'decode', 'public_key',
+                          'verify', 'total'], stages)
+
+    def test_error_outcome(self):
+        token = SoftU2FDevice()
+        request = begin_registration(APP_ID)
+        data = request.data_for_client
+        response = token.register('http://wrong.example.com', data['appId'],
+                                  data['registerRequests'][0])
+        self.assertRaises(ValueError, complete_registration, request,
+                          response, [FACET])
+        self.assertEqual([
+            ('register', 'parse', 'error'),
+            ('register', 'client_data', 'error'),
+            ('register', 'total', 'error'),
+        ], self.collector.observations)
+
+    def test_attestation_outcome(self):
+        device, cert, token = self._register()
+        del self.collector.observations[:]
+
+        provider = MetadataProvider(create_resolver())
+        provider.get_attestation(cert)
+        outcomes = set((op, outcome) for (op, s, outcome)
+                       in self.collector.observations)
+        self.assertEqual(set([('resolve', 'untrusted'),
+                              ('get_attestation', 'untrusted')]), outcomes)
+
+
+class HistogramCollectorTest(unittest.TestCase):
+
+    def test_observe(self):
+        collector = HistogramCollector(buckets=(0.1, 1.0))
+        collector.observe('sign', 'verify', 0.05, 'ok')
+        collector.observe('sign', 'verify', 0.5, 'ok')
+        collector.observe('sign', 'verify', 5.0, 'ok')
+        buckets, total, count = collector.get('sign', 'verify')
+        self.assertEqual([1, 2, 3], buckets)
+        self.assertAlmostEqual(5.55, total)
+        self.assertEqual(3, count)
+        self.assertIsNone(collector.get('sign', 'verify', 'error'))
+
+    def test_exposition(self):
+        collector = HistogramCollector(buckets=(0.1,), name='test_seconds')
+        collector.observe('sign', 'verify', 0.05, 'ok')
+        self.assertEqual(
+            '# TYPE test_seconds histogram\n'
+            'test_seconds_bucket{operation="sign",stage="verify",'
+            'outcome="ok",le="0.1"} 1\n'
+            'test_seconds_bucket{operation="sign",stage="verify",'
+            'outcome="ok",le="+Inf"} 1\n'
+            'test_seconds_sum{operation="sign",stage="verify",'
+            'outcome="ok"} 0.05\n'
+            'test_seconds_count{operation="sign",stage="verify",'
+            'outcome="ok"} 1\n',
+            collector.exposition()
+        )
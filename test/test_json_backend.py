@@ -0,0 +1,41 @@
+from u2flib_server import json_backend
+from u2flib_server.model import JSONDict
+import os
+import unittest
+
+
+class JSONBackendTest(unittest.TestCase):
+
+    def setUp(self):
+        self._backend = json_backend.get_backend()
+
+    def tearDown(self):
+        json_backend.set_backend(self._backend)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, json_backend.set_backend, 'foo')
+
+    def test_unknown_env_backend(self):
+        os.environ[json_backend.ENV_VAR] = 'foo'
+        try:
+            json_backend._select_default()
+        finally:
+            del os.environ[json_backend.ENV_VAR]
+        self.assertEqual('json', json_backend.get_backend().name)
+
+    def test_available(self):
+        self.assertIn('json', json_backend.available_backends())
+
+    def test_all_backends(self):
+        for name in json_backend.available_backends():
+            json_backend.set_backend(name)
+            self.assertEqual(name, json_backend.get_backend().name)
+            self.assertEqual({'a': 1}, JSONDict(b'{"a": 1}'))
+            self.assertEqual({'a': 1}, JSONDict(u'{"a": 1}'))
+            self.assertEqual('{"a": 1}', JSONDict(a=1).json)
+            self.assertRaises(ValueError, JSONDict, b'{"a":')
+
+    def test_encode(self):
+        for name in json_backend.available_backends():
+            json_backend.set_backend(name, encode=True)
+            self.assertEqual({'a': 1}, json_backend.loads(JSONDict(a=1).json))
@@ -1,8 +1,18 @@
-from u2flib_server.utils import websafe_decode
+from u2flib_server.utils import websafe_decode, websafe_encode, sha_256
 from u2flib_server.model import (JSONDict, RegistrationData, SignatureData,
-                                 U2fRegisterRequest, U2fSignRequest)
+                                 U2fRegisterRequest, U2fSignRequest,
+                                 Transport, Transports, Type,
+                                 ClientDataValidator, RegisteredKeyList,
+                                 PreparedKey)
+from u2flib_server.certs import _decode_transports
+from u2flib_server.facets import FacetSet
+from u2flib_server import certs, model
+from cryptography.hazmat.primitives.serialization import (Encoding,
+                                                          PublicFormat)
 from binascii import b2a_hex
+import json
 import unittest
+import six
 
 
 SAMPLE_REG_DATA = websafe_decode(
@@ -63,6 +73,87 @@ class SignatureDataTest(unittest.TestCase):
         self.assertEqual(SAMPLE_SIG_DATA, rawresponse.bytes)
 
 
+class TransportsTest(unittest.TestCase):
+    def test_iter(self):
+        self.assertEqual([], list(Transports(0)))
+        self.assertEqual([Transport.USB, Transport.NFC],
+                         list(Transports(0x0c)))
+        self.assertEqual([Transport.BT], list(Transports(0x101)))
+
+    def test_from_list(self):
+        self.assertEqual(0x0c, Transports.from_list([Transport.USB, 'nfc']))
+        self.assertEqual(0x02, Transports.from_list(2))
+
+    def test_operators(self):
+        mask = Transports(Transport.USB) | Transport.NFC
+        self.assertIsInstance(mask, Transports)
+        self.assertTrue(Transport.NFC in mask)
+        self.assertFalse(Transport.BLE in mask)
+        self.assertEqual(['usb', 'nfc'], mask.keys)
+        self.assertEqual(2, len(mask))
+
+    def test_decode_bitstring(self):
+        self.assertEqual(0x0c, _decode_transports(b'\x03\x02\x04\x30'))
+        self.assertEqual(0x01, _decode_transports(b'\x03\x02\x07\xff'))
+        self.assertEqual(0x102, _decode_transports(b'\x03\x03\x07\x40\x80'))
+
+    def test_ext_oid_alias(self):
+        self.assertEqual(certs.TRANSPORTS_EXT_OID, model.TRANSPORTS_EXT_OID)
+
+
+class ClientDataValidatorTest(unittest.TestCase):
+    raw = (b'{"typ": "navigator.id.getAssertion", "challenge": "AAEC", '
+           b'"origin": "https://example.com"}')
+
+    def test_validate(self):
+        validator = ClientDataValidator(Type.SIGN, b'\0\1\2',
+                                        ['https://example.com'])
+        param, data = validator.validate(websafe_encode(self.raw))
+        self.assertEqual(sha_256(self.raw), param)
+        self.assertEqual('https://example.com', data.origin)
+        self.assertEqual(Type.SIGN, data.typ)
+
+    def test_padded_challenge(self):
+        validator = ClientDataValidator(Type.SIGN, 'AAEC==')
+        validator.validate(websafe_encode(self.raw))
+
+    def test_invalid(self):
+        encoded = websafe_encode(self.raw)
+        self.assertRaisesRegex(
+            ValueError, 'type',
+            ClientDataValidator(Type.REGISTER, 'AAEC').validate, encoded)
+        self.assertRaisesRegex(
+            ValueError, 'challenge',
+            ClientDataValidator(Type.SIGN, 'AAED').validate, encoded)
+        self.assertRaisesRegex(
+            ValueError, 'facet',
+            ClientDataValidator(Type.SIGN, 'AAEC', []).validate, encoded)
+        self.assertRaises(
+            ValueError,
+            ClientDataValidator(Type.SIGN, 'AAEC').validate,
+            websafe_encode(b'[]'))
+
+    def test_non_string_origin(self):
+        raw = (b'{"typ": "navigator.id.getAssertion", "challenge": "AAEC", '
+               b'"origin": ["https://example.com"]}')
+        validator = ClientDataValidator(Type.SIGN, 'AAEC',
+                                        ['https://example.com'])
+        self.assertRaisesRegex(ValueError, 'facet', validator.validate,
+                               websafe_encode(raw))
+
+    def test_facets(self):
+        validator = ClientDataValidator(Type.SIGN, 'AAEC',
+                                        'https://example.com')
+        self.assertEqual(frozenset(['https://example.com']),
+                         validator.valid_facets)
+        other = ClientDataValidator(Type.SIGN, 'AAED',
+                                    ['https://example.com'])
+        self.assertEqual(validator.valid_facets, other.valid_facets)
+        facets = FacetSet(['https://example.com'])
+        self.assertIs(facets, ClientDataValidator(Type.SIGN, 'AAEC',
+                                                  facets).valid_facets)
+
+
 class JSONDictTest(unittest.TestCase):
     def test_create(self):
         self.assertEqual({}, JSONDict())
@@ -144,6 +235,57 @@ class U2fRegisterRequestTest(unittest.TestCase):
         self.assertEqual(reg_req.version, 'U2F_V2')
 
 
+class RegisteredKeyListTest(unittest.TestCase):
+    keys = [{
+        'version': 'U2F_V2',
+        'keyHandle': 'BIarIKfyMqyf4bEI6tOqGInAfHrrQkMA2eyPJlNnInbAG1tXNpdRs'
+        '48ef92_b1-mfN4VhaTWxo1SGoxT6CIanw',
+        'publicKey': 'BBCcnAOknoMgokEGuTdfpNLQ-uylwlKp_xbEW8urjJsXKv9XZSL-V'
+        '8C2nwcPEckav1mKZFr5K96uAoLtuxOUf-E',
+        'appId': 'https://example.com',
+        'transports': ['usb']
+    }]
+
+    def test_sign_request(self):
+        key_list = RegisteredKeyList(self.keys)
+        req = U2fSignRequest.create('https://example.com', key_list)
+        self.assertIs(key_list, req.key_list)
+        self.assertEqual(self.keys, req['registeredKeys'])
+        self.assertEqual(req.data_for_client,
+                         json.loads(req.data_for_client_json))
+        self.assertNotIn('publicKey', req.data_for_client_json)
+
+        req = U2fSignRequest.create('https://example.com', self.keys)
+        self.assertEqual(req.data_for_client,
+                         json.loads(req.data_for_client_json))
+
+    def test_register_request(self):
+        key_list = RegisteredKeyList(self.keys)
+        req = U2fRegisterRequest.create('https://example.com/"', key_list)
+        self.assertEqual(req.data_for_client,
+                         json.loads(req.data_for_client_json))
+
+    def test_escaped(self):
+        key_list = RegisteredKeyList(self.keys)
+        data = json.loads(key_list.sign_data_json('a', 'b"c'))
+        self.assertEqual('b"c', data['challenge'])
+        data = json.loads(key_list.register_data_json('a', 'b\\', 'V"'))
+        self.assertEqual({'version': 'V"', 'challenge': 'b\\'},
+                         data['registerRequests'][0])
+
+    def test_data_for_client_copied(self):
+        key_list = RegisteredKeyList(self.keys)
+        req = U2fSignRequest.create('https://example.com', key_list)
+        data = req.data_for_client['registeredKeys'][0]
+        data['keyHandle'] = 'modified'
+        data['transports'].append('nfc')
+        self.assertEqual(self.keys[0]['keyHandle'],
+                         req.data_for_client['registeredKeys'][0]['keyHandle'])
+        self.assertEqual(['usb'], key_list.key_data[0]['transports'])
+        self.assertEqual(req.data_for_client,
+                         json.loads(req.data_for_client_json))
+
+
 class U2fSignRequestTest(unittest.TestCase):
     def test_missing_keys(self):
         self.assertRaises(ValueError, U2fSignRequest.wrap, {
@@ -173,3 +315,33 @@ class U2fSignRequestTest(unittest.TestCase):
             websafe_decode('EAaArVRs5qV39C9S3zO0z9ynVoWeZkuNfeMpsVDQnOk')
         )
         self.assertEqual(req.challenge, websafe_decode(challenge))
+
+
+class PreparedKeyTest(unittest.TestCase):
+
+    def test_prepared_key(self):
+        registration = {
+            "publicKey": "BBCcnAOknoMgokEGuTdfpNLQ-uylwlKp_xbEW8urjJsXKv9XZSL-"
+            "V8C2nwcPEckav1mKZFr5K96uAoLtuxOUf-E",
+            "version": "U2F_V2",
+            "keyHandle": "BIarIKfyMqyf4bEI6tOqGInAfHrrQkMA2eyPJlNnInbAG1tXNpd"
+            "Rs48ef92_b1-mfN4VhaTWxo1SGoxT6CIanw",
+            "transports": ["usb", "nfc"]
+        }
+        self.assertRaises(ValueError, PreparedKey, registration)
+        key = PreparedKey(registration, 'https://example.com')
+        self.assertEqual(websafe_decode(registration['keyHandle']),
+                         key.key_handle)
+        self.assertEqual(
+            websafe_decode('EAaArVRs5qV39C9S3zO0z9ynVoWeZkuNfeMpsVDQnOk'),
+            key.app_param)
+        self.assertEqual(Transport.USB | Transport.NFC, key.transports)
+        self.assertEqual(65, len(key.public_key.public_bytes(
+            Encoding.X962, PublicFormat.UncompressedPoint)))
+        self.assertTrue(key.matches(registration, key.app_param))
+        self.assertFalse(key.matches(registration, sha_256(b'other')))
+
+
+if six.PY2:
+    ClientDataValidatorTest.assertRaisesRegex = \
+        ClientDataValidatorTest.assertRaisesRegexp
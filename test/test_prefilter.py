@@ -0,0 +1,127 @@
+from u2flib_server.attestation.prefilter import IssuerFilter, _names
+from u2flib_server.attestation.resolvers import create_resolver
+from u2flib_server.attestation.data import YUBICO
+from u2flib_server.certs import CertificateInfo
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+from datetime import datetime, timedelta
+from .test_attestation import (ATTESTATION_CERT,
+                               ATTESTATION_CERT_WITH_TRANSPORT, make_cert)
+import os
+import shutil
+import tempfile
+import unittest
+
+
+YUBICO_ROOT = x509.load_pem_x509_certificate(
+    YUBICO['trustedCertificates'][0].encode('ascii'), default_backend())
+
+
+def make_leaf_with_aki(issuer_name, issuer_key):
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    now = datetime.utcnow()
+    return x509.CertificateBuilder() \
+        .subject_name(x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, u'Device')])) \
+        .issuer_name(x509.Name([
+            x509.NameAttribute(NameOID.COMMON_NAME, issuer_name)])) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now - timedelta(days=1)) \
+        .not_valid_after(now + timedelta(days=1)) \
+        .add_extension(x509.AuthorityKeyIdentifier.from_issuer_public_key(
+            issuer_key.public_key()), critical=False) \
+        .sign(issuer_key, hashes.SHA256(), default_backend())
+
+
+class IssuerFilterTest(unittest.TestCase):
+
+    def test_names(self):
+        info = CertificateInfo(ATTESTATION_CERT)
+        issuer, subject = _names(info.der)
+        backend = default_backend()
+        self.assertEqual(info.certificate.issuer.public_bytes(backend),
+                         issuer)
+        self.assertEqual(info.certificate.subject.public_bytes(backend),
+                         subject)
+
+    def test_issuer_name(self):
+        prefilter = IssuerFilter.build([YUBICO_ROOT])
+        self.assertTrue(prefilter.might_contain(
+            CertificateInfo(ATTESTATION_CERT)))
+        self.assertFalse(prefilter.might_contain(
+            CertificateInfo(ATTESTATION_CERT_WITH_TRANSPORT)))
+
+    def test_key_identifier(self):
+        root, key = make_cert(u'Root')
+        root = x509.CertificateBuilder() \
+            .subject_name(root.subject).issuer_name(root.issuer) \
+            .public_key(key.public_key()) \
+            .serial_number(root.serial_number) \
+            .not_valid_before(root.not_valid_before) \
+            .not_valid_after(root.not_valid_after) \
+            .add_extension(x509.SubjectKeyIdentifier.from_public_key(
+                key.public_key()), critical=False) \
+            .sign(key, hashes.SHA256(), default_backend())
+        prefilter = IssuerFilter.build([root.public_bytes(Encoding.DER)])
+        leaf = make_leaf_with_aki(u'Renamed Root', key)
+        self.assertTrue(prefilter.might_contain(CertificateInfo(
+            leaf.public_bytes(Encoding.DER), leaf)))
+        leaf = make_leaf_with_aki(u'Renamed Root', make_cert(u'Other')[1])
+        self.assertFalse(prefilter.might_contain(CertificateInfo(
+            leaf.public_bytes(Encoding.DER), leaf)))
+
+    def test_snapshot(self):
+        prefilter = IssuerFilter.build([YUBICO_ROOT])
+        data = prefilter.to_bytes()
+        loaded = IssuerFilter.from_bytes(data)
+        self.assertEqual(prefilter.bits, loaded.bits)
+        self.assertEqual(prefilter.n_hashes, loaded.n_hashes)
+        self.assertEqual(IssuerFilter.trust_digest([YUBICO_ROOT]),
+                         loaded.digest)
+        self.assertRaises(ValueError, IssuerFilter.from_bytes, data[:-1])
+        self.assertRaises(ValueError, IssuerFilter.from_bytes, b'foo')
+
+
+class ResolverPrefilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.tmpdir, 'issuers.bin')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_prefilter(self):
+        resolver = create_resolver([])
+        resolver.enable_prefilter()
+        self.assertIsNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertEqual(0, len(resolver._untrusted))
+        resolver.add_metadata(YUBICO)
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
+
+    def test_snapshot(self):
+        resolver = create_resolver()
+        resolver.enable_prefilter(self.snapshot)
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
+        self.assertTrue(os.path.isfile(self.snapshot))
+        with open(self.snapshot, 'rb') as f:
+            data = f.read()
+
+        # Another process with the same metadata uses the snapshot
+        other = create_resolver()
+        other.enable_prefilter(self.snapshot)
+        other.resolve(ATTESTATION_CERT)
+        self.assertEqual(data, other._prefilter[1].to_bytes())
+
+        # A stale snapshot is replaced
+        empty = create_resolver([])
+        empty.enable_prefilter(self.snapshot)
+        self.assertIsNone(empty.resolve(ATTESTATION_CERT))
+        with open(self.snapshot, 'rb') as f:
+            self.assertNotEqual(data, f.read())
+        self.assertIsNotNone(resolver.resolve(ATTESTATION_CERT))
@@ -0,0 +1,149 @@
+from u2flib_server.counters import MemoryCounterStore
+from u2flib_server.model import SignResponse, ErrorCode
+from u2flib_server.replay import ReplayCache
+from u2flib_server.u2f import (begin_authentication, complete_authentication,
+                               check_authentication)
+from u2flib_server.utils import sha_256
+from .test_u2f import register_token, APP_ID, FACET
+import unittest
+
+
+class ReplayCacheTest(unittest.TestCase):
+
+    def test_lookup(self):
+        cache = ReplayCache(policy=ReplayCache.RETURN)
+        self.assertIsNone(cache.lookup(b'a'))
+        cache.add(b'a', 'result')
+        self.assertEqual('result', cache.lookup(b'a'))
+
+    def test_reject(self):
+        cache = ReplayCache()
+        self.assertIsNone(cache.lookup(b'a'))
+        cache.add(b'a', True)
+        self.assertRaises(ValueError, cache.lookup, b'a')
+
+    def test_claim(self):
+        cache = ReplayCache(policy=ReplayCache.RETURN)
+        self.assertIsNone(cache.claim(b'a'))
+        self.assertIs(ReplayCache.PENDING, cache.claim(b'a'))
+        self.assertIsNone(cache.lookup(b'a'))
+        cache.release(b'a')
+        self.assertIsNone(cache.claim(b'a'))
+        cache.add(b'a', 'result')
+        self.assertEqual('result', cache.claim(b'a'))
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, ReplayCache, policy='ignore')
+
+    def test_ttl(self):
+        now = [0]
+        cache = ReplayCache(ttl=10, clock=lambda: now[0],
+                            policy=ReplayCache.RETURN)
+        cache.add(b'a', True)
+        now[0] = 5
+        cache.add(b'b', True)
+        self.assertTrue(cache.lookup(b'a'))
+        now[0] = 10
+        self.assertIsNone(cache.lookup(b'a'))
+        self.assertTrue(cache.lookup(b'b'))
+        cache.add(b'c', True)
+        self.assertEqual(2, len(cache))
+
+    def test_maxsize(self):
+        cache = ReplayCache(maxsize=2, policy=ReplayCache.RETURN)
+        for key in (b'a', b'b', b'c'):
+            cache.add(key, True)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.lookup(b'a'))
+        self.assertTrue(cache.lookup(b'c'))
+
+    def test_key(self):
+        self.assertNotEqual(
+            ReplayCache.key(b'a' * 32, b'b' * 32, b'kh', b'sig'),
+            ReplayCache.key(b'a' * 32, b'b' * 32, b'khs', b'ig'))
+
+
+class ReplayedResponseTest(unittest.TestCase):
+
+    def setUp(self):
+        self.device, token = register_token()
+        self.request = begin_authentication(APP_ID, [self.device])
+        data = self.request.data_for_client
+        self.response = token.getAssertion(FACET, data['appId'],
+                                           data['challenge'],
+                                           data['registeredKeys'][0])
+
+    def test_reject_replay(self):
+        cache = ReplayCache()
+        complete_authentication(self.request, self.response,
+                                replay_cache=cache)
+        self.assertRaisesRegex(ValueError, 'Replayed',
+                               complete_authentication, self.request,
+                               self.response, replay_cache=cache)
+        check = check_authentication(self.request, self.response,
+                                     replay_cache=cache)
+        self.assertEqual(ErrorCode.REPLAYED, check.code)
+
+    def test_return_policy_checks_counter(self):
+        cache = ReplayCache(policy=ReplayCache.RETURN)
+        store = MemoryCounterStore()
+        complete_authentication(self.request, self.response,
+                                counter_store=store, replay_cache=cache)
+        result = check_authentication(self.request, self.response,
+                                      counter_store=store, replay_cache=cache)
+        self.assertEqual(ErrorCode.COUNTER_NOT_INCREASED, result.code)
+
+    def test_return_prior_result(self):
+        cache = ReplayCache(policy=ReplayCache.RETURN)
+        result = complete_authentication(self.request, self.response,
+                                         replay_cache=cache)
+        self.assertEqual(result, complete_authentication(
+            self.request, self.response, replay_cache=cache))
+
+    def test_concurrent_submission(self):
+        cache = ReplayCache(policy=ReplayCache.RETURN)
+        results = []
+        test = self
+
+        class ResubmittingStore(MemoryCounterStore):
+            # Submits the response again while it is still being verified.
+            def check_and_set(self, key_handle, counter):
+                if not results:
+                    results.append(check_authentication(
+                        test.request, test.response, counter_store=self,
+                        replay_cache=cache))
+                return super(ResubmittingStore, self).check_and_set(
+                    key_handle, counter)
+
+        store = ResubmittingStore()
+        self.assertTrue(check_authentication(
+            self.request, self.response, counter_store=store,
+            replay_cache=cache))
+        self.assertEqual(ErrorCode.REPLAYED, results[0].code)
+
+    def test_sign_response_pending(self):
+        cache = ReplayCache()
+        app_param = sha_256(APP_ID.encode('idna'))
+        response = SignResponse.wrap(self.response)
+        cache.claim(cache.key(app_param, response.challengeParameter,
+                              response.keyHandle,
+                              response.signatureData.bytes))
+        self.assertRaises(ValueError, response.verify, app_param,
+                          self.device.publicKey, cache)
+
+    def test_invalid_not_cached(self):
+        cache = ReplayCache()
+        response = SignResponse.wrap(self.response.json)
+        response['signatureData'] = response['signatureData'][:-4] + 'AAAA'
+        for _ in range(2):
+            self.assertRaises(ValueError, complete_authentication,
+                              self.request, response, replay_cache=cache)
+        self.assertEqual(0, len(cache))
+
+    def test_sign_response_verify(self):
+        cache = ReplayCache(policy=ReplayCache.REJECT)
+        app_param = sha_256(APP_ID.encode('idna'))
+        response = SignResponse.wrap(self.response)
+        response.verify(app_param, self.device.publicKey, cache)
+        self.assertRaises(ValueError, response.verify, app_param,
+                          self.device.publicKey, cache)
@@ -0,0 +1,64 @@
+from u2flib_server.attestation.report import create_report, numpy
+from u2flib_server.attestation.metadata import MetadataProvider
+from u2flib_server.attestation.resolvers import create_resolver
+from u2flib_server.model import Transport
+from u2flib_server import certs
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from .test_attestation import (ATTESTATION_CERT,
+                               ATTESTATION_CERT_WITH_TRANSPORT,
+                               ATTESTATION_CERT_WITH_KEY_VALUE_IDENTIFIER)
+import unittest
+
+
+@unittest.skipIf(numpy is None, 'NumPy is not installed')
+class AttestationReportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.provider = MetadataProvider(create_resolver())
+        calls = []
+        get_attestation = self.provider.get_attestation
+
+        def counting_get_attestation(cert):
+            calls.append(cert)
+            return get_attestation(cert)
+        self.provider.get_attestation = counting_get_attestation
+        self.calls = calls
+
+    def test_report(self):
+        parsed = x509.load_der_x509_certificate(ATTESTATION_CERT,
+                                                default_backend())
+        certs = [ATTESTATION_CERT, ATTESTATION_CERT_WITH_TRANSPORT, parsed,
+                 ATTESTATION_CERT_WITH_KEY_VALUE_IDENTIFIER, ATTESTATION_CERT]
+        report = create_report(iter(certs), self.provider)
+
+        self.assertEqual(3, len(self.calls))
+        self.assertEqual(5, len(report))
+        self.assertEqual([0, 1, 0, 2, 0], list(report.rows))
+        self.assertEqual([3, 1, 1], list(report.counts))
+        self.assertEqual([True, False, True], list(report.trusted))
+        usb_nfc = Transport.USB | Transport.NFC
+        self.assertEqual([Transport.USB, usb_nfc, usb_nfc],
+                         list(report.transports))
+
+        self.assertEqual({'1.3.6.1.4.1.41482.1.2': 4, None: 1},
+                         report.count_by_device())
+        self.assertEqual({'Yubico': 4, None: 1}, report.count_by_vendor())
+        by_transport = report.count_by_transport()
+        self.assertEqual(5, by_transport[Transport.USB])
+        self.assertEqual(2, by_transport[Transport.NFC])
+        self.assertEqual(0, by_transport[Transport.BLE])
+        self.assertEqual({Transport.USB: 3, usb_nfc: 2},
+                         report.count_by_transports())
+
+    def test_shared_cache_untouched(self):
+        certs.DEFAULT_CACHE.clear()
+        create_report([ATTESTATION_CERT, ATTESTATION_CERT_WITH_TRANSPORT],
+                      self.provider)
+        self.assertEqual(0, len(certs.DEFAULT_CACHE))
+
+    def test_empty(self):
+        report = create_report([], self.provider)
+        self.assertEqual(0, len(report))
+        self.assertEqual({}, report.count_by_device())
+        self.assertEqual({}, report.count_by_transports())
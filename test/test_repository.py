@@ -0,0 +1,107 @@
+from u2flib_server.repository import (MemoryRegistrationRepository,
+                                      SQLiteRegistrationRepository,
+                                      RegistrationRepository)
+from u2flib_server.model import Transport, U2fSignRequest
+from u2flib_server.u2f import begin_authentication, complete_authentication
+from cryptography.hazmat.primitives.asymmetric import ec
+from .test_u2f import register_token, APP_ID, FACET
+import unittest
+
+DEVICE = {
+    'version': 'U2F_V2',
+    'publicKey': 'BBCcnAOknoMgokEGuTdfpNLQ-uylwlKp_xbEW8urjJsXKv9XZSL-V'
+    '8C2nwcPEckav1mKZFr5K96uAoLtuxOUf-E',
+    'keyHandle': 'BIarIKfyMqyf4bEI6tOqGInAfHrrQkMA2eyPJlNnInbAG1tXNpdRs'
+    '48ef92_b1-mfN4VhaTWxo1SGoxT6CIanw',
+    'appId': 'http://www.example.com/appid',
+    'transports': ['usb', 'nfc']
+}
+
+
+class RegistrationRepositoryTests(object):
+
+    def test_add_get(self):
+        repo = self.create_repository()
+        repo.add('alice', DEVICE)
+        stored = repo.get(DEVICE['keyHandle'])
+        self.assertEqual('alice', stored.user)
+        self.assertEqual(65, len(stored.public_key))
+        self.assertEqual([Transport.USB, Transport.NFC],
+                         list(stored.transports))
+        self.assertEqual(DEVICE, stored.registration)
+        self.assertIsInstance(stored.key, ec.EllipticCurvePublicKey)
+        self.assertIsNone(repo.get(b'unknown'))
+
+    def test_for_user(self):
+        repo = self.create_repository()
+        device1, token1 = register_token()
+        device2, token2 = register_token()
+        repo.add('alice', device1)
+        repo.add('alice', device2)
+        self.assertEqual([device1, device2],
+                         repo.registrations_for_user('alice'))
+        self.assertEqual([], repo.for_user('bob'))
+
+        self.assertTrue(repo.remove(device1['keyHandle']))
+        self.assertFalse(repo.remove(device1['keyHandle']))
+        self.assertEqual([device2], repo.registrations_for_user('alice'))
+
+    def test_authenticate_from_key_handle(self):
+        repo = self.create_repository()
+        device, token = register_token()
+        repo.add('alice', device)
+
+        stored = repo.get(device['keyHandle'])
+        request = begin_authentication(APP_ID, [stored.registration])
+        data = request.data_for_client
+        response = token.getAssertion(FACET, data['appId'], data['challenge'],
+                                      data['registeredKeys'][0])
+        result, counter, touch = complete_authentication(request, response)
+        self.assertEqual(device, result)
+
+    def test_prepared_keys(self):
+        repo = self.create_repository()
+        device, token = register_token()
+        repo.add('alice', device)
+
+        request = begin_authentication(APP_ID,
+                                       repo.registrations_for_user('alice'))
+        data = request.data_for_client
+        response = token.getAssertion(FACET, data['appId'], data['challenge'],
+                                      data['registeredKeys'][0])
+        prepared = repo.prepared_keys('alice', APP_ID)
+        stored = repo.get(device['keyHandle'])
+        self.assertIs(stored.key, stored.prepared_key(APP_ID).public_key)
+
+        request = U2fSignRequest.wrap(request.json)
+        result, counter, touch = complete_authentication(
+            request, response, prepared_keys=prepared)
+        self.assertEqual(device, result)
+        self.assertIsNone(request._keys)  # Registered keys weren't decoded.
+
+
+class MemoryRegistrationRepositoryTest(unittest.TestCase,
+                                       RegistrationRepositoryTests):
+
+    def create_repository(self):
+        return MemoryRegistrationRepository()
+
+    def test_registration_built_once(self):
+        repo = self.create_repository()
+        repo.add('alice', DEVICE)
+        self.assertIs(repo.registrations_for_user('alice')[0],
+                      repo.registrations_for_user('alice')[0])
+        stored = repo.get(DEVICE['keyHandle'])
+        self.assertIs(stored.prepared_key(), stored.prepared_key())
+        self.assertEqual([stored.prepared_key()],
+                         list(repo.prepared_keys('alice').values()))
+
+    def test_abstract(self):
+        self.assertRaises(TypeError, RegistrationRepository)
+
+
+class SQLiteRegistrationRepositoryTest(unittest.TestCase,
+                                       RegistrationRepositoryTests):
+
+    def create_repository(self):
+        return SQLiteRegistrationRepository()
@@ -1,7 +1,12 @@
 from u2flib_server.u2f import (begin_registration, complete_registration,
-                               begin_authentication, complete_authentication)
+                               complete_registration_batch,
+                               check_registration, begin_authentication,
+                               complete_authentication, check_authentication)
 from u2flib_server.model import (U2fRegisterRequest, U2fSignRequest,
-                                 RegisterResponse)
+                                 RegisterResponse, SignResponse, PreparedKey,
+                                 ErrorCode)
+from u2flib_server.counters import MemoryCounterStore
+from u2flib_server.replay import ReplayCache
 from u2flib_server.utils import websafe_decode, websafe_encode
 from .soft_u2f_v2 import SoftU2FDevice
 import unittest
@@ -204,6 +209,195 @@ class U2fTest(unittest.TestCase):
         self.assertRaisesRegex(ValueError, 'signature', complete_registration,
                                request.json, response)
 
+    def test_authenticate_multiple_app_ids(self):
+        device1, token1 = register_token()
+        token2 = SoftU2FDevice()
+        request = begin_registration('http://www.example.com/other')
+        data = request.data_for_client
+        response = token2.register(FACET, data['appId'],
+                                   data['registerRequests'][0])
+        device2, cert = complete_registration(request, response)
+
+        request = begin_authentication(APP_ID, [device1, device2])
+        self.assertEqual([APP_ID, 'http://www.example.com/other'],
+                         list(request.key_groups))
+        data = request.data_for_client
+        for token, key in zip([token1, token2], data['registeredKeys']):
+            response = token.getAssertion(FACET, key['appId'],
+                                          data['challenge'], key)
+            device, counter, touch = complete_authentication(
+                request.json, response)
+            self.assertEqual(key['keyHandle'], device['keyHandle'])
+
+    def test_register_batch(self):
+        token = SoftU2FDevice()
+        items = []
+        for _ in range(3):
+            request = begin_registration(APP_ID)
+            data = request.data_for_client
+            items.append((request.json, token.register(
+                FACET, data['appId'], data['registerRequests'][0])))
+        items.append((begin_registration(APP_ID).json, items[0][1]))
+
+        results = complete_registration_batch(items, FACETS)
+
+        self.assertEqual(4, len(results))
+        for request, response in items[:3]:
+            expected = complete_registration(request, response, FACETS)
+            self.assertEqual(expected, results.pop(0))
+        self.assertIsInstance(results[0], ValueError)
+        self.assertIn('challenge', str(results[0]))
+
+    def test_authenticate_prepared_key(self):
+        device, token = register_token()
+        other, _ = register_token()
+        prepared = PreparedKey.index([device])
+        self.assertEqual(websafe_decode(device['keyHandle']),
+                         list(prepared)[0])
+
+        request = begin_authentication(APP_ID, [device])
+        data = request.data_for_client
+        response = token.getAssertion(FACET, data['appId'], data['challenge'],
+                                      data['registeredKeys'][0])
+        result = complete_authentication(request, response, FACETS,
+                                         prepared_keys=prepared)
+        # The registered keys were not decoded.
+        self.assertIsNone(request._keys)
+        self.assertEqual(complete_authentication(request, response, FACETS),
+                         result)
+
+        # A prepared key not matching the request is not used.
+        wrong = PreparedKey(dict(device, publicKey=other['publicKey']))
+        self.assertEqual(result, complete_authentication(
+            request, response, FACETS,
+            prepared_keys={wrong.key_handle: wrong}))
+
+
+class CheckTest(unittest.TestCase):
+
+    def register(self, request=None, facet=FACET):
+        token = SoftU2FDevice()
+        data = (request or begin_registration(APP_ID)).data_for_client
+        return token, token.register(facet, data['appId'],
+                                     data['registerRequests'][0])
+
+    def authenticate(self, token, device, facet=FACET):
+        request = begin_authentication(APP_ID, [device])
+        data = request.data_for_client
+        return request, token.getAssertion(facet, data['appId'],
+                                           data['challenge'],
+                                           data['registeredKeys'][0])
+
+    def test_check_registration(self):
+        request = begin_registration(APP_ID)
+        token, response = self.register(request)
+        result = check_registration(request, response, FACETS)
+        self.assertTrue(result)
+        self.assertEqual(ErrorCode.OK, result.code)
+        self.assertIsNone(result.message)
+        self.assertEqual(complete_registration(request, response, FACETS),
+                         result.unwrap())
+
+        result = check_registration(begin_registration(APP_ID), response)
+        self.assertFalse(result)
+        self.assertEqual(ErrorCode.WRONG_CHALLENGE, result.code)
+        self.assertIn('challenge', result.message)
+        self.assertRaisesRegex(ValueError, 'challenge', result.unwrap)
+
+        result = check_registration(request, response,
+                                    ['https://z.example.org',
+                                     'https://example.org'])
+        self.assertEqual(ErrorCode.INVALID_FACET, result.code)
+        self.assertIn("['https://example.org', 'https://z.example.org']",
+                      result.message)
+
+        response = RegisterResponse.wrap(response)
+        response['registrationData'] = websafe_encode(
+            response.registrationData.bytes[:-4] + b'\0\0\0\0')
+        result = check_registration(request, response)
+        self.assertEqual(ErrorCode.INVALID_SIGNATURE, result.code)
+        self.assertEqual('Attestation signature is invalid', result.message)
+
+        result = check_registration(request, '{"clientData": "%%%"}')
+        self.assertEqual(ErrorCode.INVALID_DATA, result.code)
+
+    def test_check_authentication(self):
+        device, token = register_token()
+        request, response = self.authenticate(token, device)
+        result = check_authentication(request, response, FACETS)
+        self.assertTrue(result)
+        device2, counter, touch = result.value
+        self.assertEqual(device['keyHandle'], device2['keyHandle'])
+
+        bad = SignResponse.wrap(response)
+        bad['signatureData'] = bad['signatureData'][:-4] + 'AAAA'
+        result = check_authentication(request, bad, FACETS)
+        self.assertEqual(ErrorCode.INVALID_SIGNATURE, result.code)
+        self.assertEqual('U2F signature is invalid', result.message)
+
+        result = check_authentication(request, dict(bad, signatureData=''))
+        self.assertEqual(ErrorCode.INVALID_DATA, result.code)
+
+        request2, response2 = self.authenticate(token, device,
+                                                'https://example.org')
+        result = check_authentication(request2, response2, FACETS)
+        self.assertEqual(ErrorCode.INVALID_FACET, result.code)
+
+    def test_malformed_certificate(self):
+        request = begin_registration(APP_ID)
+        token, response = self.register(request)
+        response = RegisterResponse.wrap(response)
+        data = response.registrationData
+        offset = 67 + len(data.key_handle)
+        raw = data.bytes
+        response['registrationData'] = websafe_encode(
+            raw[:offset + 4] + b'\0' * 8 + raw[offset + 12:])
+        result = check_registration(request, response, FACETS)
+        self.assertEqual(ErrorCode.INVALID_DATA, result.code)
+        self.assertRaises(ValueError, complete_registration, request,
+                          response, FACETS)
+
+    def test_non_string_origin(self):
+        request = begin_registration(APP_ID)
+        token, response = self.register(request, [FACET])
+        result = check_registration(request, response, FACETS)
+        self.assertEqual(ErrorCode.INVALID_FACET, result.code)
+
+        device, token = register_token()
+        request, response = self.authenticate(token, device, {'a': FACET})
+        result = check_authentication(request, response, FACETS)
+        self.assertEqual(ErrorCode.INVALID_FACET, result.code)
+        self.assertRaises(ValueError, complete_authentication, request,
+                          response, FACETS)
+
+    def test_unknown_key_handle(self):
+        device, token = register_token()
+        other, _ = register_token()
+        request = begin_authentication(APP_ID, [other])
+        data = request.data_for_client
+        response = token.getAssertion(FACET, data['appId'], data['challenge'],
+                                      device)
+        result = check_authentication(request, response)
+        self.assertEqual(ErrorCode.UNKNOWN_KEY_HANDLE, result.code)
+        self.assertIn(device['keyHandle'], result.message)
+        self.assertRaises(ValueError, complete_authentication, request,
+                          response)
+
+    def test_counter_and_replay(self):
+        device, token = register_token()
+        request, response = self.authenticate(token, device)
+        store = MemoryCounterStore()
+        cache = ReplayCache(policy=ReplayCache.REJECT)
+        self.assertTrue(check_authentication(request, response,
+                                             counter_store=store,
+                                             replay_cache=cache))
+        self.assertEqual(ErrorCode.REPLAYED, check_authentication(
+            request, response, counter_store=store,
+            replay_cache=cache).code)
+        self.assertEqual(ErrorCode.COUNTER_NOT_INCREASED, check_authentication(
+            request, response, counter_store=store).code)
+
 
 if six.PY2:
     U2fTest.assertRaisesRegex = U2fTest.assertRaisesRegexp
+    CheckTest.assertRaisesRegex = CheckTest.assertRaisesRegexp
@@ -0,0 +1,36 @@
+from u2flib_server import warmup
+from u2flib_server.attestation import MetadataProvider
+from u2flib_server.attestation.resolvers import get_default_resolver
+from u2flib_server.model import _app_params
+from u2flib_server.u2f import begin_authentication, complete_authentication
+from .test_u2f import register_token, APP_ID, FACET
+import unittest
+
+
+class WarmupTest(unittest.TestCase):
+
+    def test_default_resolver_shared(self):
+        self.assertIs(get_default_resolver(), get_default_resolver())
+        self.assertIs(get_default_resolver(),
+                      MetadataProvider(get_default_resolver())._resolver)
+        # Providers created without a resolver don't share one.
+        self.assertIsNot(get_default_resolver(), MetadataProvider()._resolver)
+
+    def test_app_ids_hashed(self):
+        app_id = 'https://warmup.example.com'
+        warmup([app_id], self_test=False)
+        self.assertIn(app_id, _app_params)
+
+    def test_prepared_keys(self):
+        device, token = register_token()
+        prepared = warmup(registrations=[device])
+        self.assertEqual([device.keyHandle], list(prepared))
+
+        request = begin_authentication(APP_ID, [device])
+        data = request.data_for_client
+        response = token.getAssertion(FACET, data['appId'],
+                                      data['challenge'],
+                                      data['registeredKeys'][0])
+        device_reg, counter, presence = complete_authentication(
+            request, response, [FACET], prepared_keys=prepared)
+        self.assertEqual(device['keyHandle'], device_reg['keyHandle'])
@@ -26,3 +26,72 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 __version__ = "5.0.1"
+
+
+def warmup(app_ids=(), registrations=(), self_test=True):
+    """Prepares a freshly started process for handling requests.
+
+    Meant to be called in each worker of a pre-forking server, e.g. from
+    gunicorn's post_fork hook. Imports the cryptography backend, builds the
+    shared attestation resolver returned by get_default_resolver(), hashes
+    the given appIds, and runs an authentication with a generated key as a
+    self-test, raising RuntimeError if it fails. Pass the shared resolver to
+    MetadataProvider to use it.
+
+    registrations can be given as DeviceRegistrations, which are prepared and
+    returned as a dict of PreparedKeys by key handle, for passing as
+    prepared_keys to complete_authentication.
+    """
+    from u2flib_server.attestation.resolvers import get_default_resolver
+    from u2flib_server.model import _app_param, PreparedKey
+    from cryptography.hazmat.backends import default_backend
+
+    default_backend()
+    get_default_resolver()
+    for app_id in app_ids:
+        _app_param(app_id)
+    prepared = PreparedKey.index(registrations)
+
+    if self_test:
+        _self_test()
+
+    return prepared
+
+
+def _self_test():
+    from u2flib_server.model import U2fSignRequest
+    from u2flib_server.utils import websafe_encode, sha_256
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.hazmat.primitives.serialization import (Encoding,
+                                                              PublicFormat)
+    import json
+    import os
+
+    app_id = 'https://localhost'
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    public_key = key.public_key().public_bytes(
+        Encoding.DER, PublicFormat.SubjectPublicKeyInfo)[-65:]
+    key_handle = os.urandom(32)
+    request = U2fSignRequest.create(app_id, [{
+        'version': 'U2F_V2',
+        'keyHandle': websafe_encode(key_handle),
+        'publicKey': websafe_encode(public_key),
+    }])
+
+    client_data = json.dumps({
+        'typ': 'navigator.id.getAssertion',
+        'challenge': request['challenge'],
+        'origin': app_id
+    }).encode('utf-8')
+    sign_data = b'\x01\x00\x00\x00\x01'
+    signature = key.sign(sha_256(app_id.encode('idna')) + sign_data +
+                         sha_256(client_data), ec.ECDSA(hashes.SHA256()))
+    result = request.check({
+        'keyHandle': websafe_encode(key_handle),
+        'signatureData': websafe_encode(sign_data + signature),
+        'clientData': websafe_encode(client_data)
+    }, [app_id])
+    if not result:
+        raise RuntimeError('Self-test failed: %s' % result.message)
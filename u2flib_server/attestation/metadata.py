@@ -25,12 +25,13 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from u2flib_server.attestation.model import DeviceInfo, Attestation
+from u2flib_server.attestation.model import (DeviceInfo, Attestation,
+                                             CompiledMetadata)
 from u2flib_server.attestation.matchers import DEFAULT_MATCHERS
 from u2flib_server.attestation.resolvers import create_resolver
-from u2flib_server.model import Transport
-from cryptography import x509
-from cryptography.hazmat.backends import default_backend
+from u2flib_server.model import Transports
+from u2flib_server.certs import get_certificate_info
+from u2flib_server import instrumentation
 
 
 __all__ = ['MetadataProvider']
@@ -42,6 +43,7 @@ class MetadataProvider(object):
         if resolver is None:
             resolver = create_resolver()
         self._resolver = resolver
+        self._resolve_compiled = getattr(resolver, 'resolve_compiled', None)
         self._matchers = {}
 
         for matcher in matchers:
@@ -51,27 +53,40 @@ class MetadataProvider(object):
         self._matchers[matcher.selector_type] = matcher
 
     def get_attestation(self, cert):
-        if isinstance(cert, bytes):
-            cert = x509.load_der_x509_certificate(cert, default_backend())
-        metadata = self._resolver.resolve(cert)
-        if metadata is not None:
-            trusted = True
-            vendor_info = metadata.vendorInfo
-            device_info = self._lookup_device(metadata, cert)
-        else:
-            trusted = False
-            vendor_info = None
-            device_info = DeviceInfo()
-        cert_transports = Transport.transports_from_cert(cert)
+        with instrumentation.timer('get_attestation') as timer:
+            timer.stage('load_cert')
+            info = get_certificate_info(cert)
+            cert = info.certificate
+
+            timer.stage('resolve')
+            if self._resolve_compiled is not None:
+                metadata = self._resolve_compiled(info)
+            else:
+                metadata = self._resolver.resolve(cert)
+                if metadata is not None:
+                    metadata = CompiledMetadata(metadata)
+
+            timer.stage('device_lookup')
+            if metadata is not None:
+                trusted = True
+                vendor_info = metadata.vendor_info
+                device_info = self._lookup_device(metadata, cert)
+            else:
+                trusted = False
+                vendor_info = None
+                device_info = DeviceInfo()
+
+            timer.stage('transports')
+            cert_transports = Transports.from_cert(info)
+            timer.set_outcome('trusted' if trusted else 'untrusted')
         return Attestation(trusted, vendor_info, device_info, cert_transports)
 
     def _lookup_device(self, metadata, cert):
         for device in metadata.devices:
-            selectors = device.selectors
-            if selectors is None:
-                return device
-            for selector in selectors:
-                matcher = self._matchers.get(selector.type)
-                if matcher and matcher.matches(cert, selector.parameters):
-                    return device
+            if device.selectors is None:
+                return device.info
+            for selector_type, parameters in device.selectors:
+                matcher = self._matchers.get(selector_type)
+                if matcher and matcher.matches(cert, parameters):
+                    return device.info
         return DeviceInfo()
@@ -26,7 +26,8 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 
-from u2flib_server.model import JSONDict, Transport
+from u2flib_server.model import JSONDict, Transports
+import copy
 
 
 class VendorInfo(JSONDict):
@@ -48,10 +49,15 @@ class DeviceInfo(JSONDict):
 
     @property
     def transports(self):
+        transports = self.transport_mask
+        return list(transports) if transports is not None else None
+
+    @property
+    def transport_mask(self):
         transport_int = self.get('transports')
         if transport_int is None:
             return None
-        return [t for t in Transport if t.value & transport_int]
+        return Transports(transport_int)
 
 
 class MetadataObject(JSONDict):
@@ -65,32 +71,92 @@ class MetadataObject(JSONDict):
         return [DeviceInfo(dev) for dev in self['devices']]
 
 
+class CompiledDevice(object):
+    """A DeviceInfo with its selectors extracted, for matching."""
+    __slots__ = ('info', 'selectors')
+
+    def __init__(self, info):
+        self.info = DeviceInfo.wrap(info)
+        selectors = self.info.get('selectors')
+        if selectors is None:
+            self.selectors = None
+        else:
+            self.selectors = tuple((s.get('type'), s.get('parameters'))
+                                   for s in selectors)
+
+
+class CompiledMetadata(object):
+    """A MetadataObject with its parts wrapped once, up front.
+
+    The original MetadataObject is kept as metadata. The VendorInfo and
+    DeviceInfo objects are shared by all lookups, and shouldn't be modified.
+    Attestations hand out copies of them.
+    """
+    __slots__ = ('metadata', 'identifier', 'version', 'vendor_info',
+                 'devices')
+
+    def __init__(self, metadata):
+        self.metadata = MetadataObject.wrap(metadata)
+        self.identifier = self.metadata.get('identifier')
+        self.version = self.metadata.get('version')
+        vendor_info = self.metadata.get('vendorInfo')
+        self.vendor_info = VendorInfo(vendor_info) \
+            if vendor_info is not None else None
+        self.devices = tuple(CompiledDevice(d)
+                             for d in self.metadata.get('devices', []))
+
+    @classmethod
+    def wrap(cls, metadata):
+        return metadata if isinstance(metadata, cls) else cls(metadata)
+
+
 class Attestation(object):
+    """The result of resolving an attestation certificate.
+
+    vendor_info and device_info may be shared with other attestations, so
+    each is copied the first time it is accessed, and callers can modify
+    the copies.
+    """
+
     def __init__(self, trusted, vendor_info=None, device_info=None,
                  cert_transports=None):
         self._trusted = trusted
         self._vendor_info = vendor_info
         self._device_info = device_info
+        self._copies = {}
 
-        if device_info.transports is None and cert_transports is None:
-            self._transports = None
+        device_transports = device_info.transport_mask
+        if device_transports is None and cert_transports is None:
+            self._transport_mask = None
         else:
-            transports = sum(t.value for t in cert_transports or []) | \
-                sum(t.value for t in device_info.transports or [])
-            self._transports = [t for t in Transport if t.value & transports]
+            self._transport_mask = Transports.from_list(cert_transports or 0) \
+                | (device_transports or 0)
 
     @property
     def trusted(self):
         return self._trusted
 
+    def _copy(self, name, value):
+        if value is None:
+            return None
+        if name not in self._copies:
+            self._copies[name] = copy.deepcopy(value)
+        return self._copies[name]
+
     @property
     def vendor_info(self):
-        return self._vendor_info
+        return self._copy('vendor_info', self._vendor_info)
 
     @property
     def device_info(self):
-        return self._device_info
+        return self._copy('device_info', self._device_info)
 
     @property
     def transports(self):
-        return self._transports
+        if self._transport_mask is None:
+            return None
+        return list(self._transport_mask)
+
+    @property
+    def transport_mask(self):
+        return self._transport_mask
@@ -0,0 +1,184 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Bloom filter prefilter for attestation certificate issuers.
+
+An IssuerFilter holds the subject names and key identifiers of trusted
+issuer certificates. Attestation certificates whose issuer name and authority
+key identifier are both absent from it can't have been issued by a trusted
+certificate, and are rejected without further parsing. Filters can be saved
+to a snapshot file, to share them between worker processes.
+"""
+
+from u2flib_server.utils import sha_256
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import Encoding
+from math import ceil, log
+import struct
+import six
+import os
+
+
+__all__ = ['IssuerFilter']
+
+
+_MAGIC = b'U2FB\x01'
+_HEADER = struct.Struct('>IB32s')
+
+
+def _read_tlv(der, offset):
+    """Returns the offsets of the value and the end of a DER TLV."""
+    length = six.indexbytes(der, offset + 1)
+    start = offset + 2
+    if length & 0x80:
+        n_bytes = length & 0x7f
+        length = 0
+        for i in range(start, start + n_bytes):
+            length = length * 256 + six.indexbytes(der, i)
+        start += n_bytes
+    return start, start + length
+
+
+def _names(der):
+    """Returns the DER encoded issuer and subject of a certificate."""
+    tbs, _ = _read_tlv(der, 0)
+    offset, _ = _read_tlv(der, tbs)
+    if six.indexbytes(der, offset) == 0xa0:  # Explicit version
+        offset = _read_tlv(der, offset)[1]
+    offset = _read_tlv(der, offset)[1]  # Serial number
+    offset = _read_tlv(der, offset)[1]  # Signature algorithm
+    issuer_end = _read_tlv(der, offset)[1]
+    subject = _read_tlv(der, issuer_end)[1]  # Skip validity
+    return der[offset:issuer_end], der[subject:_read_tlv(der, subject)[1]]
+
+
+def _extension(cert, cls):
+    try:
+        return cert.extensions.get_extension_for_class(cls).value
+    except x509.ExtensionNotFound:
+        return None
+
+
+def _der(cert):
+    return cert if isinstance(cert, bytes) else cert.public_bytes(Encoding.DER)
+
+
+class IssuerFilter(object):
+    """A Bloom filter over issuer subject names and key identifiers.
+
+    digest identifies the set of certificates the filter was built from.
+    """
+    __slots__ = ('bits', 'n_hashes', 'digest')
+
+    def __init__(self, bits, n_hashes, digest):
+        self.bits = bits
+        self.n_hashes = n_hashes
+        self.digest = digest
+
+    @staticmethod
+    def trust_digest(certs):
+        """Returns a digest identifying a set of issuer certificates."""
+        return sha_256(b''.join(sorted(sha_256(_der(c)) for c in certs)))
+
+    @classmethod
+    def build(cls, certs, error_rate=0.01):
+        """Creates a filter from issuer certificates, parsed or DER."""
+        certs = [x509.load_der_x509_certificate(c, default_backend())
+                 if isinstance(c, bytes) else c for c in certs]
+        values = []
+        for cert in certs:
+            values.append(b'dn:' + _names(_der(cert))[1])
+            ski = _extension(cert, x509.SubjectKeyIdentifier)
+            if ski is not None:
+                values.append(b'ki:' + ski.digest)
+
+        n_bits = max(64, int(ceil(
+            -len(values) * log(error_rate) / log(2) ** 2)))
+        n_bits += -n_bits % 8
+        n_hashes = min(16, max(1, int(round(
+            n_bits / float(max(1, len(values))) * log(2)))))
+        bloom = cls(bytearray(n_bits // 8), n_hashes,
+                    cls.trust_digest(certs))
+        for value in values:
+            bloom._add(value)
+        return bloom
+
+    def _positions(self, value):
+        n_bits = len(self.bits) * 8
+        digests = [sha_256(struct.pack('>B', i) + value)
+                   for i in range((self.n_hashes + 7) // 8)]
+        words = struct.unpack('>%dI' % (8 * len(digests)), b''.join(digests))
+        return [w % n_bits for w in words[:self.n_hashes]]
+
+    def _add(self, value):
+        for pos in self._positions(value):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def _contains(self, value):
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(value))
+
+    def might_contain(self, info):
+        """Checks if the issuer of a CertificateInfo may be in the filter.
+
+        The issuer name is taken from the DER encoding directly. The authority
+        key identifier extension is only parsed if the name isn't found.
+        """
+        if self._contains(b'dn:' + _names(info.der)[0]):
+            return True
+        aki = _extension(info.certificate, x509.AuthorityKeyIdentifier)
+        return aki is not None and aki.key_identifier is not None and \
+            self._contains(b'ki:' + aki.key_identifier)
+
+    def to_bytes(self):
+        return _MAGIC + _HEADER.pack(len(self.bits), self.n_hashes,
+                                     self.digest) + bytes(self.bits)
+
+    @classmethod
+    def from_bytes(cls, data):
+        if not data.startswith(_MAGIC):
+            raise ValueError('Not an IssuerFilter snapshot')
+        offset = len(_MAGIC) + _HEADER.size
+        size, n_hashes, digest = _HEADER.unpack(data[len(_MAGIC):offset])
+        if len(data) != offset + size:
+            raise ValueError('Truncated IssuerFilter snapshot')
+        return cls(bytearray(data[offset:]), n_hashes, digest)
+
+    def save(self, fname):
+        """Writes the filter to a file, replacing it atomically."""
+        tmp = '%s.%d.tmp' % (fname, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(self.to_bytes())
+        getattr(os, 'replace', os.rename)(tmp, fname)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, 'rb') as f:
+            return cls.from_bytes(f.read())
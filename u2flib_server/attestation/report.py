@@ -0,0 +1,163 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Columnar reports over large sets of attestation certificates.
+
+Requires NumPy, available through the "reports" extra. Certificates are
+deduplicated by fingerprint, and each unique certificate is resolved once.
+The results are kept as NumPy arrays, with one element per unique
+certificate, and grouped counts are computed from them.
+"""
+
+from u2flib_server.attestation.metadata import MetadataProvider
+from u2flib_server.certs import CertificateInfo
+from u2flib_server.model import Transport
+from u2flib_server.utils import sha_256
+from cryptography.hazmat.primitives.serialization import Encoding
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+__all__ = ['AttestationReport', 'create_report']
+
+
+class AttestationReport(object):
+    """Attestation results for a set of certificates, as NumPy arrays.
+
+    Each array has one element per unique certificate, in the order first
+    seen, and rows maps each input certificate to its unique certificate.
+    transports holds transport bitmasks, with -1 where unknown. device_index
+    and vendor_index index into device_ids and vendors, with -1 where
+    unknown.
+    """
+
+    def __init__(self, fingerprints, rows, trusted, transports, device_index,
+                 device_ids, vendor_index, vendors):
+        self.fingerprints = fingerprints
+        self.rows = rows
+        self.counts = numpy.bincount(rows, minlength=len(fingerprints))
+        self.trusted = trusted
+        self.transports = transports
+        self.device_index = device_index
+        self.device_ids = device_ids
+        self.vendor_index = vendor_index
+        self.vendors = vendors
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _count_by(self, index, labels):
+        counts = numpy.bincount(index + 1, weights=self.counts,
+                                minlength=len(labels) + 1).astype(numpy.int64)
+        result = dict((label, int(count)) for label, count
+                      in zip(labels, counts[1:]) if count)
+        if counts[0]:
+            result[None] = int(counts[0])
+        return result
+
+    def count_by_device(self):
+        """Returns the number of certificates by deviceId, None if unknown."""
+        return self._count_by(self.device_index, self.device_ids)
+
+    def count_by_vendor(self):
+        """Returns the number of certificates by vendor name."""
+        return self._count_by(self.vendor_index, self.vendors)
+
+    def count_by_transport(self):
+        """Returns the number of certificates supporting each Transport."""
+        known = self.transports >= 0
+        return dict(
+            (t, int(self.counts[known & (self.transports & t != 0)].sum()))
+            for t in Transport
+        )
+
+    def count_by_transports(self):
+        """Returns the number of certificates by transport bitmask."""
+        masks, inverse = numpy.unique(self.transports, return_inverse=True)
+        counts = numpy.bincount(inverse.ravel(), weights=self.counts)
+        return dict((int(m) if m >= 0 else None, int(c))
+                    for m, c in zip(masks, counts))
+
+
+def _der(cert):
+    return cert if isinstance(cert, bytes) else cert.public_bytes(Encoding.DER)
+
+
+def create_report(certs, provider=None):
+    """Resolves an iterable of attestation certificates into a report.
+
+    Certificates can be given as DER bytes or parsed, and are resolved using
+    provider, a MetadataProvider.
+    """
+    if numpy is None:
+        raise ImportError('NumPy is required for attestation reports')
+    if provider is None:
+        provider = MetadataProvider()
+
+    unique = {}  # Fingerprint -> index
+    fingerprints = []
+    rows = []
+    ders = []
+    for cert in certs:
+        der = _der(cert)
+        fingerprint = sha_256(der)
+        index = unique.get(fingerprint)
+        if index is None:
+            index = unique[fingerprint] = len(fingerprints)
+            fingerprints.append(fingerprint)
+            ders.append(der)
+        rows.append(index)
+
+    n = len(fingerprints)
+    trusted = numpy.zeros(n, dtype=bool)
+    transports = numpy.full(n, -1, dtype=numpy.int32)
+    device_index = numpy.full(n, -1, dtype=numpy.int32)
+    vendor_index = numpy.full(n, -1, dtype=numpy.int32)
+    device_ids = {}
+    vendors = {}
+    for i, der in enumerate(ders):
+        # Not the shared cache, which would be flushed by a large report.
+        attestation = provider.get_attestation(CertificateInfo(der))
+        trusted[i] = attestation.trusted
+        if attestation.transport_mask is not None:
+            transports[i] = attestation.transport_mask
+        device_id = attestation.device_info.get('deviceId')
+        if device_id is not None:
+            device_index[i] = device_ids.setdefault(device_id,
+                                                    len(device_ids))
+        vendor = (attestation.vendor_info or {}).get('name')
+        if vendor is not None:
+            vendor_index[i] = vendors.setdefault(vendor, len(vendors))
+
+    return AttestationReport(
+        fingerprints, numpy.array(rows, dtype=numpy.intp), trusted,
+        transports, device_index, sorted(device_ids, key=device_ids.get),
+        vendor_index, sorted(vendors, key=vendors.get))
@@ -25,8 +25,19 @@
 # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
 # POSSIBILITY OF SUCH DAMAGE.
 
-from u2flib_server.attestation.model import MetadataObject
+from u2flib_server.attestation.model import CompiledMetadata
 from u2flib_server.attestation.data import YUBICO
+from u2flib_server.attestation.prefilter import IssuerFilter
+from u2flib_server.certs import get_certificate_info, CertificateInfo
+from u2flib_server.cache import ShardedLRUCache
+from u2flib_server import instrumentation
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import sha256
+import threading
+import logging
+import codecs
+import time
 import six
 import os
 import json
@@ -36,25 +47,95 @@ from cryptography.x509.oid import NameOID
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives.asymmetric import ec, rsa, padding
+from cryptography.hazmat.primitives.serialization import Encoding
 
-__all__ = ['MetadataResolver', 'create_resolver']
+__all__ = ['MetadataResolver', 'ChainResolver', 'ReloadableResolver',
+           'create_resolver', 'get_default_resolver']
+
+
+log = logging.getLogger(__name__)
+
+# Returned by _find_trusted when the result depends on the current time, and
+# so mustn't be cached.
+_TIME_DEPENDENT = object()
 
 
 class MetadataResolver(object):
+    """Resolves attestation certificates to the metadata trusting them.
 
-    def __init__(self):
-        self._identifiers = {}  # identifier -> Metadata
+    Certificates which aren't trusted are remembered, by fingerprint and
+    issuer, until the trusted metadata changes. Up to negative_cache_size
+    such certificates are kept. Failures which depend on the current time,
+    such as an expired certificate in a chain, aren't remembered.
+    """
+
+    def __init__(self, negative_cache_size=4096):
+        self._identifiers = {}  # identifier -> CompiledMetadata
         self._certs = {}  # Subject -> Cert
-        self._metadata = {}  # Cert -> Metadata
+        self._metadata = {}  # Cert -> CompiledMetadata
+        # (Fingerprint, Issuer) -> generation
+        self._untrusted = ShardedLRUCache(negative_cache_size,
+                                          name='attestation_untrusted')
+        self._generation = 0
+        self._prefilter_options = None
+        self._prefilter = None
+
+    def _trust_changed(self):
+        self._generation += 1
+
+    def cache_stats(self):
+        """Returns CacheStats for the caches of this resolver, by name."""
+        return {'untrusted': self._untrusted.stats()}
+
+    def enable_prefilter(self, snapshot=None, error_rate=0.01):
+        """Rejects certificates from unknown issuers using an IssuerFilter.
+
+        The filter is rebuilt when the trusted metadata changes. If snapshot
+        is given, the filter is loaded from that file when it matches the
+        trusted certificates, and otherwise built and written to it, so that
+        it can be shared between processes.
+        """
+        self._prefilter_options = (snapshot, error_rate)
+        self._prefilter = None
+
+    def _issuer_certificates(self):
+        return [c for certs in self._certs.values() for c in certs]
+
+    def _build_prefilter(self, snapshot, error_rate):
+        certs = self._issuer_certificates()
+        if snapshot is not None:
+            try:
+                prefilter = IssuerFilter.load(snapshot)
+                if prefilter.digest == IssuerFilter.trust_digest(certs):
+                    return prefilter
+            except (EnvironmentError, ValueError):
+                pass
+        prefilter = IssuerFilter.build(certs, error_rate)
+        if snapshot is not None:
+            try:
+                prefilter.save(snapshot)
+            except EnvironmentError:
+                pass  # Use it anyway.
+        return prefilter
+
+    def _get_prefilter(self):
+        if self._prefilter_options is None:
+            return None
+        generation = self._generation
+        if self._prefilter is None or self._prefilter[0] != generation:
+            self._prefilter = (generation, self._build_prefilter(
+                *self._prefilter_options))
+        return self._prefilter[1]
 
     def add_metadata(self, metadata):
-        metadata = MetadataObject.wrap(metadata)
+        metadata = CompiledMetadata.wrap(metadata)
 
         if metadata.identifier in self._identifiers:
             existing = self._identifiers[metadata.identifier]
             if metadata.version <= existing.version:
                 return  # Older version
             else:
+                self._trust_changed()
                 # Re-index everything
                 self._identifiers[metadata.identifier] = metadata
                 self._certs.clear()
@@ -62,11 +143,23 @@ class MetadataResolver(object):
                 for metadata in self._identifiers.values():
                     self._index(metadata)
         else:
+            self._trust_changed()
             self._identifiers[metadata.identifier] = metadata
             self._index(metadata)
 
+    def add_metadata_stream(self, fileobj):
+        """Adds metadata entries parsed incrementally from a file object.
+
+        The file can hold a single entry, a JSON array of entries, or a
+        sequence of entries such as one per line. Entries are parsed and added
+        one at a time, and only the fields used by the attestation model are
+        kept from each.
+        """
+        for data in _iter_json(fileobj):
+            self.add_metadata(_compact_metadata(data))
+
     def _index(self, metadata):
-        for cert_pem in metadata.trustedCertificates:
+        for cert_pem in metadata.metadata.trustedCertificates:
             if isinstance(cert_pem, six.text_type):
                 cert_pem = cert_pem.encode('ascii')
             cert = x509.load_pem_x509_certificate(cert_pem, default_backend())
@@ -108,17 +201,403 @@ class MetadataResolver(object):
             return False
 
     def resolve(self, cert):
-        if isinstance(cert, bytes):
-            cert = x509.load_der_x509_certificate(cert, default_backend())
-        issuer = cert.issuer \
-            .get_attributes_for_oid(NameOID.COMMON_NAME)[0].value
+        compiled = self.resolve_compiled(cert)
+        return compiled.metadata if compiled is not None else None
+
+    def resolve_compiled(self, cert):
+        """Like resolve, but returns a CompiledMetadata."""
+        with instrumentation.timer('resolve') as timer:
+            timer.stage('load_cert')
+            info = get_certificate_info(cert)
 
+            prefilter = self._get_prefilter()
+            if prefilter is not None:
+                timer.stage('prefilter')
+                if not prefilter.might_contain(info):
+                    timer.set_outcome('untrusted')
+                    return None
+
+            timer.stage('issuer')
+            issuer = info.issuer_cn
+            generation = self._generation
+            negative_key = (info.fingerprint, issuer)
+            if self._untrusted.get(negative_key) == generation:
+                timer.set_outcome('untrusted')
+                return None
+
+            timer.stage('verify')
+            metadata = self._find_trusted(info, issuer)
+            if metadata is None:
+                self._untrusted.put(negative_key, generation)
+            elif metadata is _TIME_DEPENDENT:
+                metadata = None
+            timer.set_outcome(
+                'untrusted' if metadata is None else 'trusted')
+            return metadata
+
+    def _find_trusted(self, info, issuer):
         for issuer in self._certs.get(issuer, []):
-            if self._verify_cert(cert, issuer.public_key()):
+            if self._verify_cert(info.certificate, issuer.public_key()):
                 return self._metadata[issuer]
         return None
 
 
+class ChainResolver(MetadataResolver):
+    """A MetadataResolver which also follows chains of intermediates.
+
+    Certificates in the chain, including the attestation certificate, must be
+    within their validity period unless check_validity is False.
+    Intermediates must be CA certificates allowed to sign certificates, and
+    their path length constraints are enforced. The result
+    of each signature check between two certificates is remembered, so each
+    intermediate is verified once. When a certificate has more than one
+    candidate issuer, their signatures are checked concurrently using up to
+    max_workers threads.
+    """
+
+    def __init__(self, intermediates=None, max_depth=4, max_workers=4,
+                 check_validity=True, clock=datetime.utcnow,
+                 edge_cache_size=4096, negative_cache_size=4096,
+                 anchor_cache_size=1024):
+        super(ChainResolver, self).__init__(negative_cache_size)
+        self._intermediates = {}  # Subject -> [CertificateInfo]
+        self._path_lengths = {}  # Fingerprint -> path length constraint
+        # Cert -> CertificateInfo
+        self._infos = ShardedLRUCache(anchor_cache_size,
+                                      name='attestation_anchors')
+        # (Issuer, Subject) fingerprints -> bool
+        self._edges = ShardedLRUCache(edge_cache_size,
+                                      name='attestation_edges')
+        self._max_depth = max_depth
+        self._max_workers = max_workers
+        self._check_validity = check_validity
+        self._clock = clock
+        self._executor = None
+        self._executor_lock = threading.Lock()
+        for cert in intermediates or []:
+            self.add_intermediate(cert)
+
+    def add_intermediate(self, cert):
+        """Adds an intermediate CA certificate, as PEM, DER or parsed.
+
+        Raises ValueError if the certificate isn't a CA certificate.
+        """
+        if isinstance(cert, six.text_type):
+            cert = cert.encode('ascii')
+        if isinstance(cert, bytes) and cert.startswith(b'-----'):
+            cert = x509.load_pem_x509_certificate(cert, default_backend())
+        info = _certificate_info(cert)
+        path_length = _ca_path_length(info.certificate)
+        self._intermediates.setdefault(info.subject_cn, []).append(info)
+        self._path_lengths[info.fingerprint] = path_length
+        self._trust_changed()
+
+    def _trust_changed(self):
+        super(ChainResolver, self)._trust_changed()
+        self._infos.clear()  # Anchors may have been removed.
+
+    def _may_issue(self, intermediate, depth):
+        # depth is the number of intermediates below this one in the chain.
+        path_length = self._path_lengths[intermediate.fingerprint]
+        return path_length is None or depth <= path_length
+
+    def _issuer_certificates(self):
+        return super(ChainResolver, self)._issuer_certificates() + [
+            i.certificate for infos in self._intermediates.values()
+            for i in infos]
+
+    def cache_stats(self):
+        stats = super(ChainResolver, self).cache_stats()
+        stats['edges'] = self._edges.stats()
+        stats['anchors'] = self._infos.stats()
+        return stats
+
+    def _anchor_info(self, cert):
+        return self._infos.get_or_create(cert,
+                                         lambda: _certificate_info(cert))
+
+    def _is_valid(self, info, now):
+        cert = info.certificate
+        return cert.not_valid_before <= now <= cert.not_valid_after
+
+    def _verify_edge(self, subject, issuer):
+        return self._verify_cert(subject.certificate, issuer.public_key)
+
+    def _verify_edges(self, subject, issuers):
+        keys = [(i.fingerprint, subject.fingerprint) for i in issuers]
+        results = [self._edges.get(k) for k in keys]
+        pending = [n for n, result in enumerate(results) if result is None]
+
+        if len(pending) > 1 and self._max_workers > 1:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self._max_workers)
+            futures = [(n, self._executor.submit(
+                self._verify_edge, subject, issuers[n])) for n in pending]
+            for n, future in futures:
+                results[n] = future.result()
+        else:
+            for n in pending:
+                results[n] = self._verify_edge(subject, issuers[n])
+
+        for n in pending:
+            self._edges.put(keys[n], results[n])
+        return results
+
+    def _find_trusted(self, info, issuer, depth=0, now=None):
+        if now is None:
+            now = self._clock()
+        if self._check_validity and not self._is_valid(info, now):
+            return _TIME_DEPENDENT
+
+        failure = None
+        anchors = [self._anchor_info(c) for c in self._certs.get(issuer, [])]
+        if self._check_validity:
+            valid = [a for a in anchors if self._is_valid(a, now)]
+            if len(valid) < len(anchors):
+                failure = _TIME_DEPENDENT
+            anchors = valid
+        intermediates = []
+        if depth < self._max_depth:
+            intermediates = [i for i in self._intermediates.get(issuer, [])
+                             if i.fingerprint != info.fingerprint and
+                             self._may_issue(i, depth)]
+
+        candidates = anchors + intermediates
+        results = self._verify_edges(info, candidates)
+        for n, (candidate, verified) in enumerate(zip(candidates, results)):
+            if not verified:
+                continue
+            if n < len(anchors):
+                return self._metadata[candidate.certificate]
+            metadata = self._find_trusted(candidate, candidate.issuer_cn,
+                                          depth + 1, now)
+            if metadata is _TIME_DEPENDENT:
+                failure = metadata
+            elif metadata is not None:
+                return metadata
+        return failure
+
+    def close(self):
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+def _ca_path_length(cert):
+    """Returns the path length constraint of a CA certificate, or None.
+
+    Raises ValueError unless the certificate has basicConstraints with CA set,
+    and keyCertSign in its key usage, if present.
+    """
+    try:
+        constraints = cert.extensions.get_extension_for_class(
+            x509.BasicConstraints).value
+    except x509.ExtensionNotFound:
+        raise ValueError('Not a CA certificate: no basicConstraints')
+    if not constraints.ca:
+        raise ValueError('Not a CA certificate')
+    try:
+        usage = cert.extensions.get_extension_for_class(x509.KeyUsage).value
+    except x509.ExtensionNotFound:
+        pass
+    else:
+        if not usage.key_cert_sign:
+            raise ValueError('CA certificate without keyCertSign')
+    return constraints.path_length
+
+
+def _certificate_info(cert):
+    if isinstance(cert, bytes):
+        return CertificateInfo(cert)
+    return CertificateInfo(cert.public_bytes(Encoding.DER), cert)
+
+
+_METADATA_FIELDS = ('identifier', 'version', 'vendorInfo',
+                    'trustedCertificates', 'devices')
+_DEVICE_FIELDS = ('deviceId', 'displayName', 'transports', 'deviceUrl',
+                  'imageUrl', 'selectors')
+
+
+def _pick(data, fields):
+    return dict((k, data[k]) for k in fields if k in data)
+
+
+def _compact_metadata(data):
+    compact = _pick(data, _METADATA_FIELDS)
+    if 'devices' in compact:
+        compact['devices'] = [_pick(d, _DEVICE_FIELDS)
+                              for d in compact['devices']]
+    return compact
+
+
+def _iter_json(fileobj, chunk_size=65536):
+    """Yields the JSON values in a file object one at a time.
+
+    Values can be the elements of a top level array, or follow each other,
+    optionally separated by whitespace.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = None
+    separators = ' \t\r\n'
+
+    while True:
+        while pos < len(buf) and buf[pos] in separators:
+            pos += 1
+        if pos < len(buf) and in_array is None:
+            in_array = buf[pos] == '['
+            if in_array:
+                separators += ','
+                pos += 1
+                continue
+        if in_array and pos < len(buf) and buf[pos] == ']':
+            return
+        if pos < len(buf):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # A number could continue in the next chunk.
+                if end < len(buf) or eof:
+                    pos = end
+                    yield value
+                    continue
+        elif eof:
+            if in_array:
+                raise ValueError('Unterminated JSON array')
+            return
+
+        # Need more data. Drop what has been consumed, and at least double
+        # the remainder so that large values aren't reparsed too often.
+        chunk = fileobj.read(max(chunk_size, len(buf) - pos))
+        eof = not chunk
+        if isinstance(chunk, six.binary_type):
+            chunk = text_decoder.decode(chunk, eof)
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+class ReloadableResolver(object):
+    """Resolves against a directory of metadata files, reloading changes.
+
+    reload() rescans the directory, and is called every interval seconds once
+    start() has been called. Only new files and files with a changed
+    modification time, size and contents are parsed. A new resolver is then
+    built from all files and swapped in, so that lookups are never blocked,
+    and always see a consistent set of metadata.
+
+    resolver_factory is called to create each new resolver, before the
+    metadata is added. Use it to configure the resolver, e.g. to create a
+    ChainResolver or enable the prefilter. Failed reloads are logged, and
+    last_error holds the error until a reload succeeds. last_loaded is the
+    time of the last successful reload.
+    """
+
+    def __init__(self, dname, interval=60, resolver_factory=MetadataResolver,
+                 clock=time.time):
+        self._dname = dname
+        self._interval = interval
+        self._factory = resolver_factory
+        self._clock = clock
+        self._files = {}  # fname -> (stat, digest, entries)
+        self._resolver = resolver_factory()
+        self._reload_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.last_error = None
+        self.last_loaded = None
+        self.reload()
+
+    @property
+    def resolver(self):
+        """The resolver currently in use."""
+        return self._resolver
+
+    def resolve(self, cert):
+        return self._resolver.resolve(cert)
+
+    def resolve_compiled(self, cert):
+        return self._resolver.resolve_compiled(cert)
+
+    def _load(self, fname, previous):
+        st = os.stat(fname)
+        stat = (st.st_mtime, st.st_size)
+        if previous is not None and previous[0] == stat:
+            return previous
+        with open(fname, 'rb') as f:
+            raw = f.read()
+        digest = sha256(raw).digest()
+        if previous is not None and previous[1] == digest:
+            return stat, digest, previous[2]
+        data = json.loads(raw.decode('utf-8'))
+        entries = data if isinstance(data, list) else [data]
+        return stat, digest, [CompiledMetadata(e) for e in entries]
+
+    def reload(self):
+        """Rescans the directory, returning True if the metadata changed.
+
+        If a file can't be read the current metadata is kept, and the error
+        is raised.
+        """
+        with self._reload_lock:
+            try:
+                changed = self._reload()
+            except Exception as e:
+                self.last_error = e
+                raise
+            self.last_error = None
+            self.last_loaded = self._clock()
+            return changed
+
+    def _reload(self):
+        fnames = sorted(os.path.join(self._dname, d)
+                        for d in os.listdir(self._dname)
+                        if d.endswith('.json'))
+        files = {}
+        for fname in fnames:
+            files[fname] = self._load(fname, self._files.get(fname))
+
+        changed = set(files) != set(self._files) or any(
+            files[f][2] is not self._files[f][2] for f in files)
+        if changed:
+            resolver = self._factory()
+            for fname in fnames:
+                for metadata in files[fname][2]:
+                    resolver.add_metadata(metadata)
+            self._resolver = resolver
+        self._files = files
+        return changed
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            try:
+                self.reload()
+            except Exception:
+                # Keep the current metadata, and retry later.
+                log.exception('Failed to reload metadata from %s',
+                              self._dname)
+
+    def start(self):
+        if self._thread is None:
+            self._stopped.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
 def _load_from_file(fname):
     with open(fname, 'r') as f:
         return json.load(f)
@@ -135,6 +614,8 @@ def _add_data(resolver, data):
         for d in data:
             _add_data(resolver, d)
         return
+    elif hasattr(data, 'read'):
+        return resolver.add_metadata_stream(data)
     elif isinstance(data, six.string_types):
         if os.path.isdir(data):
             data = _load_from_dir(data)
@@ -151,3 +632,20 @@ def create_resolver(data=None):
         data = YUBICO
     _add_data(resolver, data)
     return resolver
+
+
+_default_resolver = None
+_default_resolver_lock = threading.Lock()
+
+
+def get_default_resolver():
+    """Returns a shared resolver for the default metadata.
+
+    It is created on first use. Pass it to MetadataProviders to share it,
+    rather than have each build its own.
+    """
+    global _default_resolver
+    with _default_resolver_lock:
+        if _default_resolver is None:
+            _default_resolver = create_resolver()
+        return _default_resolver
@@ -0,0 +1,224 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Bounded in-process caches shared by the library.
+
+ShardedLRUCache splits its entries over a number of shards, each with its own
+lock and LRU order, so that threads using different keys rarely contend.
+Entries can expire after a TTL, and hit, miss and eviction counts are kept.
+Named caches are registered, so that stats() reports on all of them. Caches
+sharing a name, such as those of several resolver instances, are reported
+together.
+"""
+
+from collections import OrderedDict, namedtuple
+import threading
+import weakref
+import time
+
+
+__all__ = [
+    'CacheStats',
+    'ShardedLRUCache',
+    'stats'
+]
+
+
+CacheStats = namedtuple('CacheStats', ['hits', 'misses', 'evictions',
+                                       'expirations', 'size', 'maxsize'])
+
+_MISSING = object()
+
+# Shards should hold at least this many entries each.
+_MIN_SHARD_SIZE = 64
+
+_registry = weakref.WeakSet()
+_registry_lock = threading.Lock()
+
+
+class _Shard(object):
+    __slots__ = ('lock', 'entries', 'maxsize', 'hits', 'misses', 'evictions',
+                 'expirations')
+
+    def __init__(self, maxsize):
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # key -> (expires, value)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+
+class ShardedLRUCache(object):
+    """A thread safe, bounded LRU cache with lock striping.
+
+    maxsize is split evenly over the shards. Small caches use fewer shards,
+    so that each holds a useful number of entries. If ttl is given, entries
+    expire that many seconds after they were stored. A named cache is
+    included in the output of stats().
+    """
+
+    def __init__(self, maxsize=1024, shards=16, ttl=None, clock=time.time,
+                 name=None):
+        self.ttl = ttl
+        self.name = name
+        self._clock = clock
+        self._n_shards = max(1, min(shards, maxsize // _MIN_SHARD_SIZE))
+        self._shards = [_Shard(0) for _ in range(self._n_shards)]
+        self.resize(maxsize)
+        if name is not None:
+            with _registry_lock:
+                _registry.add(self)
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def resize(self, maxsize):
+        """Changes the maximum number of entries, evicting if needed."""
+        self._maxsize = maxsize
+        per_shard, extra = divmod(maxsize, self._n_shards)
+        for i, shard in enumerate(self._shards):
+            with shard.lock:
+                shard.maxsize = per_shard + (i < extra)
+                self._evict(shard)
+
+    def _shard(self, key):
+        return self._shards[hash(key) % self._n_shards]
+
+    def _evict(self, shard):
+        while len(shard.entries) > shard.maxsize:
+            shard.entries.popitem(last=False)
+            shard.evictions += 1
+
+    def get(self, key, default=None):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key, _MISSING)
+            if entry is _MISSING:
+                shard.misses += 1
+                return default
+            expires, value = entry
+            if expires is not None and expires <= self._clock():
+                del shard.entries[key]
+                shard.expirations += 1
+                shard.misses += 1
+                return default
+            shard.entries.pop(key)
+            shard.entries[key] = entry
+            shard.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = self._clock() + self.ttl if self.ttl is not None else None
+        shard = self._shard(key)
+        with shard.lock:
+            shard.entries.pop(key, None)
+            shard.entries[key] = (expires, value)
+            self._evict(shard)
+
+    def setdefault(self, key, value):
+        """Stores value unless key has a live entry, atomically.
+
+        Returns the existing value if there was one, and value otherwise.
+        """
+        now = self._clock()
+        expires = now + self.ttl if self.ttl is not None else None
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.get(key, _MISSING)
+            if entry is not _MISSING:
+                if entry[0] is None or entry[0] > now:
+                    shard.entries.pop(key)
+                    shard.entries[key] = entry
+                    shard.hits += 1
+                    return entry[1]
+                del shard.entries[key]
+                shard.expirations += 1
+            shard.misses += 1
+            shard.entries[key] = (expires, value)
+            self._evict(shard)
+        return value
+
+    def get_or_create(self, key, factory):
+        """Returns the cached value for key, creating it if missing.
+
+        factory is called without holding any lock, so it may be called more
+        than once for the same key by concurrent threads.
+        """
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = factory()
+            self.put(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        shard = self._shard(key)
+        with shard.lock:
+            entry = shard.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.entries.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self._shards)
+
+    def stats(self):
+        totals = [0, 0, 0, 0, 0]
+        for shard in self._shards:
+            with shard.lock:
+                totals[0] += shard.hits
+                totals[1] += shard.misses
+                totals[2] += shard.evictions
+                totals[3] += shard.expirations
+                totals[4] += len(shard.entries)
+        return CacheStats(*(totals + [self._maxsize]))
+
+
+def stats():
+    """Returns a dict of CacheStats for all named caches, by name.
+
+    The stats of caches with the same name are summed.
+    """
+    with _registry_lock:
+        caches = list(_registry)
+    result = {}
+    for cache in caches:
+        cache_stats = cache.stats()
+        if cache.name in result:
+            cache_stats = CacheStats(*[a + b for a, b in zip(
+                result[cache.name], cache_stats)])
+        result[cache.name] = cache_stats
+    return result
@@ -0,0 +1,189 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+from u2flib_server.utils import sha_256
+from cryptography import x509
+from cryptography.x509.oid import NameOID
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.serialization import Encoding
+from u2flib_server.cache import ShardedLRUCache
+import six
+
+
+__all__ = [
+    'CertificateInfo',
+    'CertificateCache',
+    'get_certificate_info'
+]
+
+
+TRANSPORTS_EXT_OID = x509.ObjectIdentifier('1.3.6.1.4.1.45724.2.1.1')
+
+_UNSET = object()
+
+
+def _common_name(name):
+    attributes = name.get_attributes_for_oid(NameOID.COMMON_NAME)
+    return attributes[0].value if attributes else None
+
+
+class CertificateInfo(object):
+    """An X.509 certificate parsed from DER, along with values derived from it.
+
+    Derived values are computed on first access and then remembered.
+    """
+    __slots__ = ('der', 'certificate', '_public_key', '_fingerprint',
+                 '_issuer_cn', '_subject_cn', '_transports', '_extensions')
+
+    def __init__(self, der, certificate=None):
+        if certificate is None:
+            certificate = x509.load_der_x509_certificate(der,
+                                                         default_backend())
+        self.der = der
+        self.certificate = certificate
+        self._public_key = _UNSET
+        self._fingerprint = _UNSET
+        self._issuer_cn = _UNSET
+        self._subject_cn = _UNSET
+        self._transports = _UNSET
+        self._extensions = {}
+
+    @property
+    def public_key(self):
+        if self._public_key is _UNSET:
+            self._public_key = self.certificate.public_key()
+        return self._public_key
+
+    @property
+    def fingerprint(self):
+        """SHA-256 digest of the DER encoded certificate."""
+        if self._fingerprint is _UNSET:
+            self._fingerprint = sha_256(self.der)
+        return self._fingerprint
+
+    @property
+    def issuer_cn(self):
+        if self._issuer_cn is _UNSET:
+            self._issuer_cn = _common_name(self.certificate.issuer)
+        return self._issuer_cn
+
+    @property
+    def subject_cn(self):
+        if self._subject_cn is _UNSET:
+            self._subject_cn = _common_name(self.certificate.subject)
+        return self._subject_cn
+
+    def extension_value(self, oid):
+        """Returns the raw value of an extension, or None if not present."""
+        try:
+            return self._extensions[oid]
+        except KeyError:
+            pass
+        try:
+            extension = self.certificate.extensions.get_extension_for_oid(
+                x509.ObjectIdentifier(oid))
+            value = extension.value.value
+        except x509.ExtensionNotFound:
+            value = None
+        self._extensions[oid] = value
+        return value
+
+    @property
+    def transports(self):
+        """FIDO transports bitmask from the certificate, or None."""
+        if self._transports is _UNSET:
+            self._transports = _decode_transports(
+                self.extension_value(TRANSPORTS_EXT_OID.dotted_string))
+        return self._transports
+
+
+# Maps each byte value to the same byte with its bit order reversed.
+_REVERSED_BITS = bytearray(int('{0:08b}'.format(i)[::-1], 2)
+                           for i in range(256))
+
+
+def _decode_transports(der_bitstring):
+    if der_bitstring is None:
+        return None
+    int_bytes = bytearray(der_bitstring[3:])
+
+    # Mask away unused bits (should already be 0, but make sure)
+    unused_bits = six.indexbytes(der_bitstring, 2)
+    int_bytes[-1] &= (0xff << unused_bits)
+
+    # Bit n of the BIT STRING (MSB first) becomes bit n of the integer
+    transports = 0
+    for i, byte in enumerate(int_bytes):
+        transports |= _REVERSED_BITS[byte] << (8 * i)
+    return transports
+
+
+class CertificateCache(object):
+    """Bounded LRU cache of CertificateInfo objects, keyed by DER bytes."""
+
+    def __init__(self, maxsize=1024, name=None):
+        self._entries = ShardedLRUCache(maxsize, name=name)
+
+    @property
+    def maxsize(self):
+        return self._entries.maxsize
+
+    def get(self, cert):
+        """Returns a CertificateInfo for DER bytes or a parsed certificate."""
+        if isinstance(cert, CertificateInfo):
+            return cert
+        if isinstance(cert, bytes):
+            der, parsed = cert, None
+        else:
+            der, parsed = cert.public_bytes(Encoding.DER), cert
+
+        info = self._entries.get(der)
+        if info is None:
+            info = CertificateInfo(der, parsed)
+            self._entries.put(der, info)
+        return info
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return self._entries.stats()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+DEFAULT_CACHE = CertificateCache(name='certificates')
+
+
+def get_certificate_info(cert):
+    """Returns a CertificateInfo from the shared cache.
+
+    Accepts DER bytes, a cryptography Certificate or a CertificateInfo.
+    """
+    return DEFAULT_CACHE.get(cert)
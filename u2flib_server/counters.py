@@ -0,0 +1,255 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Storage of U2F signature counters, used to detect cloned devices.
+
+A CounterStore keeps the last seen counter value for each key handle, and
+atomically replaces it only when a larger value is presented.
+"""
+
+from u2flib_server.cache import ShardedLRUCache
+import abc
+import logging
+import sqlite3
+import threading
+import six
+
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+__all__ = [
+    'CounterStore',
+    'MemoryCounterStore',
+    'SQLiteCounterStore',
+    'WriteBehindCounterStore'
+]
+
+
+@six.add_metaclass(abc.ABCMeta)
+class CounterStore(object):
+
+    @abc.abstractmethod
+    def get(self, key_handle):
+        """Returns the stored counter for a key handle, or None."""
+
+    @abc.abstractmethod
+    def check_and_set(self, key_handle, counter):
+        """Stores counter if it is greater than the stored value.
+
+        Returns True if the counter was accepted, False if not.
+        """
+
+    def update_many(self, counters):
+        """Stores many (key_handle, counter) pairs, keeping the maximum."""
+        for key_handle, counter in counters:
+            self.check_and_set(key_handle, counter)
+
+
+class MemoryCounterStore(CounterStore):
+
+    def __init__(self):
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key_handle):
+        return self._counters.get(key_handle)
+
+    def check_and_set(self, key_handle, counter):
+        with self._lock:
+            current = self._counters.get(key_handle)
+            if current is not None and counter <= current:
+                return False
+            self._counters[key_handle] = counter
+            return True
+
+
+class SQLiteCounterStore(CounterStore):
+
+    def __init__(self, path=':memory:', table='u2f_counters'):
+        self._table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS %s ('
+            'key_handle TEXT PRIMARY KEY, counter INTEGER NOT NULL)' % table)
+
+    def get(self, key_handle):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT counter FROM %s WHERE key_handle = ?' % self._table,
+                (key_handle,)).fetchone()
+        return row[0] if row else None
+
+    def check_and_set(self, key_handle, counter):
+        with self._lock:
+            for _ in range(2):
+                cursor = self._conn.execute(
+                    'UPDATE %s SET counter = ? '
+                    'WHERE key_handle = ? AND counter < ?' % self._table,
+                    (counter, key_handle, counter))
+                if cursor.rowcount:
+                    return True
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO %s (key_handle, counter) '
+                    'VALUES (?, ?)' % self._table, (key_handle, counter))
+                if cursor.rowcount:
+                    return True
+                # Row exists, either with a larger counter, or it was inserted
+                # concurrently by another connection. Retry the update once.
+            return False
+
+    def update_many(self, counters):
+        counters = list(counters)
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.executemany(
+                    'INSERT OR IGNORE INTO %s (key_handle, counter) '
+                    'VALUES (?, ?)' % self._table, counters)
+                self._conn.executemany(
+                    'UPDATE %s SET counter = ? '
+                    'WHERE key_handle = ? AND counter < ?' % self._table,
+                    [(c, k, c) for (k, c) in counters])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class WriteBehindCounterStore(CounterStore):
+    """Checks counters in memory and writes them to another store in batches.
+
+    Counters are read from the backing store the first time a key handle is
+    seen, and up to max_cached of them are kept in memory. Accepted counters
+    are written back by flush(), which is called when max_pending updates are
+    queued, and every flush_interval seconds once start() has been called.
+    Updates that fail to be written are kept and retried by the next flush.
+    Checks are only atomic within this process.
+    """
+
+    def __init__(self, store, flush_interval=1.0, max_pending=1000,
+                 max_cached=100000):
+        self._store = store
+        self._flush_interval = flush_interval
+        self._max_pending = max_pending
+        self._counters = ShardedLRUCache(max_cached, name='counters')
+        self._pending = {}
+        self._flushing = {}
+        self._flushed = 0  # Number of completed flushes.
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _cached(self, key_handle):
+        # Must hold self._lock. Counters not yet written take precedence over
+        # the backing store, even if they have been evicted from the cache.
+        counter = self._counters.get(key_handle, _MISSING)
+        if counter is _MISSING:
+            counter = self._pending.get(key_handle, _MISSING)
+        if counter is _MISSING:
+            counter = self._flushing.get(key_handle, _MISSING)
+        return counter
+
+    def get(self, key_handle):
+        with self._lock:
+            counter = self._cached(key_handle)
+        if counter is _MISSING:
+            return self._store.get(key_handle)
+        return counter
+
+    def check_and_set(self, key_handle, counter):
+        stored = flushed = _MISSING
+        while True:
+            with self._lock:
+                current = self._cached(key_handle)
+                if current is _MISSING and flushed == self._flushed:
+                    # No flush finished while reading the backing store, so
+                    # a newer counter would still be held here.
+                    current = stored
+                if current is not _MISSING:
+                    if current is not None and counter <= current:
+                        self._counters.put(key_handle, current)
+                        return False
+                    self._counters.put(key_handle, counter)
+                    self._pending[key_handle] = counter
+                    flush = len(self._pending) >= self._max_pending
+                    break
+                flushed = self._flushed
+            stored = self._store.get(key_handle)
+
+        if flush:
+            self.flush()
+        return True
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+            if pending:
+                try:
+                    self._store.update_many(pending.items())
+                except Exception:
+                    with self._lock:
+                        for key_handle, counter in pending.items():
+                            if self._pending.get(key_handle, -1) < counter:
+                                self._pending[key_handle] = counter
+                    raise
+                finally:
+                    with self._lock:
+                        self._flushing = {}
+                        self._flushed += 1
+
+    def _run(self):
+        while not self._stopped.wait(self._flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                log.exception('Failed to write counters, will retry')
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
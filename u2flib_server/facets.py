@@ -0,0 +1,225 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+
+from u2flib_server.cache import ShardedLRUCache
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import build_opener, HTTPRedirectHandler
+import threading
+import logging
+import json
+import time
+import six
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = [
+    'FacetSet',
+    'TrustedFacetsResolver',
+    'parse_trusted_facets'
+]
+
+
+class FacetSet(frozenset):
+    """An immutable set of valid facets, for constant time origin checks."""
+
+    def __repr__(self):
+        return 'FacetSet(%r)' % sorted(self)
+
+
+def _origin(url):
+    parsed = urlparse(url)
+    return '%s://%s' % (parsed.scheme, parsed.netloc)
+
+
+TRUSTED_FACETS_TYPE = 'application/fido.trusted-apps+json'
+REDIRECT_HEADER = 'FIDO-AppID-Redirect-Authorized'
+
+
+class _RedirectHandler(HTTPRedirectHandler):
+    """Only follows redirects authorized by the FIDO redirect header."""
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if (headers.get(REDIRECT_HEADER) or '').lower() != 'true':
+            raise HTTPError(req.get_full_url(), code,
+                            'Unauthorized redirect to %s' % newurl,
+                            headers, fp)
+        return HTTPRedirectHandler.redirect_request(
+            self, req, fp, code, msg, headers, newurl)
+
+
+def _http_fetch(url, timeout=10):
+    response = build_opener(_RedirectHandler).open(url, timeout=timeout)
+    try:
+        if response.getcode() != 200:
+            raise ValueError('Unexpected HTTP status %d for %s' %
+                             (response.getcode(), url))
+        content_type = response.info().get('Content-Type') or ''
+        if content_type.split(';')[0].strip().lower() != TRUSTED_FACETS_TYPE:
+            raise ValueError('Unexpected content type %r for %s' %
+                             (content_type, url))
+        return response.read()
+    finally:
+        response.close()
+
+
+def parse_trusted_facets(app_id, data):
+    """Parses a TrustedFacetList, returning the FacetSet for U2F 1.0.
+
+    As required by the FIDO AppID and Facet specification, only https facets
+    are included, and the origin of the AppID is always included.
+    """
+    if isinstance(data, six.binary_type):
+        data = data.decode('utf-8')
+    data = json.loads(data)
+    facets = set([_origin(app_id)])
+    try:
+        for entry in data['trustedFacets']:
+            version = entry.get('version', {})
+            if version.get('major') == 1 and version.get('minor') == 0:
+                facets.update(f for f in entry.get('ids', [])
+                              if f.startswith('https://'))
+    except (KeyError, TypeError, AttributeError):
+        raise ValueError('Invalid TrustedFacetList')
+    return FacetSet(facets)
+
+
+class _Entry(object):
+    __slots__ = ('facets', 'fetched', 'refreshing', 'failures', 'retry_at')
+
+    def __init__(self, facets, fetched):
+        self.facets = facets  # None until fetched.
+        self.fetched = fetched
+        self.refreshing = False
+        self.failures = 0
+        self.retry_at = fetched
+
+
+class TrustedFacetsResolver(object):
+    """Resolves and caches the trusted facets for AppIDs.
+
+    Results are cached for ttl seconds. After that they are still served for
+    up to stale_ttl more seconds, while being refreshed in the background.
+    A failed fetch is retried after retry_interval seconds, doubling with
+    each further failure up to ttl, and until then the facets are
+    unavailable, unless stale ones can be served. Up to maxsize AppIDs are
+    cached. The fetcher is a callable taking a URL and returning the response
+    body.
+
+    Missing facets are fetched when first needed. If blocking is False, they
+    are instead fetched in the background, and are unavailable until then,
+    so that verifying a response never waits on the network. Use prefetch()
+    to load them ahead of use.
+    """
+
+    def __init__(self, fetcher=_http_fetch, ttl=3600, stale_ttl=86400,
+                 clock=time.time, retry_interval=60, maxsize=1024,
+                 blocking=True):
+        self._fetcher = fetcher
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._retry_interval = retry_interval
+        self._clock = clock
+        self._blocking = blocking
+        self._entries = ShardedLRUCache(maxsize, name='trusted_facets')
+        self._lock = threading.Lock()
+
+    def _fetch(self, app_id):
+        if not app_id.startswith('https://'):
+            # Non-https AppIDs only allow the AppID's own origin.
+            return FacetSet([_origin(app_id)])
+        return parse_trusted_facets(app_id, self._fetcher(app_id))
+
+    def _store(self, app_id, facets):
+        with self._lock:
+            self._entries.put(app_id, _Entry(facets, self._clock()))
+
+    def _refresh(self, app_id, entry):
+        # Returns the fetched facets, or None if the fetch failed.
+        try:
+            facets = self._fetch(app_id)
+        except Exception:
+            log.warning('Failed to fetch trusted facets for %s', app_id,
+                        exc_info=True)
+            with self._lock:
+                delay = self._retry_interval * 2 ** entry.failures
+                entry.failures += 1
+                entry.retry_at = self._clock() + min(delay, self._ttl)
+                entry.refreshing = False
+            return None
+        self._store(app_id, facets)
+        return facets
+
+    def _start_refresh(self, app_id, entry):
+        thread = threading.Thread(target=self._refresh, args=(app_id, entry))
+        thread.daemon = True
+        thread.start()
+
+    def get_facets(self, app_id):
+        """Returns the FacetSet for an AppID, fetching it if needed.
+
+        Raises ValueError if the facets are unavailable.
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(app_id)
+            if entry is None:
+                entry = _Entry(None, now)
+                self._entries.put(app_id, entry)
+            age = now - entry.fetched
+            if entry.facets is not None and age < self._ttl:
+                return entry.facets
+            fetch = not entry.refreshing and now >= entry.retry_at
+            entry.refreshing = entry.refreshing or fetch
+            if entry.facets is not None and \
+                    age < self._ttl + self._stale_ttl:
+                if fetch:
+                    self._start_refresh(app_id, entry)
+                return entry.facets
+            if fetch and not self._blocking:
+                self._start_refresh(app_id, entry)
+                fetch = False
+
+        facets = self._refresh(app_id, entry) if fetch else None
+        if facets is None:
+            raise ValueError('Trusted facets unavailable for %s' % app_id)
+        return facets
+
+    def prefetch(self, app_ids):
+        """Fetches the facets for the given AppIDs ahead of use."""
+        for app_id in app_ids:
+            self._store(app_id, self._fetch(app_id))
+
+    def invalidate(self, app_id=None):
+        with self._lock:
+            if app_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(app_id)
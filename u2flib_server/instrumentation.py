@@ -0,0 +1,227 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Optional per-stage timing of the verification paths.
+
+Instrumentation is disabled by default. Once a Collector is installed using
+set_collector(), each instrumented operation reports the time spent in each of
+its stages, as well as the total, together with an outcome label.
+"""
+
+from bisect import bisect_left
+import threading
+import time
+
+
+__all__ = [
+    'Collector',
+    'HistogramCollector',
+    'set_collector',
+    'get_collector',
+    'timer'
+]
+
+
+_now = getattr(time, 'perf_counter', time.time)
+
+_collector = None
+
+OK = 'ok'
+ERROR = 'error'
+TOTAL = 'total'
+
+
+class Collector(object):
+    """Receives timings. This base class discards them."""
+
+    def observe(self, operation, stage, seconds, outcome):
+        """Records the duration of one stage of an operation, in seconds.
+
+        stage is TOTAL for the operation as a whole, and outcome is OK, ERROR
+        or an operation specific value.
+        """
+
+
+def set_collector(collector):
+    """Installs a Collector, or disables instrumentation if given None."""
+    global _collector
+    _collector = collector
+
+
+def get_collector():
+    return _collector
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+    def stage(self, name):
+        pass
+
+    def set_outcome(self, outcome):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    __slots__ = ('_collector', '_operation', '_stages', '_stage', '_mark',
+                 '_start', '_outcome')
+
+    def __init__(self, collector, operation):
+        self._collector = collector
+        self._operation = operation
+        self._stages = []
+        self._stage = None
+        self._outcome = None
+
+    def __enter__(self):
+        self._start = self._mark = _now()
+        return self
+
+    def stage(self, name):
+        now = _now()
+        if self._stage is not None:
+            self._stages.append((self._stage, now - self._mark))
+        self._stage = name
+        self._mark = now
+
+    def set_outcome(self, outcome):
+        self._outcome = outcome
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        now = _now()
+        if self._stage is not None:
+            self._stages.append((self._stage, now - self._mark))
+        if exc_type is not None:
+            outcome = ERROR
+        else:
+            outcome = self._outcome or OK
+        for stage, seconds in self._stages:
+            self._collector.observe(self._operation, stage, seconds, outcome)
+        self._collector.observe(self._operation, TOTAL, now - self._start,
+                                outcome)
+        return False
+
+
+def timer(operation):
+    """Returns a context manager timing the stages of an operation.
+
+    Stages are started by calling stage(name) on the returned object, and each
+    one lasts until the next one starts, or the block exits. When no Collector
+    is installed a shared no-op object is returned.
+    """
+    collector = _collector
+    if collector is None:
+        return _NULL_TIMER
+    return _Timer(collector, operation)
+
+
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class _Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self, n_buckets):
+        self.counts = [0] * n_buckets
+        self.sum = 0.0
+        self.count = 0
+
+
+class HistogramCollector(Collector):
+    """Collects observations into Prometheus style histograms.
+
+    Observations are labeled by operation, stage and outcome. The collected
+    data can be rendered using the Prometheus text exposition format.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS,
+                 name='u2f_stage_duration_seconds'):
+        self.buckets = tuple(sorted(buckets))
+        self.name = name
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, operation, stage, seconds, outcome):
+        labels = (operation, stage, outcome)
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            histogram = self._histograms.get(labels)
+            if histogram is None:
+                histogram = _Histogram(len(self.buckets) + 1)
+                self._histograms[labels] = histogram
+            histogram.counts[index] += 1
+            histogram.sum += seconds
+            histogram.count += 1
+
+    def get(self, operation, stage, outcome=OK):
+        """Returns (cumulative bucket counts, sum, count) for a label set."""
+        with self._lock:
+            histogram = self._histograms.get((operation, stage, outcome))
+            if histogram is None:
+                return None
+            cumulative = []
+            total = 0
+            for count in histogram.counts:
+                total += count
+                cumulative.append(total)
+            return cumulative, histogram.sum, histogram.count
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+    def exposition(self):
+        with self._lock:
+            items = sorted(
+                (labels, list(h.counts), h.sum, h.count)
+                for labels, h in self._histograms.items()
+            )
+
+        lines = ['# TYPE %s histogram' % self.name]
+        bounds = [repr(float(b)) for b in self.buckets] + ['+Inf']
+        for (operation, stage, outcome), counts, total, count in items:
+            labels = 'operation="%s",stage="%s",outcome="%s"' % (
+                operation, stage, outcome)
+            cumulative = 0
+            for bound, n in zip(bounds, counts):
+                cumulative += n
+                lines.append('%s_bucket{%s,le="%s"} %d' % (
+                    self.name, labels, bound, cumulative))
+            lines.append('%s_sum{%s} %r' % (self.name, labels, total))
+            lines.append('%s_count{%s} %d' % (self.name, labels, count))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,178 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Pluggable JSON backend used by the model classes.
+
+A faster JSON library is used for decoding when one is installed, falling back
+to the standard library json module. The backend is picked at import time, and
+can be overridden using the U2FLIB_JSON_BACKEND environment variable, or by
+calling set_backend(). An unknown or unavailable backend in the environment
+variable logs a warning and the standard library is used.
+
+Encoding uses the standard library by default, since the fast backends don't
+produce byte-for-byte identical output. Pass encode=True to set_backend() to
+use the backend for encoding as well.
+"""
+
+import json
+import logging
+import os
+import six
+
+
+log = logging.getLogger(__name__)
+
+
+__all__ = [
+    'JSONBackend',
+    'available_backends',
+    'get_backend',
+    'set_backend',
+    'loads',
+    'dumps'
+]
+
+
+ENV_VAR = 'U2FLIB_JSON_BACKEND'
+PREFERRED = ['orjson', 'ujson', 'json']
+
+
+def _std_loads(data):
+    if isinstance(data, six.binary_type):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+
+class JSONBackend(object):
+
+    def __init__(self, name, loads, dumps=json.dumps, compact_dumps=None):
+        self.name = name
+        self.loads = loads
+        self.dumps = dumps
+        self.compact_dumps = compact_dumps or dumps
+
+    def __repr__(self):
+        return '<JSONBackend: %s>' % self.name
+
+
+def _load_orjson():
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+    return JSONBackend('orjson', orjson.loads, compact_dumps=dumps)
+
+
+def _load_ujson():
+    import ujson
+    return JSONBackend('ujson', ujson.loads, compact_dumps=ujson.dumps)
+
+
+def _load_json():
+    return JSONBackend('json', _std_loads)
+
+
+_LOADERS = {
+    'orjson': _load_orjson,
+    'ujson': _load_ujson,
+    'json': _load_json
+}
+
+
+def _load(name):
+    try:
+        loader = _LOADERS[name]
+    except KeyError:
+        raise ValueError('Unknown JSON backend: %s' % name)
+    try:
+        return loader()
+    except ImportError:
+        raise ValueError('JSON backend not available: %s' % name)
+
+
+def available_backends():
+    names = []
+    for name in PREFERRED:
+        try:
+            _load(name)
+            names.append(name)
+        except ValueError:
+            pass
+    return names
+
+
+_loads = _std_loads
+_dumps = json.dumps
+_backend = None
+
+
+def get_backend():
+    return _backend
+
+
+def set_backend(backend, encode=False):
+    """Selects the JSON backend, given by name or as a JSONBackend.
+
+    If encode is True the backend is also used for encoding, producing compact
+    output.
+    """
+    global _backend, _loads, _dumps
+    if isinstance(backend, six.string_types):
+        backend = _load(backend)
+    _backend = backend
+    _loads = backend.loads
+    _dumps = backend.compact_dumps if encode else backend.dumps
+
+
+def loads(data):
+    return _loads(data)
+
+
+def dumps(obj):
+    return _dumps(obj)
+
+
+def _select_default():
+    name = os.environ.get(ENV_VAR)
+    if name:
+        try:
+            set_backend(name)
+            return
+        except ValueError as e:
+            log.warning('Ignoring %s=%s (%s), using json', ENV_VAR, name, e)
+            set_backend('json')
+            return
+    for name in PREFERRED:
+        try:
+            set_backend(name)
+            return
+        except ValueError:
+            pass
+
+
+_select_default()
@@ -27,28 +27,38 @@
 
 
 from u2flib_server.utils import websafe_encode, websafe_decode, sha_256
-from cryptography import x509
-from cryptography.exceptions import InvalidSignature
+from u2flib_server.certs import get_certificate_info
+from u2flib_server import certs
+from u2flib_server.cache import ShardedLRUCache
+from u2flib_server.facets import TrustedFacetsResolver
+from u2flib_server import instrumentation, json_backend
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives.serialization import load_der_public_key
 from binascii import a2b_hex
 from enum import Enum, IntEnum, unique
+from collections import OrderedDict
 import struct
-import json
 import six
 import os
 
 
 __all__ = [
     'Transport',
+    'Transports',
     'Type',
+    'ErrorCode',
+    'VerificationResult',
     'RegistrationData',
     'SignatureData',
     'RegisteredKey',
+    'RegisteredKeyList',
     'DeviceRegistration',
+    'PreparedKey',
     'ClientData',
+    'ClientDataValidator',
     'RegisterRequest',
     'RegisterResponse',
     'SignResponse',
@@ -59,7 +69,9 @@ __all__ = [
 
 U2F_V2 = 'U2F_V2'
 
-TRANSPORTS_EXT_OID = x509.ObjectIdentifier('1.3.6.1.4.1.45724.2.1.1')
+# Moved to u2flib_server.certs, kept here for compatibility.
+TRANSPORTS_EXT_OID = certs.TRANSPORTS_EXT_OID
+
 PUB_KEY_DER_PREFIX = a2b_hex(
     '3059301306072a8648ce3d020106082a8648ce3d030107034200')
 
@@ -90,24 +102,30 @@ def _pop_bytes(data, l):
     return x
 
 
-def _fix_cert(der):  # Some early certs have UNUSED BITS incorrectly set.
-    if sha_256(der) in CERTS_TO_FIX:
-        der = der[:-257] + b'\0' + der[-256:]
-    return der
+def _load_public_key(der_pubkey):
+    return load_der_public_key(PUB_KEY_DER_PREFIX + der_pubkey,
+                               default_backend())
+
+
+def _facet_set(valid_facets):
+    # Pass a FacetSet to avoid building the set for each check.
+    if valid_facets is None or isinstance(valid_facets, frozenset):
+        return valid_facets
+    if isinstance(valid_facets, six.string_types):
+        return frozenset([valid_facets])
+    return frozenset(valid_facets)
 
 
-def _validate_client_data(client_data, challenge, typ, valid_facets):
-    if client_data.typ != typ:
-        raise ValueError("Wrong type! Was: %r, expecting: %r" % (
-            client_data.typ, typ))
+def _get_facets(valid_facets, app_id):
+    if isinstance(valid_facets, TrustedFacetsResolver):
+        return valid_facets.get_facets(app_id)
+    return _facet_set(valid_facets)
 
-    if challenge != client_data.challenge:
-        raise ValueError("Wrong challenge! Was: %r, expecting: %r" % (
-            client_data.challenge, challenge))
 
-    if valid_facets is not None and client_data.origin not in valid_facets:
-        raise ValueError("Invalid facet! Was: %r, expecting one of: %r" % (
-            client_data.origin, valid_facets))
+def _fix_cert(der):  # Some early certs have UNUSED BITS incorrectly set.
+    if sha_256(der) in CERTS_TO_FIX:
+        der = der[:-257] + b'\0' + der[-256:]
+    return der
 
 
 @unique
@@ -123,26 +141,67 @@ class Transport(IntEnum):
 
     @staticmethod
     def transports_from_cert(cert):
-        if isinstance(cert, bytes):
-            cert = x509.load_der_x509_certificate(cert, default_backend())
-        try:
-            ext = cert.extensions.get_extension_for_oid(TRANSPORTS_EXT_OID)
-            der_bitstring = ext.value.value
-            int_bytes = bytearray(der_bitstring[3:])
-
-            # Mask away unused bits (should already be 0, but make sure)
-            unused_bits = six.indexbytes(der_bitstring, 2)
-            int_bytes[-1] &= (0xff << unused_bits)
-
-            # Reverse the bitstring and convert to integer
-            transports = 0
-            for byte in int_bytes:
-                for _ in range(8):
-                    transports = (transports << 1) | (byte & 1)
-                    byte >>= 1
-            return [t for t in Transport if t.value & transports]
-        except x509.ExtensionNotFound:
-            return None
+        transports = Transports.from_cert(cert)
+        return list(transports) if transports is not None else None
+
+
+class Transports(int):
+    """Bitmask of Transport values.
+
+    Iterating over a Transports yields the contained Transport members.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_list(cls, transports):
+        """Creates a Transports from Transport members or their keys."""
+        if isinstance(transports, int):
+            return cls(transports)
+        value = 0
+        for t in transports:
+            if isinstance(t, six.string_types):
+                t = getattr(Transport, t.upper())
+            value |= t
+        return cls(value)
+
+    @classmethod
+    def from_cert(cls, cert):
+        """Returns the Transports of an attestation certificate, or None."""
+        transports = get_certificate_info(cert).transports
+        return cls(transports) if transports is not None else None
+
+    def __iter__(self):
+        return iter(_TRANSPORT_MEMBERS[int(self) & _TRANSPORT_BITS])
+
+    def __len__(self):
+        return len(_TRANSPORT_MEMBERS[int(self) & _TRANSPORT_BITS])
+
+    def __contains__(self, transport):
+        return bool(self & transport)
+
+    def __or__(self, other):
+        return Transports(int(self) | int(other))
+
+    __ror__ = __or__
+
+    def __and__(self, other):
+        return Transports(int(self) & int(other))
+
+    __rand__ = __and__
+
+    @property
+    def keys(self):
+        return [t.key for t in self]
+
+    def __repr__(self):
+        return '<Transports: %s>' % '|'.join(t.name for t in self)
+
+
+_TRANSPORT_BITS = sum(t.value for t in Transport)
+_TRANSPORT_MEMBERS = [
+    tuple(t for t in Transport if t.value & mask)
+    for mask in range(_TRANSPORT_BITS + 1)
+]
 
 
 @unique
@@ -151,6 +210,88 @@ class Type(Enum):
     SIGN = 'navigator.id.getAssertion'
 
 
+@unique
+class ErrorCode(IntEnum):
+    OK = 0
+    INVALID_DATA = 1
+    WRONG_TYPE = 2
+    WRONG_CHALLENGE = 3
+    INVALID_FACET = 4
+    UNKNOWN_KEY_HANDLE = 5
+    INVALID_SIGNATURE = 6
+    COUNTER_NOT_INCREASED = 7
+    REPLAYED = 8
+    FACETS_UNAVAILABLE = 9
+
+
+_MESSAGES = {
+    ErrorCode.INVALID_DATA: '%s',
+    ErrorCode.WRONG_TYPE: 'Wrong type! Was: %r, expecting: %r',
+    ErrorCode.WRONG_CHALLENGE: 'Wrong challenge! Was: %r, expecting: %r',
+    ErrorCode.INVALID_FACET: 'Invalid facet! Was: %r, expecting one of: %r',
+    ErrorCode.UNKNOWN_KEY_HANDLE: 'Unknown key handle: %s',
+    ErrorCode.INVALID_SIGNATURE: '%s signature is invalid',
+    ErrorCode.COUNTER_NOT_INCREASED: 'Counter did not increase, the device '
+                                     'may have been cloned',
+    ErrorCode.REPLAYED: 'Replayed response',
+    ErrorCode.FACETS_UNAVAILABLE: '%s',
+}
+
+
+class VerificationResult(object):
+    """The outcome of a check, returned instead of raising an exception.
+
+    A successful result is true and holds the value the raising equivalent
+    would have returned. A failed result holds an ErrorCode, and the message
+    for it is only formatted when asked for.
+    """
+    __slots__ = ('code', 'value', '_args')
+
+    def __init__(self, code=ErrorCode.OK, value=None, args=()):
+        self.code = code
+        self.value = value
+        self._args = args
+
+    @property
+    def ok(self):
+        return self.code == ErrorCode.OK
+
+    def __bool__(self):
+        return self.code == ErrorCode.OK
+
+    __nonzero__ = __bool__
+
+    @property
+    def message(self):
+        if self.code == ErrorCode.OK:
+            return None
+        template = _MESSAGES[self.code]
+        args = self._args
+        if self.code == ErrorCode.INVALID_FACET:
+            args = (args[0], sorted(args[1]))
+        return template % args if args else template
+
+    def unwrap(self):
+        """Returns the value, or raises ValueError if the check failed."""
+        if self.code != ErrorCode.OK:
+            raise ValueError(self.message)
+        return self.value
+
+    def __repr__(self):
+        return '<VerificationResult: %s>' % self.code.name
+
+
+def _failure(code, *args):
+    return VerificationResult(code, None, args)
+
+
+_VALID = VerificationResult()
+
+# Errors raised by malformed input when parsing it.
+_PARSE_ERRORS = (ValueError, TypeError, KeyError, IndexError, struct.error,
+                 UnsupportedAlgorithm)
+
+
 class RegistrationData(object):
 
     def __init__(self, data):
@@ -171,10 +312,14 @@ class RegistrationData(object):
     def publicKey(self):
         return websafe_encode(self.pub_key)
 
-    def verify(self, app_param, chal_param):
-        cert = x509.load_der_x509_certificate(self.certificate,
-                                              default_backend())
-        pubkey = cert.public_key()
+    @property
+    def attestation_key(self):
+        return get_certificate_info(self.certificate).public_key
+
+    def check(self, app_param, chal_param, pubkey=None):
+        """Like verify, but returns a VerificationResult."""
+        if pubkey is None:
+            pubkey = self.attestation_key
         verifier = pubkey.verifier(self.signature, ec.ECDSA(hashes.SHA256()))
 
         verifier.update(b'\0' + app_param + chal_param + self.key_handle +
@@ -182,7 +327,11 @@ class RegistrationData(object):
         try:
             verifier.verify()
         except InvalidSignature:
-            raise ValueError('Attestation signature is invalid')
+            return _failure(ErrorCode.INVALID_SIGNATURE, 'Attestation')
+        return _VALID
+
+    def verify(self, app_param, chal_param, pubkey=None):
+        self.check(app_param, chal_param, pubkey).unwrap()
 
     @property
     def bytes(self):
@@ -204,9 +353,12 @@ class SignatureData(object):
         self.counter = struct.unpack('>I', _pop_bytes(buf, 4))[0]
         self.signature = bytes(buf)
 
-    def verify(self, app_param, chal_param, der_pubkey):
-        pubkey = load_der_public_key(PUB_KEY_DER_PREFIX + der_pubkey,
-                                     default_backend())
+    def check(self, app_param, chal_param, der_pubkey):
+        """Like verify, but returns a VerificationResult."""
+        if isinstance(der_pubkey, ec.EllipticCurvePublicKey):
+            pubkey = der_pubkey
+        else:
+            pubkey = _load_public_key(der_pubkey)
         verifier = pubkey.verifier(self.signature, ec.ECDSA(hashes.SHA256()))
         verifier.update(app_param +
                         six.int2byte(self.user_presence) +
@@ -215,7 +367,11 @@ class SignatureData(object):
         try:
             verifier.verify()
         except InvalidSignature:
-            raise ValueError('U2F signature is invalid')
+            return _failure(ErrorCode.INVALID_SIGNATURE, 'U2F')
+        return _VALID
+
+    def verify(self, app_param, chal_param, der_pubkey):
+        self.check(app_param, chal_param, der_pubkey).unwrap()
 
     @property
     def bytes(self):
@@ -233,10 +389,8 @@ class JSONDict(dict):
         if len(args) == 1 and not kwargs:
             arg = args[0]
             args = tuple()
-            if isinstance(arg, six.text_type):
-                kwargs = json.loads(arg)
-            elif isinstance(arg, six.binary_type):
-                kwargs = json.loads(arg.decode('utf-8'))
+            if isinstance(arg, (six.text_type, six.binary_type)):
+                kwargs = json_backend.loads(arg)
             else:
                 kwargs = dict(arg)
         super(JSONDict, self).__init__(*args, **kwargs)
@@ -254,18 +408,29 @@ class JSONDict(dict):
 
     @property
     def json(self):
-        return json.dumps(self)
+        return json_backend.dumps(self)
 
     @classmethod
     def wrap(cls, data):
         return data if isinstance(data, cls) else cls(data)
 
 
+_app_params = ShardedLRUCache(1024, name='app_params')
+
+
+def _app_param(app_id):
+    param = _app_params.get(app_id)
+    if param is None:
+        param = sha_256(app_id.encode('idna'))
+        _app_params.put(app_id, param)
+    return param
+
+
 class WithAppId(object):
 
     @property
     def applicationParameter(self):
-        return sha_256(self['appId'].encode('idna'))
+        return _app_param(self['appId'])
 
 
 class WithChallenge(object):
@@ -303,6 +468,12 @@ class RegisteredKey(JSONDict, WithAppId, WithKeyHandle):
             return [getattr(Transport, x.upper()) for x in self['transports']]
         return None
 
+    @property
+    def transport_mask(self):
+        if self.get('transports') is not None:
+            return Transports.from_list(self['transports'])
+        return None
+
 
 class DeviceRegistration(RegisteredKey):
     _required_fields = ['version', 'keyHandle', 'publicKey']
@@ -312,6 +483,41 @@ class DeviceRegistration(RegisteredKey):
         return websafe_decode(self['publicKey'])
 
 
+class PreparedKey(object):
+    """A DeviceRegistration with its verification inputs computed once.
+
+    Holds the loaded public key, the decoded key handle, the application
+    parameter and the transports. Keep these around for keys that are used
+    often, and pass them to U2fSignRequest.complete. The public key is loaded
+    from the registration, unless already loaded and given as public_key.
+    """
+    __slots__ = ('registration', 'key_handle', 'public_key', 'app_param',
+                 'transports')
+
+    def __init__(self, registration, app_id=None, public_key=None):
+        self.registration = DeviceRegistration.wrap(registration)
+        self.key_handle = self.registration.keyHandle
+        if public_key is None:
+            public_key = _load_public_key(self.registration.publicKey)
+        self.public_key = public_key
+        app_id = self.registration.get('appId', app_id)
+        if app_id is None:
+            raise ValueError('No appId given for key')
+        self.app_param = _app_param(app_id)
+        self.transports = self.registration.transport_mask
+
+    @classmethod
+    def index(cls, keys, app_id=None):
+        """Returns a dict of PreparedKeys by key handle."""
+        prepared = (k if isinstance(k, cls) else cls(k, app_id) for k in keys)
+        return dict((k.key_handle, k) for k in prepared)
+
+    def matches(self, registration, app_param):
+        """Checks that this was prepared from a registration."""
+        return app_param == self.app_param and \
+            registration.get('publicKey') == self.registration['publicKey']
+
+
 class ClientData(JSONDict, WithChallenge):
     _required_fields = ['typ', 'challenge', 'origin']
 
@@ -343,6 +549,58 @@ class WithClientData(object):
         return sha_256(websafe_decode(self['clientData']))
 
 
+class ClientDataValidator(object):
+    """Decodes and validates clientData in a single pass.
+
+    The expected type, challenge and facets are prepared once. The challenge
+    is compared in its websafe encoded form, without decoding it. Facets can be
+    given as a single string or an iterable of strings, and sets made from
+    the same facets are shared between validators.
+    """
+    __slots__ = ('typ', 'challenge', 'valid_facets')
+
+    def __init__(self, typ, challenge, valid_facets=None):
+        self.typ = Type(typ).value
+        if isinstance(challenge, bytes):
+            challenge = websafe_encode(challenge)
+        self.challenge = challenge.rstrip('=')
+        self.valid_facets = _facet_set(valid_facets)
+
+    def check(self, client_data):
+        """Like validate, but returns a VerificationResult."""
+        try:
+            raw = websafe_decode(client_data)
+            data = json_backend.loads(raw)
+            if not isinstance(data, dict):
+                return _failure(ErrorCode.INVALID_DATA,
+                                'clientData must be a JSON object')
+            data = ClientData(**data)
+        except _PARSE_ERRORS as e:
+            return _failure(ErrorCode.INVALID_DATA, e)
+
+        if data['typ'] != self.typ:
+            return _failure(ErrorCode.WRONG_TYPE, data['typ'], self.typ)
+
+        challenge = data['challenge']
+        if not isinstance(challenge, six.string_types) or \
+                challenge.rstrip('=') != self.challenge:
+            return _failure(ErrorCode.WRONG_CHALLENGE, challenge,
+                            self.challenge)
+
+        origin = data['origin']
+        if self.valid_facets is not None and (
+                not isinstance(origin, six.string_types) or
+                origin not in self.valid_facets):
+            return _failure(ErrorCode.INVALID_FACET, origin,
+                            self.valid_facets)
+
+        return VerificationResult(ErrorCode.OK, (sha_256(raw), data))
+
+    def validate(self, client_data):
+        """Returns the challenge parameter and the parsed ClientData."""
+        return self.check(client_data).unwrap()
+
+
 class RegisterRequest(JSONDict, WithAppId, WithChallenge):
     _required_fields = ['version', 'challenge']
 
@@ -365,17 +623,94 @@ class SignResponse(JSONDict, WithClientData, WithKeyHandle):
     def signatureData(self):
         return SignatureData(websafe_decode(self['signatureData']))
 
-    def verify(self, app_param, der_pubkey):
-        self.signatureData.verify(app_param, self.challengeParameter,
-                                  der_pubkey)
+    def verify(self, app_param, der_pubkey, replay_cache=None):
+        chal_param = self.challengeParameter
+        sign_data = self.signatureData
+        if replay_cache is not None:
+            key = replay_cache.key(app_param, chal_param, self.keyHandle,
+                                   sign_data.bytes)
+            prior = replay_cache.claim(key)
+            if prior is not None:
+                if prior is replay_cache.PENDING or \
+                        replay_cache.policy == replay_cache.REJECT:
+                    raise ValueError('Replayed response')
+                return
+        try:
+            sign_data.verify(app_param, chal_param, der_pubkey)
+        except Exception:
+            if replay_cache is not None:
+                replay_cache.release(key)
+            raise
+        if replay_cache is not None:
+            replay_cache.add(key, True)
+
+
+class RegisteredKeyList(object):
+    """A list of registered keys with its client data pre-serialized.
+
+    Build one per set of devices and reuse it for each new request. Producing
+    the client payload then only splices in the challenge.
+    """
+    __slots__ = ('keys', 'key_data', 'json')
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self.key_data = [RegisteredKey.wrap(k).key_data for k in self.keys]
+        self.json = json_backend.dumps(self.key_data)
+
+    @classmethod
+    def wrap(cls, keys):
+        return keys if isinstance(keys, cls) else cls(keys)
+
+    def copy_key_data(self):
+        """Returns a copy of key_data, which the caller may modify."""
+        copies = []
+        for data in self.key_data:
+            data = dict(data)
+            if 'transports' in data:
+                data['transports'] = list(data['transports'])
+            copies.append(data)
+        return copies
+
+    def sign_data_json(self, app_id, challenge):
+        """Returns the JSON encoded data_for_client of a U2fSignRequest."""
+        return ''.join([
+            '{"appId": ', json_backend.dumps(app_id),
+            ', "challenge": ', json_backend.dumps(challenge),
+            ', "registeredKeys": ', self.json, '}'
+        ])
+
+    def register_data_json(self, app_id, challenge, version=U2F_V2):
+        """Returns the JSON encoded data_for_client of a U2fRegisterRequest."""
+        return ''.join([
+            '{"appId": ', json_backend.dumps(app_id),
+            ', "registerRequests": [{"version": ', json_backend.dumps(version),
+            ', "challenge": ', json_backend.dumps(challenge),
+            '}], "registeredKeys": ', self.json, '}'
+        ])
 
 
 class WithRegisteredKeys(object):
+    _key_list = None
 
     @property
     def registeredKeys(self):
         return [RegisteredKey.wrap(x) for x in self['registeredKeys']]
 
+    @property
+    def key_list(self):
+        if self._key_list is None:
+            self._key_list = RegisteredKeyList(self['registeredKeys'])
+        return self._key_list
+
+    @classmethod
+    def _create(cls, registered_keys, **kwargs):
+        if isinstance(registered_keys, RegisteredKeyList):
+            request = cls(registeredKeys=registered_keys.keys, **kwargs)
+            request._key_list = registered_keys
+            return request
+        return cls(registeredKeys=registered_keys, **kwargs)
+
 
 class U2fRegisterRequest(JSONDict, WithAppId, WithRegisteredKeys):
     _required_fields = ['appId', 'registerRequests', 'registeredKeys']
@@ -395,43 +730,119 @@ class U2fRegisterRequest(JSONDict, WithAppId, WithRegisteredKeys):
         return {
             'appId': self['appId'],
             'registerRequests': self['registerRequests'],
-            'registeredKeys': [r.key_data for r in self.registeredKeys]
+            'registeredKeys': self.key_list.copy_key_data()
         }
 
+    @property
+    def data_for_client_json(self):
+        req = self.get_request(U2F_V2)
+        return self.key_list.register_data_json(self['appId'],
+                                                req['challenge'])
+
     @classmethod
     def create(cls, app_id, registered_keys, challenge=None):
         if challenge is None:
             challenge = os.urandom(32)
 
-        return cls(
+        return cls._create(
+            registered_keys,
             appId=app_id,
             registerRequests=[RegisterRequest(
                 version=U2F_V2,
                 challenge=websafe_encode(challenge)
-            )],
-            registeredKeys=registered_keys
+            )]
         )
 
     def complete(self, response, valid_facets=None):
-        resp = RegisterResponse.wrap(response)
-        req = self.get_request(U2F_V2)
+        return self._check(response, valid_facets).unwrap()
 
-        _validate_client_data(resp.clientData, req.challenge, Type.REGISTER,
-                              valid_facets)
+    def check(self, response, valid_facets=None):
+        """Like complete, but returns a VerificationResult.
 
-        resp.verify(self.applicationParameter)
-        registration_data = resp.registrationData
-        transports = Transport.transports_from_cert(
-            registration_data.certificate)
-        transports = [t.key for t in transports] if transports else transports
+        Failures don't raise exceptions. The value of a successful result is
+        the (device, certificate) tuple returned by complete.
+        """
+        return self._check(response, valid_facets)
 
-        return DeviceRegistration(
+    def _complete(self, response, valid_facets, attestation_cache=None):
+        return self._check(response, valid_facets,
+                           attestation_cache).unwrap()
+
+    def _check(self, response, valid_facets, attestation_cache=None):
+        with instrumentation.timer('register') as timer:
+            timer.stage('parse')
+            req = self.get_request(U2F_V2)
+            try:
+                resp = RegisterResponse.wrap(response)
+                client_data = resp['clientData']
+            except _PARSE_ERRORS as e:
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.INVALID_DATA, e)
+
+            timer.stage('client_data')
+            try:
+                facets = _get_facets(valid_facets, self['appId'])
+            except ValueError as e:
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.FACETS_UNAVAILABLE, e)
+            validator = ClientDataValidator(Type.REGISTER, req['challenge'],
+                                            facets)
+            result = validator.check(client_data)
+            if not result:
+                timer.set_outcome(instrumentation.ERROR)
+                return result
+            chal_param = result.value[0]
+
+            timer.stage('decode')
+            try:
+                registration_data = resp.registrationData
+            except _PARSE_ERRORS as e:
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.INVALID_DATA, e)
+
+            timer.stage('public_key')
+            cached = attestation_cache and attestation_cache.get(
+                registration_data.certificate)
+            if cached:
+                pubkey = cached[0]
+            else:
+                try:
+                    pubkey = registration_data.attestation_key
+                except _PARSE_ERRORS as e:
+                    timer.set_outcome(instrumentation.ERROR)
+                    return _failure(ErrorCode.INVALID_DATA, e)
+            if not isinstance(pubkey, ec.EllipticCurvePublicKey):
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.INVALID_DATA,
+                                'Unsupported attestation key type')
+
+            timer.stage('verify')
+            result = registration_data.check(self.applicationParameter,
+                                             chal_param, pubkey)
+            if not result:
+                timer.set_outcome(instrumentation.ERROR)
+                return result
+
+            timer.stage('transports')
+            if cached:
+                transports = cached[1]
+            else:
+                try:
+                    transports = Transports.from_cert(
+                        registration_data.certificate)
+                except _PARSE_ERRORS as e:
+                    timer.set_outcome(instrumentation.ERROR)
+                    return _failure(ErrorCode.INVALID_DATA, e)
+            transports = transports.keys if transports is not None \
+                else None
+
+        return VerificationResult(ErrorCode.OK, (DeviceRegistration(
             version=req.version,
             keyHandle=registration_data.keyHandle,
             appId=self.appId,
             publicKey=registration_data.publicKey,
             transports=transports,
-        ), registration_data.certificate
+        ), registration_data.certificate))
 
 
 class U2fSignRequest(JSONDict, WithAppId, WithChallenge, WithRegisteredKeys):
@@ -439,17 +850,64 @@ class U2fSignRequest(JSONDict, WithAppId, WithChallenge, WithRegisteredKeys):
 
     def __init__(self, *args, **kwargs):
         super(U2fSignRequest, self).__init__(*args, **kwargs)
-        if len(self.registeredKeys) == 0:
+        if len(self['registeredKeys']) == 0:
             raise ValueError('Must have at least one RegisteredKey')
+        self._key_groups = None
+        self._keys = None
+
+    def _index_keys(self):
+        # Group keys by appId and index them by key handle, once.
+        key_groups = OrderedDict()
+        keys = {}
+        for data in self['registeredKeys']:
+            key = RegisteredKey.wrap(data)
+            app_id = key.get('appId', self['appId'])
+            key_groups.setdefault(app_id, []).append(key)
+            keys.setdefault(key.keyHandle, (data, _app_param(app_id)))
+        self._key_groups, self._keys = key_groups, keys
+
+    @property
+    def key_groups(self):
+        """Registered keys grouped by the appId they are registered to."""
+        if self._key_groups is None:
+            self._index_keys()
+        return self._key_groups
+
+    def _find_key(self, key_handle, prepared_keys):
+        """Returns the registered key data, its application parameter and
+        the matching PreparedKey, if any.
+
+        A prepared key is matched by its encoded key handle, so that the
+        registered keys need not be decoded.
+        """
+        prepared = None
+        if prepared_keys is not None:
+            prepared = prepared_keys.get(key_handle)
+        if prepared is not None:
+            encoded = prepared.registration['keyHandle']
+            for data in self['registeredKeys']:
+                if data.get('keyHandle') == encoded:
+                    app_param = _app_param(data.get('appId', self['appId']))
+                    if prepared.matches(data, app_param):
+                        return data, app_param, prepared
+                    break
+        if self._keys is None:
+            self._index_keys()
+        data, app_param = self._keys[key_handle]
+        return data, app_param, None
 
     @property
     def data_for_client(self):
         return {
             'appId': self['appId'],
             'challenge': self['challenge'],
-            'registeredKeys': [r.key_data for r in self.registeredKeys]
+            'registeredKeys': self.key_list.copy_key_data()
         }
 
+    @property
+    def data_for_client_json(self):
+        return self.key_list.sign_data_json(self['appId'], self['challenge'])
+
     @property
     def devices(self):
         return [DeviceRegistration.wrap(x) for x in self['registeredKeys']]
@@ -459,23 +917,131 @@ class U2fSignRequest(JSONDict, WithAppId, WithChallenge, WithRegisteredKeys):
         if challenge is None:
             challenge = os.urandom(32)
 
-        return cls(
+        return cls._create(
+            devices,
             appId=app_id,
-            registeredKeys=devices,
             challenge=websafe_encode(challenge)
         )
 
-    def complete(self, response, valid_facets=None):
-        resp = SignResponse.wrap(response)
-
-        _validate_client_data(resp.clientData, self.challenge, Type.SIGN,
-                              valid_facets)
-        device = next(d for d in self.devices if d.keyHandle == resp.keyHandle)
+    def complete(self, response, valid_facets=None, counter_store=None,
+                 replay_cache=None, prepared_keys=None):
+        """Verifies a SignResponse to this request.
+
+        prepared_keys can be given as a dict of PreparedKeys by key handle, as
+        created by PreparedKey.index. These are used in place of the
+        corresponding registered keys of the request, provided that they
+        match.
+        """
+        return self.check(response, valid_facets, counter_store,
+                          replay_cache, prepared_keys).unwrap()
+
+    def check(self, response, valid_facets=None, counter_store=None,
+              replay_cache=None, prepared_keys=None):
+        """Like complete, but returns a VerificationResult.
+
+        Failures don't raise exceptions. The value of a successful result is
+        the (device, counter, user presence) tuple returned by complete.
+        """
+        with instrumentation.timer('sign') as timer:
+            timer.stage('parse')
+            try:
+                resp = SignResponse.wrap(response)
+                client_data = resp['clientData']
+            except _PARSE_ERRORS as e:
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.INVALID_DATA, e)
 
-        app_param = device.applicationParameter \
-            if 'appId' in device else self.applicationParameter
-        resp.verify(app_param, device.publicKey)
+            timer.stage('client_data')
+            try:
+                facets = _get_facets(valid_facets, self['appId'])
+            except ValueError as e:
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.FACETS_UNAVAILABLE, e)
+            validator = ClientDataValidator(Type.SIGN, self['challenge'],
+                                            facets)
+            result = validator.check(client_data)
+            if not result:
+                timer.set_outcome(instrumentation.ERROR)
+                return result
+            chal_param = result.value[0]
+
+            timer.stage('decode')
+            try:
+                key_handle = resp.keyHandle
+                sign_data = resp.signatureData
+            except _PARSE_ERRORS as e:
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.INVALID_DATA, e)
+            try:
+                data, app_param, prepared = self._find_key(key_handle,
+                                                           prepared_keys)
+            except KeyError:
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.UNKNOWN_KEY_HANDLE,
+                                resp['keyHandle'])
+
+            if replay_cache is None:
+                return self._check_signed(timer, data, prepared, sign_data,
+                                          app_param, chal_param, counter_store)
+
+            timer.stage('replay')
+            replay_key = replay_cache.key(app_param, chal_param, key_handle,
+                                          sign_data.bytes)
+            prior = replay_cache.claim(replay_key)
+            if prior is replay_cache.PENDING or prior is not None and \
+                    replay_cache.policy == replay_cache.REJECT:
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.REPLAYED)
+            if prior is not None:
+                return self._check_signed(timer, data, prepared, sign_data,
+                                          app_param, chal_param, counter_store,
+                                          prior)
+
+            # Claimed, so the result must be added or the claim released.
+            try:
+                result = self._check_signed(timer, data, prepared, sign_data,
+                                            app_param, chal_param,
+                                            counter_store)
+            except Exception:
+                replay_cache.release(replay_key)
+                raise
+            if result:
+                replay_cache.add(replay_key, result.value)
+            else:
+                replay_cache.release(replay_key)
+            return result
 
-        sign_data = resp.signatureData
+    def _check_signed(self, timer, data, prepared, sign_data, app_param,
+                      chal_param, counter_store, prior=None):
+        # The signature is not verified again for a prior result.
+        device = DeviceRegistration.wrap(data)
 
-        return device, sign_data.counter, sign_data.user_presence
+        if prior is None:
+            if prepared is not None:
+                pubkey = prepared.public_key
+            else:
+                timer.stage('public_key')
+                try:
+                    pubkey = _load_public_key(device.publicKey)
+                except _PARSE_ERRORS as e:
+                    timer.set_outcome(instrumentation.ERROR)
+                    return _failure(ErrorCode.INVALID_DATA, e)
+
+            timer.stage('verify')
+            result = sign_data.check(app_param, chal_param, pubkey)
+            if not result:
+                timer.set_outcome(instrumentation.ERROR)
+                return result
+
+        if counter_store is not None:
+            timer.stage('counter')
+            if not counter_store.check_and_set(device['keyHandle'],
+                                               sign_data.counter):
+                timer.set_outcome(instrumentation.ERROR)
+                return _failure(ErrorCode.COUNTER_NOT_INCREASED)
+
+        if prior is not None:
+            return VerificationResult(ErrorCode.OK, prior)
+        return VerificationResult(
+            ErrorCode.OK,
+            (device, sign_data.counter, sign_data.user_presence))
@@ -0,0 +1,134 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Short lived memo of verified sign responses.
+
+Clients retrying over unreliable networks may resubmit an identical
+SignResponse. A ReplayCache remembers recently verified responses, so that a
+resubmission is rejected as a replay. With the return policy it is instead
+answered with the prior result, without verifying the signature again.
+Counters are still checked under that policy, so a counter store rejects the
+resubmission. Without one, identical responses are accepted within the ttl.
+A response is claimed before its signature is verified, so of several
+identical responses submitted at once, only one is accepted.
+"""
+
+from u2flib_server.utils import sha_256
+from u2flib_server.cache import ShardedLRUCache
+import struct
+import time
+
+
+__all__ = [
+    'ReplayCache'
+]
+
+
+class _Claim(object):
+    # Stored for a response while it is being verified.
+    __slots__ = ()
+
+
+class ReplayCache(object):
+    RETURN = 'return'
+    REJECT = 'reject'
+    # Returned by claim for a response that is still being verified.
+    PENDING = object()
+
+    def __init__(self, ttl=60, maxsize=10000, policy=REJECT, clock=time.time):
+        if policy not in (self.RETURN, self.REJECT):
+            raise ValueError('Invalid replay policy: %r' % policy)
+        self.policy = policy
+        self._entries = ShardedLRUCache(maxsize, ttl=ttl, clock=clock,
+                                        name='replay')
+
+    @property
+    def ttl(self):
+        return self._entries.ttl
+
+    @property
+    def maxsize(self):
+        return self._entries.maxsize
+
+    @staticmethod
+    def key(app_param, challenge_param, key_handle, signature_data):
+        """Returns the cache key for a sign response.
+
+        challenge_param is the hash of the clientData, which covers the
+        challenge, key_handle and signature_data are the raw bytes sent by the
+        client.
+        """
+        return sha_256(b''.join([
+            app_param, challenge_param, struct.pack('>H', len(key_handle)),
+            key_handle, signature_data
+        ]))
+
+    def seen(self, key):
+        """Returns the result stored for a response, or None."""
+        result = self._entries.get(key)
+        return None if isinstance(result, _Claim) else result
+
+    def lookup(self, key):
+        """Returns the result stored for a replayed response, or None.
+
+        With the reject policy a replayed response raises ValueError instead.
+        """
+        result = self._entries.get(key)
+        if result is not None and self.policy == self.REJECT:
+            raise ValueError('Replayed response')
+        return None if isinstance(result, _Claim) else result
+
+    def claim(self, key):
+        """Atomically marks a response as being verified, unless seen before.
+
+        Returns None if the claim was made, after which the caller must either
+        add the result or release the claim. Otherwise returns the stored
+        result, or PENDING if another caller is still verifying the response.
+        """
+        claim = _Claim()
+        result = self._entries.setdefault(key, claim)
+        if result is claim:
+            return None
+        return self.PENDING if isinstance(result, _Claim) else result
+
+    def release(self, key):
+        """Gives up a claim on a response that failed verification."""
+        self._entries.pop(key)
+
+    def add(self, key, result):
+        """Stores the result of a successfully verified response."""
+        self._entries.put(key, result)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return self._entries.stats()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,256 @@
+# Copyright (c) 2013 Yubico AB
+# All rights reserved.
+#
+#   Redistribution and use in source and binary forms, with or
+#   without modification, are permitted provided that the following
+#   conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#    2. Redistributions in binary form must reproduce the above
+#       copyright notice, this list of conditions and the following
+#       disclaimer in the documentation and/or other materials provided
+#       with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Storage of device registrations, indexed by user and by key handle.
+
+Registrations are stored in decoded binary form, and returned as
+StoredRegistration objects which load their public key once, on first use.
+Their PreparedKeys can be passed to complete_authentication, so that stored
+keys are verified without being decoded again.
+"""
+
+from u2flib_server.model import (DeviceRegistration, PreparedKey, Transports,
+                                 U2F_V2, _app_param, _load_public_key)
+from u2flib_server.utils import websafe_encode, websafe_decode
+from collections import OrderedDict
+import abc
+import sqlite3
+import threading
+import six
+
+
+__all__ = [
+    'StoredRegistration',
+    'RegistrationRepository',
+    'MemoryRegistrationRepository',
+    'SQLiteRegistrationRepository'
+]
+
+
+def _key_handle(key_handle):
+    if isinstance(key_handle, six.text_type):
+        return websafe_decode(key_handle)
+    return key_handle
+
+
+class StoredRegistration(object):
+    __slots__ = ('user', 'key_handle', 'public_key', 'app_id', 'version',
+                 'transports', '_key', '_registration', '_prepared')
+
+    def __init__(self, user, key_handle, public_key, app_id=None,
+                 version=U2F_V2, transports=None):
+        self.user = user
+        self.key_handle = key_handle
+        self.public_key = public_key
+        self.app_id = app_id
+        self.version = version
+        self.transports = Transports(transports) \
+            if transports is not None else None
+        self._key = None
+        self._registration = None
+        self._prepared = None
+
+    @classmethod
+    def from_registration(cls, user, registration):
+        registration = DeviceRegistration.wrap(registration)
+        return cls(user, registration.keyHandle, registration.publicKey,
+                   registration.get('appId'), registration['version'],
+                   registration.transport_mask)
+
+    @property
+    def key(self):
+        """The loaded EC public key."""
+        if self._key is None:
+            self._key = _load_public_key(self.public_key)
+        return self._key
+
+    @property
+    def registration(self):
+        """The registration as a DeviceRegistration.
+
+        It is built once, and shared, so it should not be modified.
+        """
+        if self._registration is None:
+            data = DeviceRegistration(
+                version=self.version,
+                keyHandle=websafe_encode(self.key_handle),
+                publicKey=websafe_encode(self.public_key),
+                transports=self.transports.keys
+                if self.transports is not None else None
+            )
+            if self.app_id is not None:
+                data['appId'] = self.app_id
+            self._registration = data
+        return self._registration
+
+    def prepared_key(self, app_id=None):
+        """Returns the PreparedKey for the registration.
+
+        app_id is used if the registration has none of its own.
+        """
+        prepared = self._prepared
+        if prepared is None or (self.app_id is None and app_id is not None and
+                                prepared.app_param != _app_param(app_id)):
+            prepared = PreparedKey(self.registration, app_id, self.key)
+            self._prepared = prepared
+        return prepared
+
+
+@six.add_metaclass(abc.ABCMeta)
+class RegistrationRepository(object):
+
+    @abc.abstractmethod
+    def add(self, user, registration):
+        """Stores a registration (a DeviceRegistration) for a user."""
+
+    @abc.abstractmethod
+    def get(self, key_handle):
+        """Returns the StoredRegistration for a key handle, or None.
+
+        The key handle can be given raw, or websafe encoded.
+        """
+
+    @abc.abstractmethod
+    def for_user(self, user):
+        """Returns a list of the StoredRegistrations of a user."""
+
+    @abc.abstractmethod
+    def remove(self, key_handle):
+        """Removes a registration, returning True if it was stored."""
+
+    def registrations_for_user(self, user):
+        """Returns the registrations of a user, for begin_authentication."""
+        return [r.registration for r in self.for_user(user)]
+
+    def prepared_keys(self, user, app_id=None):
+        """Returns the PreparedKeys of a user, by key handle.
+
+        Pass these as prepared_keys to complete_authentication.
+        """
+        return PreparedKey.index(
+            r.prepared_key(app_id) for r in self.for_user(user))
+
+
+class MemoryRegistrationRepository(RegistrationRepository):
+
+    def __init__(self):
+        self._by_key_handle = {}
+        self._by_user = {}
+        self._lock = threading.Lock()
+
+    def add(self, user, registration):
+        stored = StoredRegistration.from_registration(user, registration)
+        with self._lock:
+            self._remove(stored.key_handle)
+            self._by_key_handle[stored.key_handle] = stored
+            self._by_user.setdefault(user, OrderedDict())[
+                stored.key_handle] = stored
+        return stored
+
+    def get(self, key_handle):
+        return self._by_key_handle.get(_key_handle(key_handle))
+
+    def for_user(self, user):
+        with self._lock:
+            return list(self._by_user.get(user, {}).values())
+
+    def _remove(self, key_handle):
+        stored = self._by_key_handle.pop(key_handle, None)
+        if stored is not None:
+            user_keys = self._by_user[stored.user]
+            del user_keys[key_handle]
+            if not user_keys:
+                del self._by_user[stored.user]
+        return stored
+
+    def remove(self, key_handle):
+        with self._lock:
+            return self._remove(_key_handle(key_handle)) is not None
+
+
+class SQLiteRegistrationRepository(RegistrationRepository):
+
+    def __init__(self, path=':memory:', table='u2f_registrations'):
+        self._table = table
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute(
+            'CREATE TABLE IF NOT EXISTS %s ('
+            'key_handle BLOB PRIMARY KEY, '
+            'user TEXT NOT NULL, '
+            'public_key BLOB NOT NULL, '
+            'app_id TEXT, '
+            'version TEXT NOT NULL, '
+            'transports INTEGER)' % table)
+        self._conn.execute(
+            'CREATE INDEX IF NOT EXISTS %s_user ON %s (user)' % (table, table))
+        self._columns = ('user, key_handle, public_key, app_id, version, '
+                         'transports')
+
+    def add(self, user, registration):
+        stored = StoredRegistration.from_registration(user, registration)
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO %s (%s) VALUES (?, ?, ?, ?, ?, ?)' % (
+                    self._table, self._columns),
+                (user, sqlite3.Binary(stored.key_handle),
+                 sqlite3.Binary(stored.public_key), stored.app_id,
+                 stored.version, stored.transports))
+        return stored
+
+    def _from_row(self, row):
+        user, key_handle, public_key, app_id, version, transports = row
+        return StoredRegistration(user, bytes(key_handle), bytes(public_key),
+                                  app_id, version, transports)
+
+    def get(self, key_handle):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT %s FROM %s WHERE key_handle = ?' % (
+                    self._columns, self._table),
+                (sqlite3.Binary(_key_handle(key_handle)),)).fetchone()
+        return self._from_row(row) if row else None
+
+    def for_user(self, user):
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT %s FROM %s WHERE user = ? ORDER BY rowid' % (
+                    self._columns, self._table), (user,)).fetchall()
+        return [self._from_row(row) for row in rows]
+
+    def remove(self, key_handle):
+        with self._lock:
+            cursor = self._conn.execute(
+                'DELETE FROM %s WHERE key_handle = ?' % self._table,
+                (sqlite3.Binary(_key_handle(key_handle)),))
+        return cursor.rowcount > 0
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -26,14 +26,20 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 
-from u2flib_server.model import U2fRegisterRequest, U2fSignRequest
+from u2flib_server.model import (U2fRegisterRequest, U2fSignRequest,
+                                 RegisterResponse, Transports, _PARSE_ERRORS)
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
 
 
 __all__ = [
     'begin_registration',
     'complete_registration',
+    'complete_registration_batch',
+    'check_registration',
     'begin_authentication',
-    'complete_authentication'
+    'complete_authentication',
+    'check_authentication'
 ]
 
 
@@ -45,9 +51,80 @@ def complete_registration(request, response, valid_facets=None):
     return U2fRegisterRequest.wrap(request).complete(response, valid_facets)
 
 
+def check_registration(request, response, valid_facets=None):
+    """Like complete_registration, but returns a VerificationResult."""
+    return U2fRegisterRequest.wrap(request).check(response, valid_facets)
+
+
+def _default_workers():
+    try:
+        return min(32, multiprocessing.cpu_count() + 4)
+    except NotImplementedError:
+        return 4
+
+
+def complete_registration_batch(items, valid_facets=None, max_workers=None):
+    """Completes many registrations, given as (request, response) pairs.
+
+    Attestation certificates are parsed once per distinct certificate in the
+    batch, and the signatures are verified in parallel using a thread pool.
+    Returns a list with one entry per item, in order, which is either the
+    (DeviceRegistration, certificate) tuple that complete_registration would
+    return, or the error raised while processing that item. Errors other
+    than invalid data are raised. max_workers defaults to the number of CPUs
+    plus four, up to 32.
+    """
+    results = [None] * len(items)
+    pending = []
+    attestation_cache = {}
+    for i, (request, response) in enumerate(items):
+        try:
+            request = U2fRegisterRequest.wrap(request)
+            response = RegisterResponse.wrap(response)
+            cert = response.registrationData.certificate
+            if cert not in attestation_cache:
+                attestation_cache[cert] = (
+                    response.registrationData.attestation_key,
+                    Transports.from_cert(cert)
+                )
+        except _PARSE_ERRORS as e:
+            results[i] = e
+        else:
+            pending.append((i, request, response))
+
+    def _complete(item):
+        i, request, response = item
+        try:
+            return i, request._complete(response, valid_facets,
+                                        attestation_cache)
+        except _PARSE_ERRORS as e:
+            return i, e
+
+    if pending:
+        if max_workers is None:
+            max_workers = _default_workers()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for i, result in executor.map(_complete, pending):
+                results[i] = result
+    return results
+
+
 def begin_authentication(app_id, devices, challenge=None):
     return U2fSignRequest.create(app_id, devices, challenge)
 
 
-def complete_authentication(request, response, valid_facets=None):
-    return U2fSignRequest.wrap(request).complete(response, valid_facets)
+def complete_authentication(request, response, valid_facets=None,
+                            counter_store=None, replay_cache=None,
+                            prepared_keys=None):
+    return U2fSignRequest.wrap(request).complete(response, valid_facets,
+                                                 counter_store, replay_cache,
+                                                 prepared_keys)
+
+
+def check_authentication(request, response, valid_facets=None,
+                         counter_store=None, replay_cache=None,
+                         prepared_keys=None):
+    """Like complete_authentication, but returns a VerificationResult."""
+    return U2fSignRequest.wrap(request).check(response, valid_facets,
+                                              counter_store, replay_cache,
+                                              prepared_keys)